@@ -12,12 +12,24 @@ Martinez-Romo, J. et al. Phys. Rev. E - Stat. Nonlinear, Soft Matter Phys. 84, 1
 
 """
 
-import graph_tool.all as gt
 import numpy as np
+import scipy.sparse as sp
+from scipy.special import gammaln, logsumexp, digamma, polygamma
 import time
+import os
+import json
+import zipfile
+import shutil
+import tempfile
 from sklearn.externals.joblib import Parallel, delayed
-from functools import partial
 import pandas as pd
+from progressMonitor import ProgressMonitor
+
+# graph-tool is only needed to read and write graphs in graph-tool formats
+try:
+    import graph_tool.all as gt
+except ImportError:
+    gt = None
 
 
 
@@ -51,58 +63,791 @@ def p_val_np(N,n1,n2,r):
     return _sum
 
 
-def compute_significance(e_ij, G, p0=1e-6):
-    s,t = e_ij
-    e = G.edge(s,t)
-    r = G.ep.weights[e]
-    n2, n1 = sorted((G.vp.counts[e.source()],G.vp.counts[e.target()]))
-    N = G.gp.Ntweets
+#==============================================================================
+# Vectorized significance
+#==============================================================================
+# p_val_np(N,n1,n2,r) is the upper tail P(X >= r) of the hypergeometric 
+# distribution of the number of co-occurrences X of two hashtags occurring
+# n1 and n2 times in N tweets. The functions below evaluate it for arrays of
+# edges at once, in log space.
+
+def _log_binom(n, k):
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+    
+def log_hypergeom_pmf(N, n1, n2, k):
+    """ natural logarithm of the probability of k co-occurrences """
+    return _log_binom(n1, k) + _log_binom(N - n1, n2 - k) - _log_binom(N, n2)
+    
+def log_p_val_exact(N, n1, n2, r):
+    """ natural logarithm of p_val_np(N,n1,n2,r) computed by summing all the 
+        terms of the tail in log space (single edge).
+    """
+    k = np.arange(r, n2 + 1, dtype=np.float64)
+    
+    return logsumexp(log_hypergeom_pmf(N, n1, n2, k))
+    
+def _relative_tail_sum(N, n1, n2, k0, direction, rtol=1e-12, max_terms=100000):
+    """ returns the sums of the terms pmf(k0 + direction*j)/pmf(k0), j >= 0, 
+        for arrays of edges and a boolean array indicating which sums converged
+        in less than max_terms terms.
+        
+        The terms must be decreasing away from k0 (i.e. k0 is in the tail of 
+        the distribution). All the edges are summed in lockstep using the ratio 
+        of successive terms and an edge is removed from the active set as soon
+        as its terms are smaller than rtol times its sum.
+    """
+    acc = np.ones(k0.size)
+    term = np.ones(k0.size)
+    k = k0.astype(np.float64)
+    
+    active = np.arange(k0.size)
+    for _ in range(max_terms):
+        if active.size == 0:
+            break
+        
+        ka = k[active]
+        Na, n1a, n2a = N[active], n1[active], n2[active]
+        if direction > 0:
+            ratio = (n1a - ka)*(n2a - ka)/((ka + 1)*(Na - n1a - n2a + ka + 1))
+        else:
+            ratio = ka*(Na - n1a - n2a + ka)/((n1a - ka + 1)*(n2a - ka + 1))
+        
+        term[active] *= ratio
+        acc[active] += term[active]
+        k[active] += direction
+        
+        active = active[term[active] > rtol*acc[active]]
+        
+    converged = np.ones(k0.size, dtype=bool)
+    converged[active] = False
+    
+    return acc, converged
+    
+def log_p_val(N, n1, n2, r, rtol=1e-12, max_terms=100000):
+    """ natural logarithm of p_val_np(N,n1,n2,r) for arrays of edges.
+    
+        If r is above the mode of the distribution, the tail is summed from k=r 
+        upward, otherwise p is computed as 1 minus the lower tail summed from
+        k=r-1 downward, so that only decreasing terms are summed. Sums are 
+        stopped when the relative contribution of the terms is smaller than 
+        rtol. Edges needing more than max_terms terms fall back to the exact 
+        summation of `log_p_val_exact`.
+    """
+    N, n1, n2, r = [a.ravel() for a in np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) 
+                                                             for x in (N, n1, n2, r)])]
+    
+    assert np.all(N >= n1) and np.all(n1 >= n2) and np.all(n2 >= r)
+    
+    log_p = np.zeros(r.size)
+    
+    mode = np.floor((n1 + 1)*(n2 + 1)/(N + 2))
+    # smallest possible number of co-occurrences
+    k_min = np.maximum(0, n1 + n2 - N)
+    
+    # upper tail
+    upper = np.nonzero(r > mode)[0]
+    acc, converged = _relative_tail_sum(N[upper], n1[upper], n2[upper], r[upper], 
+                                        1, rtol=rtol, max_terms=max_terms)
+    log_p[upper] = log_hypergeom_pmf(N[upper], n1[upper], n2[upper], r[upper]) + np.log(acc)
+    fallback = upper[~converged]
+    
+    # 1 - lower tail (p = 1 if r <= k_min)
+    lower = np.nonzero((r <= mode) & (r > k_min))[0]
+    acc, converged = _relative_tail_sum(N[lower], n1[lower], n2[lower], r[lower] - 1, 
+                                        -1, rtol=rtol, max_terms=max_terms)
+    log_cdf = log_hypergeom_pmf(N[lower], n1[lower], n2[lower], r[lower] - 1) + np.log(acc)
+    log_p[lower] = np.log1p(-np.exp(log_cdf))
+    fallback = np.concatenate((fallback, lower[~converged]))
+    
+    for i in fallback:
+        log_p[i] = log_p_val_exact(N[i], n1[i], n2[i], r[i])
+        
+    return log_p
+    
+#==============================================================================
+# Tiered significance
+#==============================================================================
+# For hashtags with large counts, the tail of the distribution spans many 
+# standard deviations and summing its terms becomes expensive. Since the 
+# hypergeometric distribution is log-concave, the tail sum can be bounded with
+# a few evaluations of the pmf at knots: between two knots, the log of the 
+# terms lies above the chord and below the tangent at the first knot, both 
+# leading to geometric sums. The approximation is the geometric mean of the 
+# bounds, its error is at most half the width of the bounds.
+
+# knots in units of the decay length of the tail
+_TAIL_KNOTS = np.concatenate((np.arange(0, 4, 0.25), [4, 5, 6, 8, 10, 13, 16, 20, 25, 32, 40]))
+
+def _log_geometric_sum(log_q, h):
+    """ natural logarithm of 1 + q + ... + q**(h-1) for q <= 1 """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_sum = np.log(-np.expm1(h*log_q)) - np.log(-np.expm1(log_q))
+    log_sum = np.where(log_q == 0, np.log(np.maximum(h, 1)), log_sum)
+    
+    return np.where(h == 0, -np.inf, log_sum)
+    
+def _log_tail_bounds(N, n1, n2, k0, direction):
+    """ returns lower and upper bounds of the natural logarithm of the sum of
+        pmf(k0 + direction*j), j >= 0, for arrays of edges. 
+        
+        The terms must be decreasing away from k0.
+    """
+    # end of the support of the distribution
+    if direction > 0:
+        k_end = n2
+    else:
+        k_end = np.maximum(0, n1 + n2 - N)
+    span = np.abs(k_end - k0)
+    
+    log_pmf0 = log_hypergeom_pmf(N, n1, n2, k0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_ratio0 = np.where(span > 0, 
+                              log_hypergeom_pmf(N, n1, n2, k0 + direction*(span > 0)) - log_pmf0,
+                              -np.inf)
+        
+        # decay length of the tail, limited by the standard deviation
+        std = np.sqrt(n2*(n1/N)*(1 - n1/N)*(N - n2)/np.maximum(N - 1, 1))
+        scale = np.minimum(-1/np.expm1(log_ratio0), std + 1)
+    
+    offsets = np.minimum(np.round(scale[:,None]*_TAIL_KNOTS[None,:]), span[:,None])
+    k = k0[:,None] + direction*offsets
+    N, n1, n2 = N[:,None], n1[:,None], n2[:,None]
+    
+    log_pmf = log_hypergeom_pmf(N, n1, n2, k)
+    at_end = offsets == span[:,None]
+    with np.errstate(invalid='ignore'):
+        log_ratio = np.where(at_end, -np.inf, 
+                             log_hypergeom_pmf(N, n1, n2, k + direction*~at_end) - log_pmf)
+    
+    # segments between knots
+    h = np.diff(offsets, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_chord = (log_pmf[:,1:] - log_pmf[:,:-1])/h
+    lower = log_pmf[:,:-1] + _log_geometric_sum(log_chord, h)
+    upper = log_pmf[:,:-1] + _log_geometric_sum(log_ratio[:,:-1], h)
+    
+    # tail after the last knot
+    lower = np.column_stack((lower, log_pmf[:,-1]))
+    with np.errstate(divide='ignore'):
+        upper = np.column_stack((upper, log_pmf[:,-1] - np.log(-np.expm1(log_ratio[:,-1]))))
+    
+    return logsumexp(lower, axis=1), logsumexp(upper, axis=1)
+    
+def log_p_val_bounds(N, n1, n2, r):
+    """ returns lower and upper bounds of the natural logarithm of 
+        p_val_np(N,n1,n2,r) for arrays of edges, computed with a fixed number 
+        of evaluations of the pmf per edge.
+    """
+    N, n1, n2, r = [a.ravel() for a in np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) 
+                                                             for x in (N, n1, n2, r)])]
+    
+    log_p_low = np.zeros(r.size)
+    log_p_up = np.zeros(r.size)
+    
+    mode = np.floor((n1 + 1)*(n2 + 1)/(N + 2))
+    k_min = np.maximum(0, n1 + n2 - N)
+    
+    # upper tail
+    upper = np.nonzero(r > mode)[0]
+    log_p_low[upper], log_p_up[upper] = _log_tail_bounds(N[upper], n1[upper], n2[upper], 
+                                                         r[upper], 1)
+    
+    # 1 - lower tail
+    lower = np.nonzero((r <= mode) & (r > k_min))[0]
+    log_cdf_low, log_cdf_up = _log_tail_bounds(N[lower], n1[lower], n2[lower], 
+                                               r[lower] - 1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_p_low[lower] = np.log1p(-np.exp(np.minimum(log_cdf_up, 0)))
+        log_p_up[lower] = np.log1p(-np.exp(log_cdf_low))
+    
+    return np.minimum(log_p_low, 0), np.minimum(log_p_up, 0)
+    
+def log_p_val_tiered(N, n1, n2, r, accuracy=1e-2, min_terms=100, return_tiers=False):
+    """ natural logarithm of p_val_np(N,n1,n2,r) for arrays of edges, 
+        computed with one of three tiers per edge:
+        
+        0. edges with small counts (less than about min_terms terms to sum) 
+           are summed with `log_p_val`,
+        1. for the others, the p-value is approximated by the geometric mean of
+           the bounds of `log_p_val_bounds` if its error on log10(p) is smaller
+           than accuracy,
+        2. the remaining edges are summed with `log_p_val`.
+           
+        If return_tiers is True, also returns the tier of each edge.
+    """
+    N, n1, n2, r = [a.ravel() for a in np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) 
+                                                             for x in (N, n1, n2, r)])]
+    
+    log_p = np.zeros(r.size)
+    tiers = np.zeros(r.size, dtype=np.int8)
+    
+    large = np.nonzero(expected_cost(N, n1, n2, r, method='log') > min_terms)[0]
+    
+    log_p_low, log_p_up = log_p_val_bounds(N[large], n1[large], n2[large], r[large])
+    approximated = (log_p_up - log_p_low)/2 <= accuracy*np.log(10)
+    log_p[large[approximated]] = ((log_p_up + log_p_low)/2)[approximated]
+    tiers[large[approximated]] = 1
+    tiers[large[~approximated]] = 2
+    
+    summed = np.nonzero(tiers != 1)[0]
+    log_p[summed] = log_p_val(N[summed], n1[summed], n2[summed], r[summed])
+    
+    if return_tiers:
+        return log_p, tiers
+    
+    return log_p
+    
+def edge_counts(G):
+    """ returns the arrays n1, n2 (number of occurences of the two hashtags of
+        each edge, with n1 >= n2) and r (number of co-occurences)
+    """
+    counts = G.vp.counts[G.edges]
+    
+    return counts.max(axis=1), counts.min(axis=1), G.ep.weights
+    
+
+class PValTable(object):
+    """ Table of the natural logarithm of the p-values keyed by (N, n1, n2, r).
+    
+        The table is used to compute each p-value only once, it can be saved
+        and loaded to reuse p-values between runs and graphs with the same
+        number of tweets N. Only exact p-values are stored (not the 
+        approximations of `log_p_val_tiered`), so that the table can be used
+        with any method. `hits` and `misses` count the number of p-values
+        found and not found in the table since it was created or loaded 
+        (cumulative over all the lookups).
+    """
+    
+    key_dtype = np.dtype([('N', np.int64), ('n1', np.int64), ('n2', np.int64), ('r', np.int64)])
+    
+    def __init__(self, keys=None, log_p=None):
+        if keys is None:
+            keys = np.zeros(0, dtype=self.key_dtype)
+            log_p = np.zeros(0)
+        
+        # keys are kept sorted for lookups
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.log_p = np.asarray(log_p)[order]
+        
+        self.hits = 0
+        self.misses = 0
+        
+    def __len__(self):
+        return self.keys.size
+        
+    @classmethod
+    def make_keys(cls, N, n1, n2, r):
+        keys = np.zeros(np.size(r), dtype=cls.key_dtype)
+        keys['N'] = N
+        keys['n1'] = n1
+        keys['n2'] = n2
+        keys['r'] = r
+        return keys
+        
+    def lookup(self, keys):
+        """ returns the log p-values of keys, NaN if not in the table """
+        
+        log_p = np.full(keys.size, np.nan)
+        
+        if self.keys.size > 0:
+            pos = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+            found = self.keys[pos] == keys
+            log_p[found] = self.log_p[pos[found]]
+        else:
+            found = np.zeros(keys.size, dtype=bool)
+        
+        self.hits += int(found.sum())
+        self.misses += int(keys.size - found.sum())
+        
+        return log_p
+        
+    def update(self, keys, log_p):
+        """ adds new keys (not already in the table) and their log p-values """
+        
+        keys = np.concatenate((self.keys, keys))
+        log_p = np.concatenate((self.log_p, log_p))
+        
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.log_p = log_p[order]
+        
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return self.hits/(self.hits + self.misses)
+        
+    def save(self, filename):
+        with open(filename, 'wb') as fopen:
+            np.savez(fopen, keys=self.keys, log_p=self.log_p, exact=np.array(True))
+            
+    @classmethod
+    def load(cls, filename):
+        """ loads a table saved with `save`, returns an empty table if 
+            filename does not exist or if it was saved without the `exact` 
+            flag (it might contain approximated p-values)
+        """
+        if not os.path.exists(filename):
+            return cls()
+        
+        with np.load(filename) as arrays:
+            if 'exact' not in arrays.files:
+                print('ignoring ' + filename + ', it might contain approximated p-values')
+                return cls()
+            
+            return cls(arrays['keys'], arrays['log_p'])
+            
+
+def pval_table_filename(graph_file):
+    """ default filename of the p-value table saved alongside graph_file """
+    return os.path.splitext(graph_file)[0] + '_pval_table.npz'
+    
+
+def log_p_val_np(N, n1, n2, r):
+    """ natural logarithm of p_val_np """
+    return float(np.log(p_val_np(N, n1, n2, r)))
+    
+def expected_cost(N, n1, n2, r, method='log'):
+    """ returns the expected relative cost of computing the p-values of 
+        arrays of edges.
+        
+        With method='exact', `p_val_np` computes n2-r+1 products of length n2.
+        With method='log', `log_p_val` sums the terms of the tail until they 
+        are negligible, i.e. at most a few standard deviations of the 
+        distribution away from r.
+        With method='tiered', `log_p_val_tiered` evaluates the pmf a fixed 
+        number of times for edges with large counts.
+    """
+    n1 = np.asarray(n1, dtype=np.float64)
+    n2 = np.asarray(n2, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    
+    if method == 'exact':
+        return (n2 - r + 1)*n2
+    
+    std = np.sqrt(n2*(n1/N)*(1 - n1/N)*(N - n2)/np.maximum(N - 1, 1))
+    
+    cost = 1 + np.minimum(n2 - r + 1, 10*(std + 1))
+    
+    if method == 'tiered':
+        return np.minimum(cost, 4*_TAIL_KNOTS.size)
+    
+    return cost
+    
+def _log_p_vals_chunk(N, counts, start, stop, method='log', accuracy=1e-2):
+    """ computes the log p-values of the edges start to stop in the array
+        counts (with rows n1, n2, r). Returns the log p-values, whether they
+        are exact (not approximated by `log_p_val_tiered`) and the 
+        computation time.
+    """
+    t0 = time.time()
+    
+    n1, n2, r = counts[:, start:stop]
+    
+    exact = np.ones(stop - start, dtype=bool)
+    if method == 'log':
+        log_p = log_p_val(N, n1, n2, r)
+    elif method == 'tiered':
+        log_p, tiers = log_p_val_tiered(N, n1, n2, r, accuracy=accuracy, return_tiers=True)
+        exact = tiers != 1
+    else:
+        log_p = np.array([log_p_val_np(N, int(a), int(b), int(c)) for a, b, c in zip(n1, n2, r)])
+    
+    return log_p, exact, time.time() - t0
+    
+def balanced_chunks(cost, num_chunks):
+    """ splits consecutive items with the given costs in num_chunks chunks
+        of similar total cost. Returns a list of (start, stop).
+    """
+    cum_cost = np.cumsum(cost)
+    
+    bounds = np.searchsorted(cum_cost, cum_cost[-1]*np.arange(1, num_chunks)/num_chunks)
+    bounds = np.unique(np.concatenate(([0], bounds, [cost.size])))
+    
+    return list(zip(bounds[:-1], bounds[1:]))
+    
+def compute_log_p_vals(N, n1, n2, r, method='log', ncpu=1, chunks_per_cpu=4,
+                       chunk_size=100000, metrics_file=None, accuracy=1e-2,
+                       return_exact=False):
+    """ returns the natural logarithm of the p-values of arrays of edges 
+        with `log_p_val` (method='log'), with `log_p_val_tiered` and the given
+        accuracy on log10(p) (method='tiered') or with `p_val_np` 
+        (method='exact'), using ncpu processes.
+        
+        Edges are sorted by expected cost and split into chunks of similar 
+        total cost: chunks_per_cpu*ncpu chunks with several processes, chunks 
+        of about chunk_size edges otherwise (one edge per chunk for the 'exact'
+        method). Only the arrays of counts are shared with the workers, through
+        a memory-mapped file.
+        
+        Progress and the computation time per n2 range are reported with a 
+        `ProgressMonitor` and appended to metrics_file if given.
+        
+        If return_exact is True, also returns whether each p-value is exact
+        (not approximated by `log_p_val_tiered`).
+    """
+    num_edges = np.size(r)
+    
+    monitor = ProgressMonitor('significance', total=num_edges, unit='edges', 
+                              cost_key_name='n2')
+    
+    if num_edges == 0:
+        monitor.close(metrics_file)
+        if return_exact:
+            return np.zeros(0), np.ones(0, dtype=bool)
+        return np.zeros(0)
+    
+    cost = expected_cost(N, n1, n2, r, method=method)
+    order = np.argsort(cost, kind='mergesort')
+    
+    if ncpu > 1:
+        num_chunks = ncpu*chunks_per_cpu
+    elif method in ['log', 'tiered']:
+        num_chunks = int(np.ceil(num_edges/chunk_size))
+    else:
+        num_chunks = num_edges
+        
+    chunks = balanced_chunks(cost[order], num_chunks)
+    
+    # counts are written once to a memory-mapped file shared by the workers
+    temp_folder = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        counts_file = os.path.join(temp_folder, 'counts.npy')
+        counts = np.lib.format.open_memmap(counts_file, mode='w+', dtype=np.int64,
+                                           shape=(3, num_edges))
+        counts[0] = np.asarray(n1)[order]
+        counts[1] = np.asarray(n2)[order]
+        counts[2] = np.asarray(r)[order]
+        counts.flush()
+        del counts
+        
+        counts = np.load(counts_file, mmap_mode='r')
+        
+        if ncpu > 1:
+            res = Parallel(n_jobs=ncpu, verbose=1)(delayed(_log_p_vals_chunk)(N, counts, start, stop, 
+                                                                              method=method,
+                                                                              accuracy=accuracy)
+                                                   for start, stop in chunks)
+        else:
+            res = []
+            for start, stop in chunks:
+                res.append(_log_p_vals_chunk(N, counts, start, stop, method=method,
+                                             accuracy=accuracy))
+                monitor.update(stop - start, cost_keys=counts[1, start:stop], 
+                               elapsed=res[-1][2])
+                
+        if ncpu > 1:
+            # time spent in the workers
+            for (start, stop), (_, _, chunk_time) in zip(chunks, res):
+                monitor.update(stop - start, cost_keys=counts[1, start:stop], 
+                               elapsed=chunk_time)
+        del counts
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        
+    log_p = np.zeros(num_edges)
+    log_p[order] = np.concatenate([log_p_chunk for log_p_chunk, _, _ in res])
+    exact = np.ones(num_edges, dtype=bool)
+    exact[order] = np.concatenate([exact_chunk for _, exact_chunk, _ in res])
+    
+    monitor.close(metrics_file)
+    
+    if return_exact:
+        return log_p, exact
+    
+    return log_p
+    
+
+def memoized_log_p_vals(N, n1, n2, r, method='log', ncpu=1, pval_table=None,
+                        metrics_file=None, accuracy=1e-2, return_exact=False):
+    """ returns the natural logarithm of the p-values of arrays of edges.
+    
+        The p-value is computed only once for each unique triple (n1, n2, r) 
+        of edges and looked up first in pval_table (a `PValTable`) if given.
+        The table is updated with the new exact p-values.
+        (see `compute_log_p_vals` for the other parameters)
+    """
+    if pval_table is None:
+        pval_table = PValTable()
+        
+    # unique triples of counts
+    keys, inverse = np.unique(PValTable.make_keys(N, n1, n2, r), return_inverse=True)
+    
+    log_p = pval_table.lookup(keys)
+    missing = np.isnan(log_p)
+    
+    exact = np.ones(keys.size, dtype=bool)
+    log_p[missing], exact[missing] = compute_log_p_vals(N, keys['n1'][missing], 
+                                        keys['n2'][missing], keys['r'][missing], 
+                                        method=method, ncpu=ncpu, metrics_file=metrics_file, 
+                                        accuracy=accuracy, return_exact=True)
+    # approximated p-values are not stored
+    new = missing & exact
+    pval_table.update(keys[new], log_p[new])
+    
+    num_edges = np.size(r)
+    print('computed ' + str(missing.sum()) + ' p-values for ' + str(num_edges) + 
+          ' edges (' + str(keys.size) + ' unique triples, ' + 
+          str(keys.size - missing.sum()) + ' found in table)')
+    print('unique triples per edge: ' + '{:.2%}'.format(keys.size/max(num_edges, 1)) +
+          ', table hit rate: ' + '{:.2%}'.format((~missing).sum()/max(keys.size, 1)) +
+          ' (cumulative: ' + '{:.2%}'.format(pval_table.hit_rate()) + ')')
+    
+    if return_exact:
+        return log_p[inverse.ravel()], exact[inverse.ravel()]
+    
+    return log_p[inverse.ravel()]
     
-    return np.log10(p0/p_val_np(N,n1,n2,r))
 
-def add_p_val_to_edges(G, N, p0=1e-6, ncpu=1):
+def add_p_val_to_edges(G, N, p0=1e-6, ncpu=1, method='log', pval_table=None, 
+                       metrics_file=None, accuracy=1e-2):
     """ add an edge vertex property 's' with the significance of the edge
         coocurence
+        
+        The p-value is computed only once for each unique triple (n1, n2, r) 
+        of edges and looked up first in pval_table (a `PValTable`) if given.
+        The table is updated with the new p-values.
+        
+        method is 'log' to evaluate the p-values of all edges at once in log
+        space (`log_p_val`), 'tiered' to approximate the p-values of edges with
+        large counts when the error on log10(p) is smaller than accuracy 
+        (`log_p_val_tiered`) or 'exact' to use `p_val_np` for each triple.
+        With ncpu > 1, triples are split into chunks of similar cost computed 
+        in parallel (see `compute_log_p_vals`). A summary of the computation 
+        is appended to metrics_file if given.
+        
+        Returns the anchors of the log p-values (see `significance_anchors`).
         """
     
-    G.graph_properties['p0'] = G.new_graph_property('float')
-    G.graph_properties['p0'] = p0
+    G.gp['p0'] = p0
+    
+    n1, n2, r = edge_counts(G)
+    
+    log_p, exact = memoized_log_p_vals(N, n1, n2, r, method=method, ncpu=ncpu, 
+                                       pval_table=pval_table, metrics_file=metrics_file,
+                                       accuracy=accuracy, return_exact=True)
     
     # edge significance
-    sign_map = G.new_edge_property('float')
+    G.ep['s'] = np.log10(p0) - log_p/np.log(10)
+    
+    return significance_anchors(N, log_p, np.where(exact, 0, accuracy))
+        
 
-    if ncpu == 1:
-        t0 = time.time()
-        for i, e in enumerate(G.edges()):
-            
-            print(str(i) + ' over ' + str(G.num_edges()))
-            print(time.time()-t0)
-            # num of cooccurence
-            r = G.ep.weights[e]
-            # num of occurence of v1 and v2
-            n2, n1 = sorted((G.vp.counts[e.source()],G.vp.counts[e.target()]))
-            
-            sign_map[e] = np.log10(p0/p_val_np(N,n1,n2,r))
-            
-    else: #multiprocessing
+#==============================================================================
+# Incremental significance
+#==============================================================================
+# When the graph is rebuilt with new tweets, the number of tweets N changes and
+# so do all the p-values. The inputs and results of the previous computation 
+# are saved in a state file. Edges whose counts (n1, n2, r) changed are 
+# recomputed exactly, the others are rescaled to the new N with a first order
+# correction when its error bound is small enough.
+# Rescaled values are never rescaled again: each edge keeps the anchor of its 
+# last computation (number of tweets, log p-value and its error on s) and is 
+# always rescaled from it, so that errors do not accumulate between updates.
+
+def significance_anchors(N, log_p, error):
+    """ returns the anchors of log p-values computed with N tweets and with 
+        the given error on s (0 if exact)
+    """
+    return {'anchor_N': np.full(np.size(log_p), N, dtype=np.int64),
+            'anchor_log_p': np.asarray(log_p, dtype=np.float64),
+            'anchor_error': np.asarray(error, dtype=np.float64)*np.ones(np.size(log_p))}
+
+def significance_state_filename(graph_file):
+    """ default filename of the significance state saved alongside graph_file """
+    return os.path.splitext(graph_file)[0] + '_signi_state.npz'
     
-        _compute_significance = partial(compute_significance, G=G, p0=p0)
-        edges_ij = [(G.vertex_index[e.source()], G.vertex_index[e.target()]) for e in G.edges()]
-                 
-        sign_res = Parallel(n_jobs=ncpu, verbose=1, 
-                            batch_size=1)(delayed(_compute_significance)(e_ij) for e_ij in edges_ij)
+def save_significance_state(G, filename, anchors):
+    """ saves the inputs (hashtag names, edges and counts), the resulting
+        log p-values of the significance computation of G and their anchors
+        (returned by `add_p_val_to_edges` or `update_p_val_of_edges`)
+    """
+    n1, n2, r = edge_counts(G)
+    
+    with open(filename, 'wb') as fopen:
+        np.savez(fopen, N=np.array(G.gp['Ntweets']), names=np.asarray(G.vp.names), 
+                 edges=G.edges, n1=n1, n2=n2, r=r, 
+                 log_p=(np.log10(G.gp['p0']) - G.ep.s)*np.log(10), **anchors)
         
-        for sign, e_ij in zip(sign_res, edges_ij):
-            s,t = e_ij
-            e = G.edge(s,t)
-            sign_map[e] = sign
+def load_significance_state(filename):
+    """ returns a dictionary with the state saved by `save_significance_state`,
+        None if filename does not exist or if the state has no anchors
+    """
+    if not os.path.exists(filename):
+        return None
+    
+    with np.load(filename) as arrays:
+        if 'anchor_N' not in arrays.files:
+            print('ignoring ' + filename + ', saved without anchors')
+            return None
+        
+        return {key: arrays[key] for key in arrays.files}
+        
+def match_edges(G, names, edges):
+    """ returns, for each edge of G, the index of the same edge (between the
+        same hashtags) in edges, an array of pairs of indices in names, or -1
+        if the edge is not present.
+    """
+    num_vertices = G.num_vertices()
+    
+    # index in G of the vertices of names
+    new_index = G.vertex_index(names)
+    
+    other_edges = new_index[edges]
+    valid = np.nonzero(np.all(other_edges >= 0, axis=1))[0]
+    other_edges = other_edges[valid]
+    
+    def edge_codes(e):
+        return np.minimum(e[:,0], e[:,1]).astype(np.int64)*num_vertices + np.maximum(e[:,0], e[:,1])
+    
+    other_codes = edge_codes(other_edges)
+    order = np.argsort(other_codes)
+    other_codes = other_codes[order]
+    
+    codes = edge_codes(G.edges)
+    pos = np.minimum(np.searchsorted(other_codes, codes), max(other_codes.size - 1, 0))
+    
+    matched = np.full(G.num_edges(), -1, dtype=np.int64)
+    if other_codes.size > 0:
+        found = other_codes[pos] == codes
+        matched[found] = valid[order[pos[found]]]
+    
+    return matched
     
-    G.ep['s'] = sign_map
+def rescale_log_p_val(N_old, N_new, n1, n2, r, log_p_old):
+    """ rescales log p-values computed with N_old tweets to N_new tweets.
+    
+        For r above the mode, log(p) is dominated by the log of the first term
+        of the tail, whose derivative with respect to N is
+        D(N) = psi(N-n1+1) - psi(N-n1-n2+r+1) - psi(N+1) + psi(N-n2+1).
+        The correction is D((N_old+N_new)/2)*(N_new-N_old).
+        
+        Returns the rescaled log p-values and a bound on their error (natural 
+        log) that accounts for the variation of D over the interval and for the
+        weight of the other terms of the tail. The bound is infinite for edges
+        below the mode, which must be recomputed.
+    """
+    n1 = np.asarray(n1, dtype=np.float64)
+    n2 = np.asarray(n2, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    
+    dN = float(N_new - N_old)
+    N_mid = (N_old + N_new)/2
+    
+    D = digamma(N_mid - n1 + 1) - digamma(N_mid - n1 - n2 + r + 1) - \
+        digamma(N_mid + 1) + digamma(N_mid - n2 + 1)
+    # derivative of D, taken at the edge of the interval where it is largest
+    dD = np.maximum(*[np.abs(polygamma(1, NN - n1 + 1) - polygamma(1, NN - n1 - n2 + r + 1) - \
+                             polygamma(1, NN + 1) + polygamma(1, NN - n2 + 1))
+                      for NN in (N_old, N_new)])
+    
+    log_p_new = log_p_old + D*dN
+    
+    # expected excess k-r in the tail is bounded by rho/(1-rho), where rho is 
+    # the ratio between the second and first terms of the tail
+    N_min = min(N_old, N_new)
+    rho = (n1 - r)*(n2 - r)/((r + 1)*(N_min - n1 - n2 + r + 1))
+    with np.errstate(divide='ignore'):
+        excess = np.where(rho < 1, rho/(1 - rho), np.inf)
+    
+    error = 0.5*dN**2*dD + abs(dN)*excess/(N_min - n1 - n2 + r + 1)
+    
+    # only valid above the mode
+    for NN in (N_old, N_new):
+        error[r <= np.floor((n1 + 1)*(n2 + 1)/(NN + 2))] = np.inf
+        
+    return log_p_new, error
+    
+def update_p_val_of_edges(G, N, state, p0=1e-6, max_error=1e-2, num_validation=1000,
+                          ncpu=1, method='log', pval_table=None, metrics_file=None,
+                          accuracy=1e-2):
+    """ updates the significance 's' of the edges of G using the state of a 
+        previous computation (see `save_significance_state`).
+        
+        Edges whose counts (n1, n2, r) changed are recomputed exactly. The 
+        others are rescaled from their anchor (the number of tweets and log 
+        p-value of their last computation) to N with `rescale_log_p_val` when 
+        the error bound on s, including the error of the anchor, is smaller 
+        than max_error and recomputed otherwise. The rescaling is validated on 
+        a random sample of num_validation reused edges: if the error on one of
+        them is larger than max_error, all the edges are recomputed. 
+        
+        Returns the anchors of the log p-values (see `significance_anchors`).
+    """
+    G.gp['p0'] = p0
+    
+    n1, n2, r = edge_counts(G)
+    
+    matched = match_edges(G, state['names'], state['edges'])
+    unchanged = np.nonzero(matched >= 0)[0]
+    old = matched[unchanged]
+    same = (state['n1'][old] == n1[unchanged]) & (state['n2'][old] == n2[unchanged]) & \
+           (state['r'][old] == r[unchanged])
+    unchanged = unchanged[same]
+    old = old[same]
+    
+    log_p = np.zeros(G.num_edges())
+    
+    anchor_N = state['anchor_N'][old]
+    anchor_log_p = state['anchor_log_p'][old]
+    
+    # rescale from the anchors, grouped by number of tweets
+    log_p_new = np.zeros(unchanged.size)
+    error = state['anchor_error'][old].copy()
+    for N_anchor in np.unique(anchor_N):
+        sel = anchor_N == N_anchor
+        if N_anchor == N:
+            log_p_new[sel] = anchor_log_p[sel]
+        else:
+            log_p_new[sel], rescale_error = rescale_log_p_val(int(N_anchor), N, n1[unchanged[sel]],
+                                                              n2[unchanged[sel]], r[unchanged[sel]],
+                                                              anchor_log_p[sel])
+            error[sel] += rescale_error/np.log(10)
+            
+    ok = error <= max_error
+    rescaled = unchanged[ok]
+    log_p[rescaled] = log_p_new[ok]
+    
+    # validation on a random sample
+    if rescaled.size > 0:
+        sample = np.random.RandomState(42).choice(rescaled, min(num_validation, rescaled.size),
+                                                  replace=False)
+        sample_error = np.abs(log_p[sample] - log_p_val(N, n1[sample], n2[sample], r[sample]))/np.log(10)
+        
+        print('rescaling validated on ' + str(sample.size) + ' edges, max error on s: ' + 
+              '{:.3}'.format(sample_error.max()))
         
+        if sample_error.max() > max_error:
+            print('error larger than ' + str(max_error) + ', recomputing all edges')
+            rescaled = np.zeros(0, dtype=np.int64)
+            ok[:] = False
+    
+    to_compute = np.ones(G.num_edges(), dtype=bool)
+    to_compute[rescaled] = False
+    
+    print('reusing ' + str(rescaled.size) + ' edges, recomputing ' + 
+          str(to_compute.sum()) + ' edges')
+    
+    log_p[to_compute], exact = memoized_log_p_vals(N, n1[to_compute], n2[to_compute], 
+                                            r[to_compute], method=method, ncpu=ncpu, 
+                                            pval_table=pval_table, metrics_file=metrics_file,
+                                            accuracy=accuracy, return_exact=True)
+    
+    G.ep['s'] = np.log10(p0) - log_p/np.log(10)
+    
+    # recomputed edges are anchored at N, the others keep their anchor
+    anchors = significance_anchors(N, log_p, 0.0)
+    anchors['anchor_error'][to_compute] = np.where(exact, 0, accuracy)
+    anchors['anchor_N'][rescaled] = anchor_N[ok]
+    anchors['anchor_log_p'][rescaled] = anchor_log_p[ok]
+    anchors['anchor_error'][rescaled] = state['anchor_error'][old][ok]
+    
+    return anchors
+    
 
 def propagates_labels(Graph, init_label_vp='label_init'):
     """ propage labels from init_label_vp to neighbours according to edge significance
-        init_label_vp is a integer graph-tool vertex property, each label has
+        init_label_vp is a integer vertex property, each label has
         a value > 0. Vertices without labels have a value = -1.
         
         Returns a dataframe with each vertex as row and 
@@ -113,50 +858,767 @@ def propagates_labels(Graph, init_label_vp='label_init'):
         label_sum(label_val) is equal to the number of neighbor with label_val
         signi_sum(label_val) is equal to the sum of the significance of 
                 the links with neighbor of label_val
-    
+                
+        All the sums are computed at once with the product of the adjacency
+        matrix (with 1 or the significance as entries) and a one-hot matrix
+        of the initial labels.
     """
     # results dataframe
     df_propag = pd.DataFrame(columns=['name', 'count',init_label_vp,'vertex_id'])
 
-    df_propag['name'] = Graph.vp.names.get_2d_array([0])[0]
-    df_propag['count'] = Graph.vp.counts.a
-    df_propag['vertex_id'] = [Graph.vertex_index[v] for v in Graph.vertices()]
-    df_propag[init_label_vp] = Graph.vp[init_label_vp].a
+    df_propag['name'] = Graph.vp.names
+    df_propag['count'] = Graph.vp.counts
+    df_propag['vertex_id'] = np.arange(Graph.num_vertices())
+    df_propag[init_label_vp] = Graph.vp[init_label_vp]
               
 
     # get the different labels
     labels_values = df_propag[init_label_vp].unique()
     labels_values = labels_values[labels_values>0]
     
-    #create a dictionary of vp for each labels
-    final_label_vp = dict()
-    for label_val in labels_values:
-        final_label_vp[label_val] = {'sum_label' : Graph.new_vertex_property('float', val=0),
-                                     'sum_signi' : Graph.new_vertex_property('float', val=0)}
-    
-    for label_val in labels_values:
-        for v_i in df_propag.loc[df_propag[init_label_vp] == label_val].vertex_id:
-            v = Graph.vertex(v_i)
-            for e in v.out_edges():
-                final_label_vp[label_val]['sum_label'][e.target()] += 1
-                final_label_vp[label_val]['sum_signi'][e.target()] += Graph.ep.s[e]
-                
-    for label_val in labels_values:
-        df_propag['label_sum' + str(label_val)] = final_label_vp[label_val]['sum_label'].a
-        df_propag['signi_sum' + str(label_val)] = final_label_vp[label_val]['sum_signi'].a
+    # one-hot matrix of the seeds of each label
+    labels = np.asarray(Graph.vp[init_label_vp])
+    seeds = np.nonzero(labels > 0)[0]
+    order = np.argsort(labels_values)
+    columns = order[np.searchsorted(labels_values[order], labels[seeds])]
+    seed_matrix = sp.csr_matrix((np.ones(seeds.size), (seeds, columns)),
+                                shape=(Graph.num_vertices(), labels_values.size))
+    
+    # number of neighbors and sum of significances for each label
+    label_sums = Graph.adjacency().dot(seed_matrix).toarray()
+    signi_sums = Graph.adjacency(Graph.ep.s).dot(seed_matrix).toarray()
+    
+    for j, label_val in enumerate(labels_values):
+        df_propag['label_sum' + str(label_val)] = label_sums[:,j]
+        df_propag['signi_sum' + str(label_val)] = signi_sums[:,j]
 
     
     return df_propag
     
 
+def propagates_labels_iteratively(Graph, init_label_vp='label_init', count_ratio=0.0,
+                                  max_rounds=10, max_new_per_round=None, min_new_count=0,
+                                  reevaluate_labels=True, max_per_label=None):
+    """ iterates the propagation of labels from init_label_vp until the labels 
+        do not change or after max_rounds rounds.
+        
+        Only vertices with a count larger than count_ratio times the smallest 
+        of the maximum counts of the vertices of each label are considered, 
+        the threshold is updated when labels change. 
+        
+        If reevaluate_labels is True, each round is a round of the manual loop
+        `propagateLabels` and `selectHashtags` with the labeled vertices as 
+        `htgs_lists`: every vertex, labeled or not, gets the label_val 
+        satisfying 2*signi_sum(label_val) > sum(signi_sum), where the sums are
+        over the labeled neighbors, or no label. Labeled vertices can thus be 
+        dropped or change label. If max_per_label is given, only the 
+        max_per_label vertices with the largest counts keep each label (as 
+        `num_top_htgs` in `selectHashtags`).
+        
+        If reevaluate_labels is False, labels are only added: at each round, 
+        the unlabeled vertices satisfying the rule receive label_val, and the 
+        sums are only updated for the neighbors of the added vertices.
+        
+        In both cases, only the vertices with a count larger than 
+        min_new_count and, if max_new_per_round is given, the 
+        max_new_per_round vertices with the largest counts of each label are
+        newly labeled at each round.
+        
+        Returns a dataframe similar to the one of `propagates_labels` with 
+        the sums of the final labels and the additional columns `label_final`
+        and `round` (last round where the label of the vertex changed, 0 for 
+        the initial labels, -1 for vertices without label), and a dataframe 
+        with the vertices whose label changed at each round (label -1 for 
+        dropped vertices).
+    """
+    if reevaluate_labels:
+        return _propagates_labels_reevaluated(Graph, init_label_vp=init_label_vp,
+                                              count_ratio=count_ratio, 
+                                              max_rounds=max_rounds,
+                                              max_new_per_round=max_new_per_round,
+                                              min_new_count=min_new_count,
+                                              max_per_label=max_per_label)
+    
+    labels = np.asarray(Graph.vp[init_label_vp]).copy()
+    counts = np.asarray(Graph.vp.counts)
+    rounds = np.where(labels > 0, 0, -1)
+    
+    labels_values = np.unique(labels[labels > 0])
+    
+    def count_threshold():
+        return count_ratio*min([counts[labels == label_val].max() 
+                                for label_val in labels_values])
+    
+    def active_adjacency(threshold):
+        # edges between vertices with enough counts
+        active = counts >= threshold
+        emask = active[Graph.edges[:,0]] & active[Graph.edges[:,1]]
+        return Graph.adjacency(emask.astype(np.float64)), \
+               Graph.adjacency(np.where(emask, Graph.ep.s, 0)), active
+    
+    added = []
+    threshold = None
+    for round_num in range(1, max_rounds + 1):
+        
+        new_threshold = count_threshold()
+        if new_threshold != threshold:
+            # refilter and recompute all the sums
+            threshold = new_threshold
+            A_label, A_signi, active = active_adjacency(threshold)
+            seed_matrix = sp.csr_matrix((np.ones((labels > 0).sum()), 
+                                         (np.nonzero(labels > 0)[0], 
+                                          np.searchsorted(labels_values, labels[labels > 0]))),
+                                        shape=(Graph.num_vertices(), labels_values.size))
+            label_sums = A_label.dot(seed_matrix).toarray()
+            signi_sums = A_signi.dot(seed_matrix).toarray()
+            candidates = np.arange(Graph.num_vertices())
+        
+        # unlabeled candidates satisfying the majority rule
+        candidates = candidates[(labels[candidates] <= 0) & active[candidates] & 
+                                (counts[candidates] >= min_new_count)]
+        sums = signi_sums[candidates]
+        winner = np.argmax(sums, axis=1)
+        majority = 2*sums[np.arange(candidates.size), winner] > sums.sum(axis=1)
+        
+        new_vertices = []
+        # candidates left out by max_new_per_round
+        pending = []
+        for j, label_val in enumerate(labels_values):
+            new = candidates[majority & (winner == j)]
+            new = new[np.argsort(-counts[new], kind='mergesort')]
+            if max_new_per_round is not None:
+                pending.append(new[max_new_per_round:])
+                new = new[:max_new_per_round]
+            
+            for v in new:
+                added.append({'round': round_num, 'label': label_val, 'vertex_id': v,
+                              'name': Graph.vp.names[v], 'count': counts[v],
+                              'signi_sum': signi_sums[v, j]})
+            new_vertices.append(new)
+        
+        num_new = sum(new.size for new in new_vertices)
+        print('round ' + str(round_num) + ': ' + str(num_new) + ' vertices added')
+        if num_new == 0:
+            break
+        
+        # update the sums of the neighbors of the new vertices
+        touched = []
+        for j, (label_val, new) in enumerate(zip(labels_values, new_vertices)):
+            labels[new] = label_val
+            rounds[new] = round_num
+            label_sums[:,j] += np.asarray(A_label[new].sum(axis=0)).ravel()
+            signi_sums[:,j] += np.asarray(A_signi[new].sum(axis=0)).ravel()
+            touched.append(A_label[new].indices)
+        candidates = np.unique(np.concatenate(touched + pending))
+    
+    df_propag = pd.DataFrame(columns=['name', 'count', init_label_vp, 'vertex_id'])
+    df_propag['name'] = Graph.vp.names
+    df_propag['count'] = counts
+    df_propag[init_label_vp] = Graph.vp[init_label_vp]
+    df_propag['vertex_id'] = np.arange(Graph.num_vertices())
+    for j, label_val in enumerate(labels_values):
+        df_propag['label_sum' + str(label_val)] = label_sums[:,j]
+        df_propag['signi_sum' + str(label_val)] = signi_sums[:,j]
+    df_propag['label_final'] = labels
+    df_propag['round'] = rounds
+    
+    df_rounds = pd.DataFrame(added, columns=['round', 'label', 'vertex_id', 'name', 
+                                             'count', 'signi_sum'])
+    
+    return df_propag, df_rounds
+    
+
+def _propagates_labels_reevaluated(Graph, init_label_vp='label_init', count_ratio=0.0,
+                                   max_rounds=10, max_new_per_round=None, min_new_count=0,
+                                   max_per_label=None):
+    """ `propagates_labels_iteratively` with reevaluate_labels=True, the sums 
+        are recomputed at each round
+    """
+    labels = np.asarray(Graph.vp[init_label_vp]).copy()
+    counts = np.asarray(Graph.vp.counts)
+    rounds = np.where(labels > 0, 0, -1)
+    
+    labels_values = np.unique(labels[labels > 0])
+    
+    def label_sums_of(labels):
+        # sums over the labeled neighbors, only between vertices with enough counts
+        threshold = count_ratio*min([counts[labels == label_val].max() 
+                                     for label_val in labels_values])
+        active = counts >= threshold
+        emask = active[Graph.edges[:,0]] & active[Graph.edges[:,1]]
+        
+        seeds = np.nonzero((labels > 0) & active)[0]
+        seed_matrix = sp.csr_matrix((np.ones(seeds.size), 
+                                     (seeds, np.searchsorted(labels_values, labels[seeds]))),
+                                    shape=(Graph.num_vertices(), labels_values.size))
+        
+        label_sums = Graph.adjacency(emask.astype(np.float64)).dot(seed_matrix).toarray()
+        signi_sums = Graph.adjacency(np.where(emask, Graph.ep.s, 0)).dot(seed_matrix).toarray()
+        
+        return label_sums, signi_sums, active
+    
+    changes = []
+    for round_num in range(1, max_rounds + 1):
+        
+        label_sums, signi_sums, active = label_sums_of(labels)
+        
+        winner = np.argmax(signi_sums, axis=1)
+        majority = active & (2*signi_sums[np.arange(labels.size), winner] > signi_sums.sum(axis=1))
+        
+        new_labels = np.full(labels.size, -1, dtype=labels.dtype)
+        for j, label_val in enumerate(labels_values):
+            selected = np.nonzero(majority & (winner == j))[0]
+            
+            # limits on the vertices newly labeled
+            new = selected[labels[selected] != label_val]
+            new = new[counts[new] >= min_new_count]
+            if max_new_per_round is not None:
+                new = new[np.argsort(-counts[new], kind='mergesort')[:max_new_per_round]]
+            selected = np.concatenate((selected[labels[selected] == label_val], new))
+            
+            if max_per_label is not None:
+                selected = selected[np.argsort(-counts[selected], kind='mergesort')[:max_per_label]]
+                
+            new_labels[selected] = label_val
+        
+        changed = np.nonzero(new_labels != labels)[0]
+        print('round ' + str(round_num) + ': ' + str(changed.size) + ' vertices changed label')
+        if changed.size == 0:
+            break
+        
+        for v in changed:
+            j = np.searchsorted(labels_values, new_labels[v])
+            changes.append({'round': round_num, 'label': new_labels[v], 'vertex_id': v,
+                            'name': Graph.vp.names[v], 'count': counts[v],
+                            'signi_sum': signi_sums[v, j] if new_labels[v] > 0 else np.nan})
+            
+        labels = new_labels
+        rounds[changed] = np.where(labels[changed] > 0, round_num, -1)
+        
+        if not all((labels == label_val).any() for label_val in labels_values):
+            print('a label has no vertex left, stopping')
+            break
+        
+    if all((labels == label_val).any() for label_val in labels_values):
+        label_sums, signi_sums, _ = label_sums_of(labels)
+    
+    df_propag = pd.DataFrame(columns=['name', 'count', init_label_vp, 'vertex_id'])
+    df_propag['name'] = Graph.vp.names
+    df_propag['count'] = counts
+    df_propag[init_label_vp] = Graph.vp[init_label_vp]
+    df_propag['vertex_id'] = np.arange(Graph.num_vertices())
+    for j, label_val in enumerate(labels_values):
+        df_propag['label_sum' + str(label_val)] = label_sums[:,j]
+        df_propag['signi_sum' + str(label_val)] = signi_sums[:,j]
+    df_propag['label_final'] = labels
+    df_propag['round'] = rounds
+    
+    df_rounds = pd.DataFrame(changes, columns=['round', 'label', 'vertex_id', 'name', 
+                                               'count', 'signi_sum'])
+    
+    return df_propag, df_rounds
+    
+
+def propagation_sweep(Graph, p0_values, count_ratio_values, init_label_vp='label_init'):
+    """ computes the label propagation of `propagates_labels` for a grid of 
+        p0 and count_ratio values (see `propagateLabels`) in a single pass.
+        
+        Since the filters are thresholds on the significance of the edges and 
+        the counts of the vertices, the edges incident to the initial labels 
+        are binned once by significance and smallest count of their vertices,
+        and the sums of each grid point are cumulative sums over the bins.
+        
+        Returns a dataframe with a row for each grid point and vertex having
+        labeled neighbors and the columns p0, count_ratio, name, count, 
+        init_label_vp, vertex_id (index in Graph), label_sum(label_val), 
+        signi_sum(label_val) and camp (label_val satisfying 
+        2*signi_sum(label_val) > sum(signi_sum), -1 otherwise).
+    """
+    labels = np.asarray(Graph.vp[init_label_vp])
+    counts = np.asarray(Graph.vp.counts)
+    labels_values = np.unique(labels[labels > 0])
+    num_labels = labels_values.size
+    
+    # thresholds in increasing order
+    p0_values = np.sort(np.asarray(p0_values, dtype=np.float64))[::-1]
+    s0_values = np.log10(Graph.gp.p0/p0_values)
+    count_ratio_values = np.sort(np.asarray(count_ratio_values, dtype=np.float64))
+    min_counts = count_ratio_values*min([counts[labels == label_val].max() 
+                                         for label_val in labels_values])
+    
+    # edges incident to labeled vertices, in both directions
+    sources = np.concatenate((Graph.edges[:,0], Graph.edges[:,1]))
+    targets = np.concatenate((Graph.edges[:,1], Graph.edges[:,0]))
+    s = np.concatenate((Graph.ep.s, Graph.ep.s))
+    from_seed = labels[sources] > 0
+    sources, targets, s = sources[from_seed], targets[from_seed], s[from_seed]
+    
+    # an edge is kept for thresholds smaller than its significance and the 
+    # smallest count of its vertices
+    s_bins = np.searchsorted(s0_values, s, side='right')
+    count_bins = np.searchsorted(min_counts, np.minimum(counts[sources], counts[targets]),
+                                 side='right')
+    
+    # histograms for each (target, label)
+    keys, key_index = np.unique(targets*num_labels + np.searchsorted(labels_values, 
+                                                                     labels[sources]),
+                                return_inverse=True)
+    key_index = key_index.ravel()
+    shape = (keys.size, s0_values.size + 1, min_counts.size + 1)
+    flat_index = np.ravel_multi_index((key_index, s_bins, count_bins), shape)
+    num_links = np.bincount(flat_index, minlength=np.prod(shape)).reshape(shape)
+    sum_s = np.bincount(flat_index, weights=s, minlength=np.prod(shape)).reshape(shape)
+    
+    # cumulative sums from the largest bins
+    def reverse_cumsum(a):
+        return a[:,::-1,::-1].cumsum(axis=1).cumsum(axis=2)[:,::-1,::-1][:,1:,1:]
+    
+    num_links = reverse_cumsum(num_links)
+    signi = reverse_cumsum(sum_s) - num_links*s0_values[None,:,None]
+    
+    # arrays of shape (vertices, labels, p0 values, count ratios)
+    vertices, vertex_index = np.unique(keys//num_labels, return_inverse=True)
+    vertex_index = vertex_index.ravel()
+    label_sums = np.zeros((vertices.size, num_labels) + num_links.shape[1:])
+    signi_sums = np.zeros(label_sums.shape)
+    label_sums[vertex_index, keys % num_labels] = num_links
+    signi_sums[vertex_index, keys % num_labels] = signi
+    
+    # rows of vertices with labeled neighbors for each grid point
+    vertex_rows, p0_rows, count_ratio_rows = np.nonzero(label_sums.sum(axis=1) > 0)
+    
+    df_sweep = pd.DataFrame({'p0': p0_values[p0_rows], 
+                             'count_ratio': count_ratio_values[count_ratio_rows]})
+    v = vertices[vertex_rows]
+    df_sweep['name'] = Graph.vp.names[v]
+    df_sweep['count'] = counts[v]
+    df_sweep[init_label_vp] = labels[v]
+    df_sweep['vertex_id'] = v
+    for j, label_val in enumerate(labels_values):
+        df_sweep['label_sum' + str(label_val)] = label_sums[vertex_rows, j, p0_rows, count_ratio_rows]
+        df_sweep['signi_sum' + str(label_val)] = signi_sums[vertex_rows, j, p0_rows, count_ratio_rows]
+        
+    signi_rows = signi_sums[vertex_rows, :, p0_rows, count_ratio_rows]
+    winner = np.argmax(signi_rows, axis=1)
+    majority = 2*signi_rows[np.arange(winner.size), winner] > signi_rows.sum(axis=1)
+    df_sweep['camp'] = np.where(majority, labels_values[winner], -1)
+    
+    return df_sweep
+    
+
+def significant_subgraph(Graph, s0=0.0, min_count=0):
+    """ returns the subgraph with the vertices having counts >= min_count and 
+        the edges having a significance s >= s0. The significance of the 
+        subgraph is shifted by s0, Graph is not modified.
+    """
+    vmask = Graph.vp.counts >= min_count
+    emask = Graph.ep.s >= s0
+    
+    G_filt = Graph.subgraph(vmask=vmask, emask=emask)
+    G_filt.ep['s'] = G_filt.ep.s - s0
+    
+    return G_filt
+    
+
 def find_vertices_from_hashtags(Graph, ht_list):
-    """ return Graph vertices corresponding to a hashtag name
+    """ return the indices of the Graph vertices corresponding to the 
+        hashtag names in ht_list
+    """
+    
+    index = Graph.vertex_index(ht_list)
+    
+    return np.unique(index[index >= 0])
+
+
+#==============================================================================
+# Hashtag graph
+#==============================================================================
+
+class _PropertyDict(dict):
+    """ dictionary of properties with attribute access (`G.vp.counts`) """
+    
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+            
+    def __setattr__(self, name, value):
+        self[name] = value
+        
+
+class HTGraph(object):
+    """ Undirected hashtag co-occurrence graph stored as numpy arrays.
+    
+        `edges` is an array of shape (num_edges, 2) with the indices of the 
+        two vertices of each edge. Vertex, edge and graph properties are
+        stored in the dictionaries `vp`, `ep` and `gp` and can be accessed as
+        attributes, as with graph-tool (e.g. `G.vp.counts`). Vertex and edge 
+        properties are numpy arrays indexed by vertex and edge indices.
+        
+        Neighbors are found with a CSR representation of the adjacency that
+        is built on first use. Vertices are found from their names with the 
+        permutation sorting the vertex property `names`, which is built on 
+        first use and saved with the graph.
     """
     
-    name_array = Graph.vp.names.get_2d_array([0])
+    def __init__(self, edges, num_vertices, vp=None, ep=None, gp=None, name_sorter=None):
+        
+        self.edges = np.asarray(edges).reshape(-1,2)
+        self._num_vertices = int(num_vertices)
+        
+        self.vp = _PropertyDict(vp or dict())
+        self.ep = _PropertyDict(ep or dict())
+        self.gp = _PropertyDict(gp or dict())
+        
+        self._csr = None
+        self._name_sorter = name_sorter
+        
+    @classmethod
+    def from_edge_list(cls, edge_names, weights=None):
+        """ creates a graph from an array of shape (num_edges, 2) with the
+            names of the vertices of each edge.
+            
+            Vertices are indexed in the order of their sorted names and
+            their names are saved in the vertex property `names`.
+        """
+        names, edges = np.unique(np.asarray(edge_names, dtype=str), return_inverse=True)
+        
+        G = cls(edges.reshape(-1,2), names.size, vp={'names': names})
+        
+        if weights is not None:
+            G.ep['weights'] = np.asarray(weights)
+            
+        return G
+        
+    def num_vertices(self):
+        return self._num_vertices
+    
+    def num_edges(self):
+        return self.edges.shape[0]
+    
+    def _build_csr(self):
+        """ builds the CSR arrays (indptr, neighbors, edge indices) of the
+            adjacency
+        """
+        num_edges = self.num_edges()
+        
+        sources = np.concatenate((self.edges[:,0], self.edges[:,1]))
+        targets = np.concatenate((self.edges[:,1], self.edges[:,0]))
+        edge_ids = np.concatenate((np.arange(num_edges), np.arange(num_edges)))
+        
+        # self-loops appear only once in the adjacency
+        keep = np.concatenate((np.ones(num_edges, dtype=bool), 
+                               self.edges[:,0] != self.edges[:,1]))
+        sources = sources[keep]
+        
+        order = np.argsort(sources, kind='mergesort')
+        
+        indptr = np.zeros(self._num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=self._num_vertices), out=indptr[1:])
+        
+        self._csr = (indptr, targets[keep][order], edge_ids[keep][order])
+        
+    @property
+    def csr(self):
+        if self._csr is None:
+            self._build_csr()
+        return self._csr
+        
+    @property
+    def name_sorter(self):
+        """ indices of the vertices sorting their names """
+        if self._name_sorter is None:
+            self._name_sorter = np.argsort(self.vp.names, kind='mergesort')
+        return self._name_sorter
+        
+    def vertex_index(self, names):
+        """ returns the indices of the vertices with the given names, -1 for
+            names not in the graph
+        """
+        names = np.asarray(names, dtype=str).ravel()
+        
+        if self._num_vertices == 0:
+            return np.full(names.size, -1, dtype=np.int64)
+        
+        sorter = self.name_sorter
+        pos = np.minimum(np.searchsorted(self.vp.names, names, sorter=sorter), 
+                         self._num_vertices - 1)
+        
+        return np.where(self.vp.names[sorter[pos]] == names, sorter[pos], -1)
+        
+    def neighbors(self, v):
+        """ returns the indices of the neighbors of vertex v """
+        indptr, neighbors, _ = self.csr
+        return neighbors[indptr[v]:indptr[v+1]]
+    
+    def out_edges(self, v):
+        """ returns the indices of the edges of vertex v """
+        indptr, _, edge_ids = self.csr
+        return edge_ids[indptr[v]:indptr[v+1]]
+        
+    def degrees(self):
+        indptr, _, _ = self.csr
+        return np.diff(indptr)
+    
+    def adjacency(self, weights=None):
+        """ returns the adjacency matrix as a scipy CSR matrix.
+        
+            weights is an edge property array, the matrix entries are 1 by 
+            default.
+        """
+        indptr, neighbors, edge_ids = self.csr
+        if weights is None:
+            data = np.ones(neighbors.size)
+        else:
+            data = np.asarray(weights, dtype=np.float64)[edge_ids]
+            
+        return sp.csr_matrix((data, neighbors, indptr),
+                             shape=(self._num_vertices, self._num_vertices))
+    
+    def shallow_copy(self):
+        """ returns a graph sharing the arrays of this graph, with its own
+            property dictionaries (properties can be added or replaced without
+            modifying this graph)
+        """
+        G = HTGraph(self.edges, self._num_vertices, vp=dict(self.vp), ep=dict(self.ep),
+                    gp=dict(self.gp), name_sorter=self._name_sorter)
+        G._csr = self._csr
+        
+        return G
+        
+    def subgraph(self, vmask=None, emask=None):
+        """ returns a new graph with only the vertices in the boolean mask vmask
+            and the edges in the boolean mask emask. 
+            
+            Edges with a vertex not in vmask are removed. Vertices are 
+            reindexed and properties copied (like 
+            `Graph(GraphView(G, vfilt, efilt), prune=True)` in graph-tool).
+        """
+        if vmask is None:
+            vmask = np.ones(self._num_vertices, dtype=bool)
+        if emask is None:
+            emask = np.ones(self.num_edges(), dtype=bool)
+        
+        emask = emask & vmask[self.edges[:,0]] & vmask[self.edges[:,1]]
+        
+        new_index = np.cumsum(vmask) - 1
+        
+        # the order of the names of the remaining vertices is unchanged
+        if self._name_sorter is not None:
+            name_sorter = new_index[self._name_sorter[vmask[self._name_sorter]]]
+        else:
+            name_sorter = None
+        
+        return HTGraph(new_index[self.edges[emask]], vmask.sum(),
+                       vp={name: prop[vmask] for name, prop in self.vp.items()},
+                       ep={name: prop[emask] for name, prop in self.ep.items()},
+                       gp=dict(self.gp), name_sorter=name_sorter)
+                       
+    def save(self, filename):
+        """ saves the graph in an uncompressed numpy archive """
+        
+        arrays = {'num_vertices': np.array(self._num_vertices),
+                  'edges': self.edges}
+        
+        for name, prop in self.vp.items():
+            arrays['vp_' + name] = prop
+        for name, prop in self.ep.items():
+            arrays['ep_' + name] = prop
+            
+        arrays['gp_json'] = np.array(json.dumps(self.gp, default=str))
+        
+        if 'names' in self.vp:
+            arrays['name_sorter'] = self.name_sorter
+        
+        # write to a temporary file first since the arrays might be 
+        # memory-mapped from filename
+        tmp_filename = filename + '.tmp'
+        
+        # uncompressed so that arrays can be memory-mapped when loading
+        with open(tmp_filename, 'wb') as fopen:
+            np.savez(fopen, **arrays)
+            
+        os.replace(tmp_filename, filename)
+            
+    @classmethod
+    def load(cls, filename):
+        """ loads a graph saved with `save`, arrays are memory-mapped """
+        
+        arrays = _npz_memmap(filename)
+        
+        return cls(arrays['edges'], int(arrays['num_vertices']),
+                   vp={key[3:]: val for key, val in arrays.items() if key.startswith('vp_')},
+                   ep={key[3:]: val for key, val in arrays.items() if key.startswith('ep_')},
+                   gp=json.loads(str(arrays['gp_json'])),
+                   name_sorter=arrays.get('name_sorter', None))
+        
+    @classmethod
+    def from_graph_tool(cls, Gt):
+        """ converts a graph-tool graph """
+        
+        # edges with their edge index, so that edge properties are aligned
+        edges = Gt.get_edges([Gt.edge_index])
+        order = edges[:,2]
+        
+        vp = dict()
+        for name, prop in Gt.vp.items():
+            if prop.value_type() == 'string':
+                vp[name] = np.array(prop.get_2d_array([0])[0], dtype=str)
+            else:
+                vp[name] = prop.a.copy()
+        
+        return cls(edges[:,:2].astype(np.int64), Gt.num_vertices(), vp=vp,
+                   ep={name: prop.a[order] for name, prop in Gt.ep.items()},
+                   gp={name: Gt.gp[name] for name in Gt.gp.keys()})
+        
+    def to_graph_tool(self):
+        """ converts to a graph-tool graph """
+        
+        if gt is None:
+            raise ImportError("graph-tool is required to convert the graph to graph-tool.")
+            
+        Gt = gt.Graph(directed=False)
+        Gt.add_vertex(self._num_vertices)
+        Gt.add_edge_list(self.edges)
+        
+        value_types = {'i': 'int64_t', 'u': 'int64_t', 'f': 'double', 'b': 'bool'}
+        
+        for name, values in self.vp.items():
+            if values.dtype.kind == 'U':
+                prop = Gt.new_vertex_property('string')
+                for v, val in zip(Gt.vertices(), values.tolist()):
+                    prop[v] = val
+            else:
+                prop = Gt.new_vertex_property(value_types[values.dtype.kind])
+                prop.a = values
+            Gt.vp[name] = prop
+            
+        for name, values in self.ep.items():
+            prop = Gt.new_edge_property(value_types[values.dtype.kind])
+            prop.a = values
+            Gt.ep[name] = prop
+            
+        for name, val in self.gp.items():
+            if isinstance(val, bool):
+                Gt.graph_properties[name] = Gt.new_graph_property('bool')
+            elif isinstance(val, int):
+                Gt.graph_properties[name] = Gt.new_graph_property('int64_t')
+            elif isinstance(val, float):
+                Gt.graph_properties[name] = Gt.new_graph_property('double')
+            else:
+                Gt.graph_properties[name] = Gt.new_graph_property('object')
+            Gt.graph_properties[name] = val
+            
+        return Gt
+        
+
+#==============================================================================
+# Graph persistence
+#==============================================================================
+# The graph artifact is stored either as an uncompressed numpy archive (`.npz`)
+# holding the edge array, the vertex and edge properties (`vp_<name>`, 
+# `ep_<name>`) and the graph properties serialized as JSON, or in graph-tool's
+# native binary format (`.gt`). GraphML is only available as an explicit 
+# export with `export_graphml`. graph-tool is only required for the `.gt` 
+# and GraphML formats.
 
-    indices = np.where(np.in1d(name_array, ht_list))[0]
+def _graph_format(filename):
+    """ returns the graph format corresponding to the extension of filename """
     
-    vertices = [Graph.vertex(i) for i in indices]
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.gz':
+        ext = os.path.splitext(filename[:-3])[1].lower()
     
-    return vertices    
+    return ext.lstrip('.')
+    
+
+def _require_graph_tool(fmt):
+    if gt is None:
+        raise ImportError("graph-tool is required for the " + fmt + " format, use `.npz` instead.")
+        
+
+def _npz_memmap(filename):
+    """ returns a dictionary with the arrays of the numpy archive filename.
+    
+        Arrays stored uncompressed (default of `np.savez`) are memory-mapped,
+        the others are read in memory.
+    """
+    arrays = dict()
+    with zipfile.ZipFile(filename) as zf, open(filename, 'rb') as fopen:
+        for info in zf.infolist():
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            
+            if info.compress_type == zipfile.ZIP_STORED:
+                # skip the local file header to find the start of the .npy data
+                fopen.seek(info.header_offset)
+                header = fopen.read(30)
+                name_len = int.from_bytes(header[26:28], 'little')
+                extra_len = int.from_bytes(header[28:30], 'little')
+                fopen.seek(info.header_offset + 30 + name_len + extra_len)
+                
+                version = np.lib.format.read_magic(fopen)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fopen)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fopen)
+                
+                if len(shape) > 0 and np.prod(shape) > 0 and not dtype.hasobject:
+                    arrays[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                             shape=shape, offset=fopen.tell(),
+                                             order='F' if fortran_order else 'C')
+                    continue
+            
+            with zf.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                
+    return arrays
+    
+
+def save_graph(G, filename):
+    """ saves the hashtag graph G to filename in a binary format.
+    
+        The format is chosen from the extension of filename: `.npz` for a
+        numpy archive or `.gt` for graph-tool's native binary format.
+        Use `export_graphml` to save in GraphML format.
+    """
+    fmt = _graph_format(filename)
+    
+    if fmt == 'npz':
+        G.save(filename)
+    elif fmt == 'gt':
+        _require_graph_tool(fmt)
+        G.to_graph_tool().save(filename, fmt='gt')
+    elif fmt in ['graphml', 'xml']:
+        raise ValueError("GraphML is only available as an explicit export, use `export_graphml`.")
+    else:
+        raise ValueError("Unknown graph format for " + str(filename) + ", use `.npz` or `.gt`.")
+        
+
+def load_graph(filename):
+    """ loads the hashtag graph saved with `save_graph`.
+    
+        GraphML files are still read to convert graphs saved by older
+        versions of the pipeline.
+    """
+    fmt = _graph_format(filename)
+    
+    if fmt == 'npz':
+        return HTGraph.load(filename)
+    elif fmt == 'gt':
+        _require_graph_tool(fmt)
+        return HTGraph.from_graph_tool(gt.load_graph(filename, fmt='gt'))
+    elif fmt in ['graphml', 'xml']:
+        _require_graph_tool(fmt)
+        print('loading graphml file, consider converting it to `.npz` with `save_graph`.')
+        return HTGraph.from_graph_tool(gt.load_graph(filename, fmt='graphml'))
+    else:
+        raise ValueError("Unknown graph format for " + str(filename) + ", use `.npz` or `.gt`.")
+        
+
+def export_graphml(G, filename):
+    """ exports the hashtag graph G in GraphML format (e.g. for visualization
+        in other softwares).
+    """
+    _require_graph_tool('graphml')
+    G.to_graph_tool().save(filename, fmt='graphml')
@@ -0,0 +1,430 @@
+# Author: Alexandre Bovet <alexandre.bovet@gmail.com>
+# License: BSD 3 clause
+
+"""
+Compressed bitmaps of sets of tweets.
+
+Tweets are identified by their row number in the sorted array of the
+tweet_id of the database. A `Bitmap` is a chunked bitset: the rows are split
+in chunks of 2**16 rows and only the chunks with at least one row are
+stored, as 1024 uint64 words, so that union, intersection and difference
+are vectorized operations over the common chunks.
+
+`getTweetBitmaps` builds (once) and persists next to the database the bitmaps
+of the retweets, of the tweets sent from official clients, of the tweets of
+each day and of each camp of a labeling of hashtags:
+
+    tb = getTweetBitmaps(conn, 'tweets_bitmaps.npz', labeling='ht_class')
+    sel = (tb.camp('ht_class', 'pro_0') - tb.camp('ht_class', 'pro_1') \
+           - tb['retweet']) & tb['official_client']
+    tweet_ids = tb.tweet_ids_of(sel)
+"""
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+
+from TwSentiment import official_twitter_clients
+from TwSqliteDB import updateTweetCampTable, getTweetsStamp
+
+CHUNK_BITS = 16
+WORDS_PER_CHUNK = 2**CHUNK_BITS//64
+
+# number of bits set in each byte value
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+class Bitmap(object):
+    """ Chunked bitset of non-negative integers (see module docstring).
+
+        Bitmaps are immutable, the operators &, | and - return new bitmaps.
+    """
+
+    def __init__(self, keys=None, words=None):
+
+        if keys is None:
+            keys = np.zeros(0, dtype=np.int64)
+            words = np.zeros((0, WORDS_PER_CHUNK), dtype='<u8')
+
+        # sorted indices of the stored chunks and their words
+        self.keys = np.asarray(keys, dtype=np.int64)
+        self.words = np.asarray(words, dtype='<u8')
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ returns the bitmap of the integers in rows """
+
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if rows.size == 0:
+            return cls()
+
+        if rows[0] < 0:
+            raise ValueError('rows must be non-negative')
+
+        chunks = rows >> CHUNK_BITS
+        keys, chunk_pos = np.unique(chunks, return_inverse=True)
+
+        bits = rows & (2**CHUNK_BITS - 1)
+        word_index = chunk_pos.astype(np.int64)*WORDS_PER_CHUNK + (bits >> 6)
+
+        # the bits of rows are distinct so their sum in each word is their OR
+        values = np.left_shift(np.uint64(1), (bits & 63).astype(np.uint64))
+        starts = np.flatnonzero(np.concatenate(([True], word_index[1:] != word_index[:-1])))
+
+        words = np.zeros(keys.size*WORDS_PER_CHUNK, dtype='<u8')
+        words[word_index[starts]] = np.add.reduceat(values, starts)
+
+        return cls(keys, words.reshape(keys.size, WORDS_PER_CHUNK))
+
+    @classmethod
+    def union_all(cls, bitmaps):
+        """ returns the union of bitmaps in one pass (the bitmaps of 
+            consecutive ranges of rows only share their boundary chunks)
+        """
+        bitmaps = list(bitmaps)
+        if len(bitmaps) == 0:
+            return cls()
+
+        keys = np.concatenate([bm.keys for bm in bitmaps])
+        words = np.concatenate([bm.words for bm in bitmaps])
+        if keys.size == 0:
+            return cls()
+
+        order = np.argsort(keys, kind='mergesort')
+        keys, starts = np.unique(keys[order], return_index=True)
+
+        return cls(keys, np.bitwise_or.reduceat(words[order], starts, axis=0))
+
+    def rows(self):
+        """ returns the sorted array of the integers in the bitmap """
+
+        # unpackbits starts with the most significant bit of each byte
+        bits = np.unpackbits(self.words.view(np.uint8)).reshape(-1, 8)[:, ::-1]
+        positions = np.flatnonzero(bits.ravel())
+
+        return (self.keys[positions >> CHUNK_BITS] << CHUNK_BITS) | \
+               (positions & (2**CHUNK_BITS - 1))
+
+    def iter_rows(self, batch_chunks=16):
+        """ yields the sorted arrays of the integers in batches of batch_chunks
+            chunks (at most batch_chunks*2**16 integers per batch)
+        """
+        for start in range(0, self.keys.size, batch_chunks):
+            yield Bitmap(self.keys[start:start+batch_chunks],
+                         self.words[start:start+batch_chunks]).rows()
+
+    def __len__(self):
+        return int(_POPCOUNT8[self.words.view(np.uint8)].sum())
+
+    def contains(self, rows):
+        """ returns a boolean array, True where rows are in the bitmap """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.keys.size == 0:
+            return np.zeros(rows.shape, dtype=bool)
+
+        chunks = rows >> CHUNK_BITS
+        pos = np.minimum(np.searchsorted(self.keys, chunks), self.keys.size - 1)
+        found = np.logical_and(self.keys[pos] == chunks, rows >= 0)
+
+        bits = rows & (2**CHUNK_BITS - 1)
+        words = self.words[pos, bits >> 6]
+        is_set = np.right_shift(words, (bits & 63).astype(np.uint64)) & np.uint64(1)
+
+        return np.logical_and(found, is_set.astype(bool))
+
+    def _common_chunks(self, other):
+        """ returns the positions of the common chunks in self and other """
+
+        if other.keys.size == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(other.keys, self.keys), other.keys.size - 1)
+        common = other.keys[pos] == self.keys
+
+        return np.flatnonzero(common), pos[common]
+
+    @classmethod
+    def _nonempty(cls, keys, words):
+        mask = words.any(axis=1)
+        return cls(keys[mask], words[mask])
+
+    def __and__(self, other):
+        ia, ib = self._common_chunks(other)
+
+        return self._nonempty(self.keys[ia], self.words[ia] & other.words[ib])
+
+    def __or__(self, other):
+        keys = np.union1d(self.keys, other.keys)
+
+        words = np.zeros((keys.size, WORDS_PER_CHUNK), dtype='<u8')
+        words[np.searchsorted(keys, self.keys)] = self.words
+        words[np.searchsorted(keys, other.keys)] |= other.words
+
+        return Bitmap(keys, words)
+
+    def __sub__(self, other):
+        ia, ib = self._common_chunks(other)
+
+        words = self.words.copy()
+        words[ia] &= ~other.words[ib]
+
+        return self._nonempty(self.keys, words)
+
+    def __repr__(self):
+        return 'Bitmap(' + str(len(self)) + ' rows in ' + str(self.keys.size) + ' chunks)'
+
+
+class TweetBitmaps(object):
+    """ Named bitmaps over the row numbers of the tweets (see module docstring).
+
+        Bitmap names are 'retweet', 'official_client', 'day:YYYY-MM-DD' and
+        'camp:<labeling>:<label>'. `stamps` records the state of the database
+        when the bitmaps were computed.
+    """
+
+    def __init__(self, tweet_ids, bitmaps=None, stamps=None):
+
+        # the row number of a tweet is its position in tweet_ids
+        self.tweet_ids = np.asarray(tweet_ids, dtype=np.int64)
+        self.bitmaps = dict() if bitmaps is None else bitmaps
+        self.stamps = dict() if stamps is None else stamps
+
+    def __getitem__(self, name):
+        return self.bitmaps[name]
+
+    def __contains__(self, name):
+        return name in self.bitmaps
+
+    def camp(self, labeling, label):
+        """ bitmap of the tweets having a hashtag with label """
+        return self.bitmaps.get('camp:' + labeling + ':' + str(label), Bitmap())
+
+    def days(self):
+        """ returns the sorted list of days (as 'YYYY-MM-DD' strings) """
+        return sorted(name[4:] for name in self.bitmaps if name.startswith('day:'))
+
+    def rows_of(self, tweet_ids):
+        """ returns the row numbers of tweet_ids, -1 for unknown tweet_ids """
+
+        tweet_ids = np.asarray(tweet_ids, dtype=np.int64)
+        if self.tweet_ids.size == 0:
+            return np.full(tweet_ids.shape, -1, dtype=np.int64)
+
+        pos = np.minimum(np.searchsorted(self.tweet_ids, tweet_ids), self.tweet_ids.size - 1)
+
+        return np.where(self.tweet_ids[pos] == tweet_ids, pos, -1)
+
+    def bitmap_of(self, tweet_ids):
+        """ returns the bitmap of tweet_ids (unknown tweet_ids are ignored) """
+
+        rows = self.rows_of(tweet_ids)
+
+        return Bitmap.from_rows(rows[rows >= 0])
+
+    def tweet_ids_of(self, bitmap):
+        """ returns the sorted tweet_ids of bitmap """
+        return self.tweet_ids[bitmap.rows()]
+
+    def iter_tweet_ids(self, bitmap, batch_chunks=16):
+        """ yields the sorted tweet_ids of bitmap by batches (see `Bitmap.iter_rows`) """
+        for rows in bitmap.iter_rows(batch_chunks):
+            yield self.tweet_ids[rows]
+
+    def with_bitmaps(self, bitmaps, stamps, drop_prefix=None):
+        """ returns new TweetBitmaps with bitmaps and stamps added, after
+            removing the bitmaps with a name starting with drop_prefix
+        """
+        new_bitmaps = {name: bm for name, bm in self.bitmaps.items() if \
+                       drop_prefix is None or not name.startswith(drop_prefix)}
+        new_bitmaps.update(bitmaps)
+
+        new_stamps = self.stamps.copy()
+        new_stamps.update(stamps)
+
+        return TweetBitmaps(self.tweet_ids, new_bitmaps, new_stamps)
+
+    def __repr__(self):
+        return 'TweetBitmaps(' + str(self.tweet_ids.size) + ' tweets, ' + \
+                str(len(self.bitmaps)) + ' bitmaps)'
+
+
+def tweetBitmapsFilename(sqlite_file):
+    """ default filename of the bitmaps of the database sqlite_file """
+    return os.path.splitext(sqlite_file)[0] + '_bitmaps.npz'
+
+
+def saveTweetBitmaps(tweet_bitmaps, filename):
+    """ saves tweet_bitmaps in numpy's npz format """
+
+    names = sorted(tweet_bitmaps.bitmaps.keys())
+
+    arrays = {'tweet_ids': tweet_bitmaps.tweet_ids,
+              'names': np.array(json.dumps(names)),
+              'stamps': np.array(json.dumps(tweet_bitmaps.stamps))}
+    for i, name in enumerate(names):
+        arrays['keys_' + str(i)] = tweet_bitmaps.bitmaps[name].keys
+        arrays['words_' + str(i)] = tweet_bitmaps.bitmaps[name].words
+
+    # writing to a file object prevents numpy from appending .npz
+    with open(filename, 'wb') as fopen:
+        np.savez(fopen, **arrays)
+
+
+def loadTweetBitmaps(filename):
+    """ loads TweetBitmaps saved with `saveTweetBitmaps` """
+
+    with np.load(filename) as arrays:
+        names = json.loads(str(arrays['names']))
+        bitmaps = {name: Bitmap(arrays['keys_' + str(i)], arrays['words_' + str(i)]) \
+                   for i, name in enumerate(names)}
+
+        return TweetBitmaps(arrays['tweet_ids'], bitmaps,
+                            json.loads(str(arrays['stamps'])))
+
+
+def _labeling_stamp(cursor, labeling, tweets_stamp):
+    """ changes when the hashtags of labeling change or when tweets are added
+        (tweets_stamp, the camps are then recomputed from tweet_camp after
+        `updateTweetCampTable` updated it)
+    """
+
+    cursor.execute("""SELECT label, hashtag FROM hashtag_label WHERE labeling = ?
+                      ORDER BY label, hashtag""", (labeling,))
+
+    md5 = hashlib.md5()
+    for label, hashtag in cursor.fetchall():
+        md5.update((str(label) + '\t' + hashtag + '\n').encode('utf-8'))
+
+    md5.update(tweets_stamp.encode('utf-8'))
+
+    return md5.hexdigest()
+
+
+def _split_rows(rows, groups):
+    """ returns a dictionary with the rows of each value of groups """
+
+    order = np.argsort(groups, kind='mergesort')
+    values, starts = np.unique(groups[order], return_index=True)
+
+    return {value: rows[idx] for value, idx in zip(values, np.split(order, starts[1:]))}
+
+
+def buildTweetBitmaps(db_connection, chunksize=1000000):
+    """ computes the bitmaps of the retweets, of the tweets from official
+        clients and of the tweets of each day.
+
+        The tweets and retweets are read by chunks of chunksize rows, ordered
+        by tweet_id, and only the tweet_ids and the bitmaps are kept in memory.
+    """
+    t0 = time.time()
+    print('computing tweet bitmaps')
+
+    sql_query = """SELECT tweet_id, substr(datetime_EST, 1, 10) AS day,
+                          IFNULL(source_content_id IN (SELECT id FROM source_content
+                                                       WHERE source_content IN ({seq})), 0)
+                          AS official_client
+                   FROM tweet ORDER BY tweet_id
+                """.format(seq=','.join(['?']*len(official_twitter_clients)))
+
+    # the rows of each chunk follow the rows of the previous chunks, the
+    # bitmaps of the chunks are merged at the end
+    tweet_ids = []
+    official = []
+    days = dict()
+    num_rows = 0
+    for df in pd.read_sql(sql_query, db_connection, params=official_twitter_clients,
+                          chunksize=chunksize):
+        tweet_ids.append(df.tweet_id.values.astype(np.int64))
+        rows = np.arange(num_rows, num_rows + df.index.size)
+        num_rows += df.index.size
+
+        official.append(Bitmap.from_rows(rows[df.official_client.values.astype(bool)]))
+
+        for day, day_rows in _split_rows(rows, df.day.values.astype(str)).items():
+            days.setdefault(day, []).append(Bitmap.from_rows(day_rows))
+
+    tweet_ids = np.concatenate(tweet_ids) if len(tweet_ids) > 0 else np.zeros(0, dtype=np.int64)
+
+    tweet_bitmaps = TweetBitmaps(tweet_ids)
+
+    tweet_bitmaps.bitmaps['official_client'] = Bitmap.union_all(official)
+
+    for day, day_bitmaps in days.items():
+        tweet_bitmaps.bitmaps['day:' + day] = Bitmap.union_all(day_bitmaps)
+
+    # uses the index on tweet_id so that the retweets are also read in order
+    c = db_connection.cursor()
+    c.execute("SELECT tweet_id FROM tweet_to_retweeted_uid ORDER BY tweet_id")
+    retweets = []
+    batch = c.fetchmany(chunksize)
+    while len(batch) > 0:
+        retweets.append(tweet_bitmaps.bitmap_of(np.array(batch, dtype=np.int64).reshape(-1)))
+        batch = c.fetchmany(chunksize)
+    tweet_bitmaps.bitmaps['retweet'] = Bitmap.union_all(retweets)
+
+    print('*** took ' + "{:.4}".format(time.time()-t0) + 's')
+
+    return tweet_bitmaps
+
+
+def buildCampBitmaps(db_connection, tweet_bitmaps, labeling, tweets_stamp=None):
+    """ returns a dictionary with the bitmaps of the tweets having a hashtag
+        of each label of labeling, computed from the table tweet_camp, which
+        is recomputed first if the labeling or the tweets changed (tweets_stamp
+        is passed to `updateTweetCampTable`)
+    """
+    label_bits = updateTweetCampTable(db_connection, labeling, tweets_stamp)
+
+    c = db_connection.cursor()
+    c.execute("SELECT tweet_id, camp_bits FROM tweet_camp WHERE labeling = ?", (labeling,))
+    tweet_camps = np.array(c.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+    rows = tweet_bitmaps.rows_of(tweet_camps[:,0])
+
+    return {'camp:' + labeling + ':' + str(label) : \
+            Bitmap.from_rows(rows[np.logical_and(tweet_camps[:,1] & bit != 0, rows >= 0)]) \
+            for label, bit in label_bits.items()}
+
+
+def getTweetBitmaps(db_connection, filename, labeling=None,
+                    load=loadTweetBitmaps, save=saveTweetBitmaps):
+    """ returns the TweetBitmaps of the database saved in filename, updating
+        and saving them if the database changed.
+
+        The bitmaps of the camps of labeling are added if labeling is given.
+        load(filename) and save(tweet_bitmaps, filename) can be replaced to
+        cache the bitmaps (e.g. with `baseModule.load_artifact`).
+    """
+    c = db_connection.cursor()
+
+    tweets_stamp = getTweetsStamp(c)
+
+    tweet_bitmaps = None
+    if os.path.exists(filename):
+        tweet_bitmaps = load(filename)
+
+    changed = False
+    if tweet_bitmaps is None or tweet_bitmaps.stamps.get('tweets') != tweets_stamp:
+        tweet_bitmaps = buildTweetBitmaps(db_connection)
+        tweet_bitmaps.stamps['tweets'] = tweets_stamp
+        changed = True
+
+    if labeling is not None:
+        labeling_stamp = _labeling_stamp(c, labeling, tweets_stamp)
+        if tweet_bitmaps.stamps.get('labeling:' + labeling) != labeling_stamp:
+            tweet_bitmaps = tweet_bitmaps.with_bitmaps(
+                                buildCampBitmaps(db_connection, tweet_bitmaps, labeling,
+                                                 tweets_stamp),
+                                {'labeling:' + labeling: labeling_stamp},
+                                drop_prefix='camp:' + labeling + ':')
+            changed = True
+
+    if changed:
+        print('saving tweet bitmaps to ' + filename)
+        save(tweet_bitmaps, filename)
+
+    return tweet_bitmaps
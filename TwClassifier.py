@@ -39,7 +39,7 @@ class TweetClassifier(object):
                 
             features = self.feature_extractor(tokens)
             
-            proba = self.classifier.predict_proba(features)
+            proba = self.classifier.predict_proba([features])
             
             proba = proba.flatten()
             
@@ -56,7 +56,7 @@ class TweetClassifier(object):
         elif isinstance(text, list):
             # list of multiple texts
     
-            tokens = map(self.tokenizer.tokenize, text)
+            tokens = self.tokenizer.tokenize_batch(text)
             features = map(self.feature_extractor, tokens)
             
             proba = self.classifier.predict_proba(features)
@@ -40,30 +40,45 @@ def bag_of_non_stopwords(words, stopfile='english'):
 #==============================================================================
 
 from nltk.tokenize.casual import TweetTokenizer, _replace_html_entities, remove_handles, \
-                                reduce_lengthening, HANG_RE, WORD_RE, EMOTICON_RE
+                                HANG_RE, WORD_RE, EMOTICON_RE
 import re
+import hashlib
+from multiprocessing import Pool
+
+# patterns compiled once for all the calls
+MENTION_RE = re.compile(r"(^|(?<=[^\w.-]))@[A-Za-z_]+\w+")
+
+# same pattern as nltk's reduce_lengthening
+REDUCE_LEN_RE = re.compile(r"(.)\1{2,}")
+
+URL_RE = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
 
 def normalize_mentions(text):
     """
     Replace Twitter username handles with '@USER'.
     """
-    pattern = re.compile(r"(^|(?<=[^\w.-]))@[A-Za-z_]+\w+")
-    return pattern.sub('@USER', text)
+    return MENTION_RE.sub('@USER', text)
 
 
 def normalize_urls(text):
     """
     Replace urls with 'URL'.
     """  
-    pattern = re.compile(r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'".,<>?«»“”‘’]))""")
     # first shorten consecutive punctuation to 3 
     # to avoid the pattern to hang in exponential loop in extreme cases.    
     text = HANG_RE.sub(r'\1\1\1', text)
 
-    return pattern.sub('URL', text)
+    return URL_RE.sub('URL', text)
     
 
 def _lowerize(word, keep_all_upper=False):
+    # fast path: emoticons always contain eyes ([:;=8]) or '<3' so words 
+    # made only of letters and digits other than 8 cannot be emoticons
+    if word.isalnum() and '8' not in word:
+        if (keep_all_upper and word.isupper()) or word == 'URL':
+            return word
+        return word.lower()
+    
     if EMOTICON_RE.search(word):
         return word
     elif word.isupper() and keep_all_upper:
@@ -106,11 +121,12 @@ class CustomTweetTokenizer(TweetTokenizer):
         
         """
         # Fix HTML character entities:
-        text = _replace_html_entities(text)
+        if '&' in text:
+            text = _replace_html_entities(text)
         # Remove or replace username handles
         if self.strip_handles:
             text = remove_handles(text)
-        elif self.normalize_usernames:
+        elif self.normalize_usernames and '@' in text:
             text = normalize_mentions(text)
         
         if self.normalize_urls:
@@ -120,20 +136,294 @@ class CustomTweetTokenizer(TweetTokenizer):
         # Normalize word lengthening
         if self.reduce_len:
             text = HANG_RE.sub(r'\1\1\1', text)
-            text = reduce_lengthening(text)
+            # no sequence is longer than 3 after reduce_lengthening, so 
+            # the text is already safe
+            safe_text = REDUCE_LEN_RE.sub(r'\1\1\1', text)
+        else:
+            safe_text = HANG_RE.sub(r'\1\1\1', text)
         
         # Tokenize:
-        safe_text = HANG_RE.sub(r'\1\1\1', text)
         words = WORD_RE.findall(safe_text)
         
         # Possibly alter the case, but avoid changing emoticons like :D into :d:
         # lower words but keep words that are all upper cases                              
         if not self.preserve_case:
-            words = [_lowerize(w, self.keep_allupper) for w in words]
+            keep_allupper = self.keep_allupper
+            words = [_lowerize(w, keep_allupper) for w in words]
             
             
         return words
+    
+    def _tokenize_list(self, texts):
+        return [self.tokenize(text) for text in texts]
+        
+    def tokenize_batch(self, texts, ncpu=1, chunksize=10000):
+        """
+        :param texts: list(str)
+        :rtype: list(list(str))
+        :return: the list of the tokens of each text, the same as 
+                 `tokenize`. With ncpu > 1, chunks of chunksize texts are
+                 tokenized by ncpu processes.
+        """
+        if ncpu > 1 and len(texts) > chunksize:
+            chunks = [texts[start:start+chunksize] for start in range(0, len(texts), chunksize)]
+            with Pool(ncpu) as p:
+                return list(chain.from_iterable(p.map(self._tokenize_list, chunks)))
+            
+        return self._tokenize_list(texts)
+        
+
+def text_hash(text):
+    """ returns a 64-bit hash of text (as a signed integer that can be stored
+        in SQLite) used to find identical texts
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(),
+                          'little', signed=True)
+    
+
+#==============================================================================
+# Batched feature extraction
+#==============================================================================
+
+import scipy.sparse as sp
+from array import array
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.utils import murmurhash3_32
+
+# murmurhash3 of the tokens, cleared when it reaches _TOKEN_HASHES_MAX_SIZE
+_token_hashes = {}
+_TOKEN_HASHES_MAX_SIZE = 2**20
+
+def token_hash(token):
+    """ returns the 32-bit murmurhash3 of token (cached) """
+    h = _token_hashes.get(token)
+    if h is None:
+        if len(_token_hashes) >= _TOKEN_HASHES_MAX_SIZE:
+            _token_hashes.clear()
+        h = _token_hashes[token] = murmurhash3_32(token, positive=True)
+        
+    return h
+    
+def bigram_hash(h1, h2):
+    """ combines the 32-bit hashes of two consecutive tokens in a 32-bit hash
+        (multiplicative hashing)
+    """
+    return ((((h1 << 32) | h2) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32
+
+# version of the columns given by `hashed_feature_index` and 
+# `hashed_bag_of_words_and_bigrams`, stored in `HashedFeatureVectorizer` 
+# (version 1 hashed the bigrams joined by a space)
+FEATURE_HASHING_VERSION = 2
+
+def hashed_feature_index(feature, n_features):
+    """ returns the column of feature (a token or a tuple of tokens) in a 
+        matrix of n_features hashed features
+    """
+    if isinstance(feature, tuple):
+        h = token_hash(feature[0])
+        for token in feature[1:]:
+            h = bigram_hash(h, token_hash(token))
+    else:
+        h = token_hash(feature)
+        
+    return h % n_features
+    
+def hashed_bag_of_words_and_bigrams(words, n_features=2**20):
+    """ returns the array (32-bit integers) of the columns of the tokens and 
+        bigrams of words in a matrix of n_features hashed features. 
+        
+        Same columns as `hashed_feature_index` of the features of 
+        `bag_of_words_and_bigrams(words)` but without building the dictionary 
+        and the bigram tuples (repeated tokens give repeated columns). 
+        Can be used as `feature_extractor` with `HashedFeatureVectorizer`, e.g. 
+        `partial(hashed_bag_of_words_and_bigrams, n_features=n_features)`.
+    """
+    hashes = [token_hash(word) for word in words]
+    
+    columns = array('i', [h % n_features for h in hashes])
+    columns.extend(bigram_hash(h1, h2) % n_features for h1, h2 in zip(hashes, hashes[1:]))
+    
+    return columns
+
+# tokenizer, feature extractor and excluded hashtags of the worker processes
+_feature_worker = {}
+
+def _init_feature_worker(tokenizer, feature_extractor, excluded_hashtags, n_features):
+    _feature_worker['tokenizer'] = tokenizer
+    _feature_worker['feature_extractor'] = feature_extractor
+    _feature_worker['excluded_hashtags'] = frozenset(excluded_hashtags)
+    _feature_worker['n_features'] = n_features
+    
+def _extract_features_chunk(texts):
+    """ returns the column indices and row pointers of the sparse features 
+        of texts and the list of features in the order of the columns 
+        (order of first appearance in the chunk), or None for hashed features
+    """
+    tokenizer = _feature_worker['tokenizer']
+    feature_extractor = _feature_worker['feature_extractor']
+    excluded_hashtags = _feature_worker['excluded_hashtags']
+    n_features = _feature_worker['n_features']
+    
+    vocab = {}
+    feature_names = []
+    indices = []
+    indptr = [0]
+    for text_tokens in tokenizer.tokenize_batch(texts):
+        # remove hashtags that are used for labeling
+        tokens = [token for token in text_tokens if not \
+                  (token[0] == '#' and token[1:] in excluded_hashtags)]
+        
+        if n_features is not None:
+            features = feature_extractor(tokens)
+            if isinstance(features, dict):
+                indices.extend(hashed_feature_index(feature, n_features) for \
+                               feature in features)
+            else:
+                # columns given by the feature extractor
+                indices.extend(features)
+        else:
+            for feature in feature_extractor(tokens):
+                index = vocab.get(feature)
+                if index is None:
+                    index = vocab[feature] = len(feature_names)
+                    feature_names.append(feature)
+                indices.append(index)
+            
+        indptr.append(len(indices))
+        
+    if n_features is not None:
+        feature_names = None
+        
+    return np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64), feature_names
+    
+def extract_features(texts, tokenizer=CustomTweetTokenizer(), 
+                     feature_extractor=bag_of_words_and_bigrams,
+                     excluded_hashtags=(), ncpu=1, chunksize=10000, dtype=np.int8,
+                     n_features=None):
+    """ tokenizes texts, extracts their features and returns them as a sparse 
+        matrix X (one row per text) with the list of the features of the 
+        columns.
+        
+        Tokens that are hashtags in excluded_hashtags (without '#') are removed.
+        Chunks of chunksize texts are processed by ncpu processes, each with
+        its own tokenizer, and the vocabularies of the chunks are merged in 
+        order, such that X and the features are the same as with 
+        `DictVectorizer(dtype=dtype, sort=False).fit_transform` applied to
+        the dictionaries of features.
         
+        If n_features is given, features are directly mapped to n_features 
+        hashed columns (see `hashed_feature_index`), as with 
+        `HashedFeatureVectorizer`, and the list of features is None. In this
+        case, feature_extractor can also directly return the columns (e.g. 
+        `hashed_bag_of_words_and_bigrams` with the same n_features).
+    """
+    chunks = [texts[start:start+chunksize] for start in range(0, len(texts), chunksize)]
+    
+    initargs = (tokenizer, feature_extractor, excluded_hashtags, n_features)
+    if ncpu > 1 and len(chunks) > 1:
+        with Pool(ncpu, initializer=_init_feature_worker, initargs=initargs) as p:
+            results = p.map(_extract_features_chunk, chunks)
+    else:
+        _init_feature_worker(*initargs)
+        results = [_extract_features_chunk(chunk) for chunk in chunks]
+        
+    # merge the vocabularies of the chunks
+    vocab = {}
+    feature_names = []
+    all_indices = []
+    all_indptr = [np.zeros(1, dtype=np.int64)]
+    for indices, indptr, chunk_feature_names in results:
+        if chunk_feature_names is not None:
+            chunk_to_global = np.empty(len(chunk_feature_names), dtype=np.int64)
+            for i, feature in enumerate(chunk_feature_names):
+                index = vocab.get(feature)
+                if index is None:
+                    index = vocab[feature] = len(feature_names)
+                    feature_names.append(feature)
+                chunk_to_global[i] = index
+            indices = chunk_to_global[indices]
+            
+        all_indices.append(indices)
+        all_indptr.append(indptr[1:] + all_indptr[-1][-1])
+        
+    indices = np.concatenate(all_indices) if len(all_indices) > 0 else np.zeros(0, dtype=np.int64)
+    indptr = np.concatenate(all_indptr)
+    
+    if n_features is not None:
+        feature_names = None
+    else:
+        n_features = len(feature_names)
+    
+    X = sp.csr_matrix((np.ones(indices.size, dtype=dtype), indices, indptr),
+                      shape=(indptr.size - 1, n_features), dtype=dtype)
+    X.sum_duplicates()
+    # binary features (repeated or colliding hashed features count once)
+    X.data[:] = 1
+    
+    return X, feature_names
+    
+class HashedFeatureVectorizer(BaseEstimator, TransformerMixin):
+    """ Transforms dictionaries of features (e.g. from `bag_of_words_and_bigrams`)
+        or arrays of columns (e.g. from `hashed_bag_of_words_and_bigrams` with 
+        the same n_features) to a sparse matrix with n_features hashed binary
+        columns. Can replace DictVectorizer in a pipeline trained on features 
+        from `extract_features` with n_features.
+        
+        The version of the hashing (`FEATURE_HASHING_VERSION`) is set in 
+        `hashing_version` by `fit` and checked when transforming, since a 
+        pickled pipeline gives wrong probabilities with the columns of another
+        version.
+    """
+    def __init__(self, n_features=2**20, dtype=np.int8):
+        self.n_features = n_features
+        self.dtype = dtype
+        
+    def fit(self, X, y=None):
+        self.hashing_version = FEATURE_HASHING_VERSION
+        return self
+        
+    def transform(self, X):
+        # instances pickled before the version was stored have version 1 
+        # (as well as instances that were not fitted)
+        hashing_version = getattr(self, 'hashing_version', 1)
+        if hashing_version != FEATURE_HASHING_VERSION:
+            raise Exception("The classifier was trained with the feature hashing version " + 
+                            str(hashing_version) + " but the current version is " + 
+                            str(FEATURE_HASHING_VERSION) + ", run `buildTrainingSet` and "
+                            "`trainClassifier` again")
+            
+        if isinstance(X, dict):
+            X = [X]
+            
+        indices = []
+        indptr = [0]
+        for features in X:
+            if isinstance(features, dict):
+                indices.extend(hashed_feature_index(feature, self.n_features) for \
+                               feature in features)
+            else:
+                indices.extend(features)
+            indptr.append(len(indices))
+            
+        X = sp.csr_matrix((np.ones(len(indices), dtype=self.dtype), indices, indptr),
+                          shape=(len(indptr) - 1, self.n_features), dtype=self.dtype)
+        X.sum_duplicates()
+        X.data[:] = 1
+        
+        return X
+    
+def features_from_matrix(X, feature_names):
+    """ returns the list of dictionaries of features (as given by 
+        `bag_of_words`) of the rows of the sparse matrix X
+    """
+    X = sp.csr_matrix(X)
+    names = np.empty(len(feature_names), dtype=object)
+    for i, feature in enumerate(feature_names):
+        names[i] = feature
+    
+    return [dict.fromkeys(names[X.indices[X.indptr[i]:X.indptr[i+1]]].tolist(), True) \
+            for i in range(X.shape[0])]
+    
 
 #==============================================================================
 # Direct classification of tweet text
@@ -156,7 +446,7 @@ def classifyText(text, classifier, tokenizer=CustomTweetTokenizer(),
             
         features = feature_extractor(tokens)
         
-        proba = classifier.predict_proba(features)
+        proba = classifier.predict_proba([features])
         
         proba = proba.flatten()
         
@@ -10,6 +10,7 @@ import sqlite3
 import ujson as json
 from TwSentiment import CustomTweetTokenizer
 from collections import Counter
+from itertools import islice
 import random
 import pickle
 import pandas as pd
@@ -1026,11 +1027,31 @@ def fetchgenerator(cursor, arraysize=1000):
         for result in results:
             yield result
             
+def iterTweetTexts(cursor, tweet_ids, batch_size=500):
+    """ yields the texts of tweet_ids (an iterable, in the same order), 
+        queried by batches of batch_size tweet_ids
+    """
+    tweet_ids = iter(tweet_ids)
+    while True:
+        batch = [int(tid) for tid in islice(tweet_ids, batch_size)]
+        if not batch:
+            break
+        cursor.execute("SELECT tweet_id, text FROM tweet WHERE tweet_id IN ({seq})".format(
+                       seq=','.join(['?']*len(batch))), batch)
+        text_of = dict(cursor.fetchall())
+        for tid in batch:
+            if tid in text_of:
+                yield text_of[tid]
+                
+            
 
     
 def addHTSupportGroup(db_connection, ht_group_names, ht_list_lists, 
                       create_column=True, create_index=True, column_name='ht_group'):
-    
+    """ marks the hashtags of ht_list_lists in a column of hashtag_tweet_user 
+        (old way of labeling hashtags, see `setHashtagLabels`). Such columns 
+        are migrated to the table hashtag_label by `migrateHashtagLabelColumn`.
+    """
     c = db_connection.cursor()
     
     # add column to hashtag_tweet_user table
@@ -1052,8 +1073,245 @@ def addHTSupportGroup(db_connection, ht_group_names, ht_list_lists,
     db_connection.commit()
     
 
-
+def createHashtagLabelTable(cursor):
+    """ creates the table hashtag_label with the label of the hashtags for 
+        each labeling (named lists of hashtag groups) """
+        
+    cursor.execute("""CREATE TABLE IF NOT EXISTS hashtag_label (
+                      labeling TEXT NOT NULL,
+                      hashtag TEXT NOT NULL,
+                      label TEXT NOT NULL,
+                      PRIMARY KEY (labeling, hashtag))""")
+    
+    
+def setHashtagLabels(db_connection, labeling, ht_group_names, ht_list_lists):
+    """ replaces the labeling `labeling` in the table hashtag_label, hashtags
+        in ht_list_lists[i] have label ht_group_names[i].
+        
+        Only the hashtag_label table is modified, tweets with labeled hashtags
+        are found by joining with it on `hashtag`. If a hashtag is in several
+        lists, the last label is kept.
+    """
+    c = db_connection.cursor()
+    
+    createHashtagLabelTable(c)
+    
+    c.execute("DELETE FROM hashtag_label WHERE labeling = ?", (labeling,))
+    
+    # the tweet camps of the labeling are no longer valid
+    createTweetCampTable(c)
+    c.execute("DELETE FROM tweet_camp WHERE labeling = ?", (labeling,))
+    c.execute("DELETE FROM tweet_camp_labeling WHERE labeling = ?", (labeling,))
+    
+    for ht_group_name, ht_list in zip(ht_group_names, ht_list_lists):
+        c.executemany("""INSERT OR REPLACE INTO hashtag_label (labeling, hashtag, label) 
+                         VALUES (?, ?, ?)""",
+                      [(labeling, ht, ht_group_name) for ht in ht_list])
+        
+    db_connection.commit()
+    
+    
+def migrateHashtagLabelColumn(db_connection, labeling):
+    """ copies the labels of the column `labeling` of hashtag_tweet_user 
+        (databases labeled with `addHTSupportGroup`) to the table 
+        hashtag_label, if the labeling is not already in hashtag_label.
+        
+        Returns the number of labeled hashtags copied.
+    """
+    c = db_connection.cursor()
+    
+    createHashtagLabelTable(c)
+    
+    c.execute("SELECT 1 FROM hashtag_label WHERE labeling = ? LIMIT 1", (labeling,))
+    if c.fetchone() is not None:
+        return 0
+    
+    c.execute("PRAGMA table_info(hashtag_tweet_user)")
+    if labeling not in [cname for _, cname, _, _, _ ,_ in c.fetchall()]:
+        return 0
+    
+    c.execute("""INSERT OR REPLACE INTO hashtag_label (labeling, hashtag, label)
+                 SELECT DISTINCT ?, hashtag, "{cname}" FROM hashtag_tweet_user
+                 WHERE "{cname}" IS NOT NULL""".format(cname=labeling), (labeling,))
+    num_hashtags = c.rowcount
+    
+    db_connection.commit()
+    
+    print('copied the labels of ' + str(num_hashtags) + ' hashtags from the column ' + 
+          labeling + ' of hashtag_tweet_user to hashtag_label')
+    
+    return num_hashtags
+    
+    
+def getHashtagLabelNames(db_connection, labeling):
+    """ returns the sorted list of labels of the labeling `labeling`. Labels 
+        stored in a column of hashtag_tweet_user are first migrated (see 
+        `migrateHashtagLabelColumn`).
+    """
+    
+    c = db_connection.cursor()
+    
+    createHashtagLabelTable(c)
+    
+    migrateHashtagLabelColumn(db_connection, labeling)
+    
+    c.execute("SELECT DISTINCT label FROM hashtag_label WHERE labeling = ? ORDER BY label",
+              (labeling,))
+    
+    return [label for (label,) in c.fetchall()]
+    
+    
+def getTweetsStamp(cursor):
+    """ returns a stamp that changes when tweets, retweets, hashtags or 
+        clients are added to the database (only maximums of the primary key 
+        or rowid, read from the end of the tables)
+    """
+    stamp = []
+    for query in ["SELECT MAX(tweet_id) FROM tweet",
+                  "SELECT MAX(rowid) FROM tweet_to_retweeted_uid",
+                  "SELECT MAX(rowid) FROM hashtag_tweet_user",
+                  "SELECT MAX(rowid) FROM source_content"]:
+        cursor.execute(query)
+        stamp.extend(cursor.fetchone())
+
+    return json.dumps(stamp)
+    
+    
+def createTweetCampTable(cursor):
+    """ creates the table tweet_camp with one row per tweet having labeled 
+        hashtags for each labeling, and the table tweet_camp_labeling with the
+        labelings for which tweet_camp was computed and the stamp (see 
+        `getTweetsStamp`) of the tweets at that time.
         
+        Bit i of camp_bits is set if the tweet has a hashtag with the i-th label 
+        (in the order of `getHashtagLabelNames`). The retweets and the tweets
+        from official clients are given by the bitmaps of `TwBitmaps`.
+    """
+    # tables created with the is_retweet and official_client columns are 
+    # recomputed
+    cursor.execute("PRAGMA table_info(tweet_camp)")
+    if 'is_retweet' in [cname for _, cname, _, _, _ ,_ in cursor.fetchall()]:
+        cursor.execute("DROP TABLE tweet_camp")
+        cursor.execute("DROP TABLE IF EXISTS tweet_camp_labeling")
+        
+    cursor.execute("""CREATE TABLE IF NOT EXISTS tweet_camp (
+                      labeling TEXT NOT NULL,
+                      tweet_id INTEGER NOT NULL,
+                      camp_bits INTEGER NOT NULL,
+                      PRIMARY KEY (labeling, tweet_id))""")
+    
+    cursor.execute("""CREATE TABLE IF NOT EXISTS tweet_camp_labeling (
+                      labeling TEXT PRIMARY KEY,
+                      num_tweets INTEGER,
+                      tweets_stamp TEXT)""")
+    
+    # tables created without tweets_stamp
+    cursor.execute("PRAGMA table_info(tweet_camp_labeling)")
+    if 'tweets_stamp' not in [cname for _, cname, _, _, _ ,_ in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE tweet_camp_labeling ADD tweets_stamp TEXT")
+    
+    
+def updateTweetCampTable(db_connection, labeling, tweets_stamp=None):
+    """ computes the rows of tweet_camp for labeling in one pass over the 
+        tweets with labeled hashtags, unless they are up to date (the labeling
+        did not change and no tweets were added since, see `getTweetsStamp`).
+        tweets_stamp can be given if `getTweetsStamp` was already called.
+        
+        Returns a dictionary mapping the label names to their bit in camp_bits.
+    """
+    label_names = getHashtagLabelNames(db_connection, labeling)
+    label_bits = {label: 1 << i for i, label in enumerate(label_names)}
+    
+    c = db_connection.cursor()
+    
+    createTweetCampTable(c)
+    
+    if tweets_stamp is None:
+        tweets_stamp = getTweetsStamp(c)
+    
+    c.execute("SELECT tweets_stamp FROM tweet_camp_labeling WHERE labeling = ?", (labeling,))
+    row = c.fetchone()
+    if (row is not None and row[0] == tweets_stamp) or len(label_names) == 0:
+        return label_bits
+    
+    t0 = time.time()
+    print('computing tweet camps of labeling ' + labeling)
+    
+    c.execute("DELETE FROM tweet_camp WHERE labeling = ?", (labeling,))
+    
+    # each hashtag_tweet_user row has the bit of the label of the hashtag and
+    # the sum of the distinct bits of a tweet is their bitwise OR
+    bits_case = 'CASE hashtag_label.label ' + \
+                ' '.join(['WHEN ? THEN ' + str(bit) for bit in label_bits.values()]) + ' END'
+    
+    c.execute("""INSERT INTO tweet_camp (labeling, tweet_id, camp_bits)
+                 SELECT ?, hashtag_tweet_user.tweet_id, SUM(DISTINCT {bits_case})
+                 FROM hashtag_label INNER JOIN hashtag_tweet_user 
+                      ON hashtag_tweet_user.hashtag = hashtag_label.hashtag
+                 WHERE hashtag_label.labeling = ?
+                 GROUP BY hashtag_tweet_user.tweet_id
+              """.format(bits_case=bits_case),
+              [labeling] + list(label_bits.keys()) + [labeling])
+    
+    num_tweets = c.rowcount
+    c.execute("""INSERT OR REPLACE INTO tweet_camp_labeling (labeling, num_tweets, tweets_stamp) 
+                 VALUES (?, ?, ?)""", (labeling, num_tweets, tweets_stamp))
+    
+    db_connection.commit()
+    
+    print(str(num_tweets) + ' tweets with labeled hashtags')
+    print('*** took ' + "{:.4}".format(time.time()-t0) + 's')
+    
+    return label_bits
+    
+    
+def createTextProbaCacheTable(cursor):
+    """ creates the table text_proba_cache with the classification 
+        probability of texts (identified by `TwSentiment.text_hash`) for 
+        each classifier (identified by the digest of its file)
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS text_proba_cache (
+                      classifier TEXT NOT NULL,
+                      text_hash INTEGER NOT NULL,
+                      proba REAL,
+                      PRIMARY KEY (classifier, text_hash)) WITHOUT ROWID""")
+    
+    
+def getCachedTextProba(cursor, classifier, text_hashes, batch_size=500):
+    """ returns a dictionary with the cached probabilities of text_hashes """
+    
+    text_hashes = [int(h) for h in text_hashes]
+    
+    cached = {}
+    for start in range(0, len(text_hashes), batch_size):
+        batch = text_hashes[start:start+batch_size]
+        cursor.execute("""SELECT text_hash, proba FROM text_proba_cache
+                          WHERE classifier = ? AND text_hash IN ({seq})""".format(
+                          seq=','.join(['?']*len(batch))), [classifier] + batch)
+        cached.update(cursor.fetchall())
+        
+    return cached
+    
+    
+def setCachedTextProba(cursor, classifier, text_hashes, probas):
+    """ adds the probabilities of text_hashes to the cache """
+    
+    cursor.executemany("""INSERT OR REPLACE INTO text_proba_cache (classifier, text_hash, proba)
+                          VALUES (?, ?, ?)""", 
+                       [(classifier, int(h), float(p)) for h, p in zip(text_hashes, probas)])
+    
+    
+def deleteCachedTextProba(cursor, classifier=None):
+    """ removes the cached probabilities of classifier (the digest of its 
+        file, `artifactCache.file_digest(classifier_filename)`) from the 
+        table text_proba_cache, or drops the table if classifier is None
+    """
+    
+    if classifier is None:
+        cursor.execute("DROP TABLE IF EXISTS text_proba_cache")
+    else:
+        cursor.execute("DELETE FROM text_proba_cache WHERE classifier = ?", (classifier,))
+    
     
 def createIndexes(conn):
     c = conn.cursor()
@@ -1,9 +1,11 @@
 # Author: Alexandre Bovet <alexandre.bovet@gmail.com>
 # License: BSD 3 clause
 
-import graph_tool.all as gt
 import time
-from HTCoocNetwork import add_p_val_to_edges
+from HTCoocNetwork import add_p_val_to_edges, load_graph, save_graph, export_graphml, \
+                          PValTable, pval_table_filename, update_p_val_of_edges, \
+                          significance_state_filename, save_significance_state, \
+                          load_significance_state
 from multiprocessing import cpu_count
 
 from baseModule import baseModule
@@ -19,11 +21,48 @@ class addStatSigniHT(baseModule):
         The computation is done using `p0=1e-6` and `p0` is saved as a graph property.
         Different values of `p0` can be tested latter.
         The resulting graph is saved to `graph_file`.
+        Each p-value is computed once per unique triple of counts and saved in
+        a table alongside the graph, so that it is reused by later runs on 
+        graphs with the same number of tweets.
+        The inputs and results of the computation are saved in a state file 
+        alongside the graph, they are used to update the significance of a 
+        rebuilt graph incrementally (see `incremental_significance`).
         
         *Optional parameters that can be added to `job`:*
             
-        :ncpu: number of processors to be used. (Default is the number of cores 
+        :p_val_method: 'log' to compute the p-values of all edges at once in
+                       log space, 'tiered' to approximate the p-values of edges
+                       with large counts when the error is smaller than 
+                       `p_val_accuracy`, or 'exact' to use the exact summation 
+                       of `HTCoocNetwork.p_val_np` for each edge. 
+                       (Default is 'log').
+        :p_val_accuracy: maximum error on the significance of the approximated
+                         p-values with `p_val_method='tiered'`. (Default is 0.01).
+        :ncpu: number of processors to be used. Edges are split into chunks of
+               similar computational cost. (Default is the number of cores 
                on your machine minus 1).
+        :incremental_significance: if True and a previous state exists, only the
+                                   edges whose counts changed are recomputed, 
+                                   the others are rescaled to the new number 
+                                   of tweets when the error bound on their 
+                                   significance is smaller than 
+                                   `max_rescale_error`. Edges are always 
+                                   rescaled from their last computation, so
+                                   errors do not accumulate over successive 
+                                   updates. (Default is False).
+        :max_rescale_error: maximum error on the significance of rescaled edges.
+                            (Default is 0.01).
+        :significance_state_file: file where the state of the computation is
+                                  saved. (Default is `graph_file` with the 
+                                  suffix `_signi_state.npz`).
+        :pval_table_file: file where the table of p-values is saved. Only exact
+                          p-values are saved, not the approximations of
+                          `p_val_method='tiered'`. (Default is
+                          `graph_file` with the suffix `_pval_table.npz`).
+        :metrics_file: file where a JSON summary of the computation (rate, time
+                       per range of occurrences) is appended. (Default is None).
+        :graphml_file: if given, the resulting graph is also exported in GraphML
+                       format to this file. (Default is None).
         
         [1] Martinez-Romo, J. et al. Disentangling categorical relationships through 
         a graph of co-occurrences. Phys. Rev. E 84, 1–8 (2011).
@@ -43,16 +82,60 @@ class addStatSigniHT(baseModule):
         # set the number of cores
         ncpu = self.job.get('ncpu', cpu_count()-1)
         
-        self.G = gt.load_graph(graph_file)
+        # method used to compute the p-values
+        p_val_method = self.job.get('p_val_method', 'log')
+        p_val_accuracy = self.job.get('p_val_accuracy', 0.01)
+        
+        # incremental update of the significance
+        incremental_significance = self.job.get('incremental_significance', False)
+        max_rescale_error = self.job.get('max_rescale_error', 0.01)
+        significance_state_file = self.job.get('significance_state_file',
+                                               significance_state_filename(graph_file))
+        
+        # table of already computed p-values
+        pval_table_file = self.job.get('pval_table_file', pval_table_filename(graph_file))
+        
+        # file with performance metrics
+        metrics_file = self.job.get('metrics_file', None)
+        
+        # optional export of the graph in GraphML format
+        graphml_file = self.job.get('graphml_file', None)
+        
+        # copy of the graph shared with the artifact cache, since edge and graph
+        # properties are added
+        self.G = self.load_artifact(graph_file, load_graph).shallow_copy()
+        
+        self.pval_table = PValTable.load(pval_table_file)
+        
+        if incremental_significance:
+            state = load_significance_state(significance_state_file)
+        else:
+            state = None
         
         t0 = time.time()
         print('computing significance of links')
-        add_p_val_to_edges(self.G, self.G.gp.Ntweets, ncpu=ncpu)
+        if state is None:
+            anchors = add_p_val_to_edges(self.G, self.G.gp.Ntweets, ncpu=ncpu, method=p_val_method,
+                               pval_table=self.pval_table, metrics_file=metrics_file,
+                               accuracy=p_val_accuracy)
+        else:
+            print('updating significance from ' + significance_state_file)
+            anchors = update_p_val_of_edges(self.G, self.G.gp.Ntweets, state, 
+                                  max_error=max_rescale_error, ncpu=ncpu, 
+                                  method=p_val_method, pval_table=self.pval_table,
+                                  metrics_file=metrics_file, accuracy=p_val_accuracy)
         print('finished')
         self.print_elapsed_time(t0)
         
+        self.pval_table.save(pval_table_file)
+        save_significance_state(self.G, significance_state_file, anchors)
+        
         # save graph file
-        self.G.save(graph_file, fmt='graphml')
+        self.save_artifact(self.G, graph_file, save_graph)
+        
+        if graphml_file is not None:
+            print('exporting graph to ' + graphml_file)
+            export_graphml(self.G, graphml_file)
                 
         
         
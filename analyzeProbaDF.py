@@ -7,6 +7,9 @@ import pandas as pd
 from multiprocessing import Pool, cpu_count
 from functools import partial
 import time
+import sqlite3
+from TwBitmaps import Bitmap, getTweetBitmaps, loadTweetBitmaps, saveTweetBitmaps, \
+                      tweetBitmapsFilename
 
 def applyParallel(dfGrouped, func, ncpu):
     with Pool(ncpu) as p:
@@ -106,6 +109,15 @@ class analyzeProbaDF(baseModule):
                     p < 1-threshold are classified in camp1. Default is 0.5.
         :r_threshold: threshold for the ratio of classified tweets needed to 
                       classify a user. Default is 0.5.
+        :use_tweet_bitmaps: if True and `resampling_frequency` is `'D'`, the 
+                            number of tweets per day is computed from the 
+                            bitmaps of the tweets of each day (see `TwBitmaps`)
+                            of the database `sqlite_db_filename`. Tweets of
+                            `df_proba_filename` that are not in the database
+                            are not counted and a tweet appearing in several 
+                            rows is counted once. Default is False.
+        :tweet_bitmaps_file: where the bitmaps are saved. Default is 
+                             `sqlite_db_filename` with the suffix `_bitmaps.npz`.
     
     
         [1] http://pandas.pydata.org/pandas-docs/stable/timeseries.html#offset-aliases
@@ -129,6 +141,9 @@ class analyzeProbaDF(baseModule):
         threshold = self.job.get('threshold',0.5)
         # threshold for the ratio of classified tweets needed to classify a user
         r_threshold = self.job.get('r_threshold',0.5)
+        # count tweets per day with the bitmaps of the days
+        use_tweet_bitmaps = self.job.get('use_tweet_bitmaps', False) \
+                            and resampling_frequency == 'D'
         
         if ncpu == 1:
             parallel=False
@@ -136,7 +151,7 @@ class analyzeProbaDF(baseModule):
             parallel=True
 
         print('loading ' + df_proba_filename)
-        df = pd.read_pickle(df_proba_filename)
+        df = self.load_artifact(df_proba_filename, pd.read_pickle)
         
         # display settings for pandas
         pd.set_option('expand_frame_repr', False)
@@ -163,12 +178,16 @@ class analyzeProbaDF(baseModule):
         print('computing stats')
         t0 = time.time()
         
-        if parallel:
+        if use_tweet_bitmaps:
+            self.df_num_tweets = self.num_tweets_from_bitmaps(df_filt)
+        elif parallel:
             self.df_num_tweets = applyParallel(resample, get_num_tweets_u, ncpu)            
-            self.df_num_users = applyParallel(resample, get_num_users_u, ncpu)
-            
         else:
             self.df_num_tweets = resample.apply(get_num_tweets_u)
+            
+        if parallel:
+            self.df_num_users = applyParallel(resample, get_num_users_u, ncpu)
+        else:
             self.df_num_users = resample.apply(get_num_users_u)
 
         #%% save dataframes            
@@ -197,8 +216,42 @@ class analyzeProbaDF(baseModule):
             print('\nNumber of users per day in each camp:')
             display(self.df_num_users.to_string())
             
+    def num_tweets_from_bitmaps(self, df_filt):
+        """ returns the number of tweets in each camp per day from the 
+            intersections of the bitmaps of the tweets of each day with the 
+            bitmaps of the tweets of each camp
+        """
+        sqlite_file = self.job['sqlite_db_filename']
+        tweet_bitmaps_file = self.job.get('tweet_bitmaps_file', 
+                                          tweetBitmapsFilename(sqlite_file))
         
+        with sqlite3.connect(sqlite_file) as conn:
+            tb = getTweetBitmaps(conn, tweet_bitmaps_file,
+                                 load=partial(self.load_artifact, loader=loadTweetBitmaps),
+                                 save=partial(self.save_artifact, saver=saveTweetBitmaps))
         
+        rows = tb.rows_of(df_filt.tweet_id.values)
+        known = rows >= 0
+        if not known.all():
+            print(str((~known).sum()) + ' tweets not in ' + sqlite_file + 
+                  ' are not counted')
+        num_duplicates = known.sum() - np.unique(rows[known]).size
+        if num_duplicates > 0:
+            print(str(num_duplicates) + ' duplicated tweets are counted once')
         
+        all_tweets = Bitmap.from_rows(rows[known])
+        pro_1 = Bitmap.from_rows(rows[np.logical_and(known, df_filt.n_pro_1.values)])
+        pro_0 = Bitmap.from_rows(rows[np.logical_and(known, df_filt.n_pro_0.values)])
+        
+        index = []
+        data = {'n_pro_1': [], 'n_pro_0': []}
+        for day in tb.days():
+            day_tweets = tb['day:' + day] & all_tweets
+            if len(day_tweets) == 0:
+                continue
+            index.append(pd.Timestamp(day).date())
+            data['n_pro_1'].append(len(day_tweets & pro_1))
+            data['n_pro_0'].append(len(day_tweets & pro_0))
             
-            
+        return pd.DataFrame(data=data, index=pd.Index(index, name='datetime_EST'),
+                            columns=['n_pro_1', 'n_pro_0'])
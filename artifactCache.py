@@ -0,0 +1,245 @@
+# Author: Alexandre Bovet <alexandre.bovet@gmail.com>
+# License: BSD 3 clause
+
+"""
+In-process cache of the artifacts (graphs, dataframes, features, ...)
+written and read by the stages of the pipeline.
+
+    G = artifact_cache.load(graph_file, load_graph)
+    ...
+    save_graph(G, graph_file)
+    artifact_cache.put(graph_file, G)
+
+Entries are keyed by the absolute path of the file and are only used if the
+modification time and size of the file did not change, so that files
+modified outside of the session are reloaded. The least recently used
+entries are evicted when the estimated memory of the cached objects is
+larger than `max_bytes`. Cached objects are shared and must not be modified
+in place by the stages.
+"""
+
+import os
+import sys
+import mmap
+import hashlib
+import pickle
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def _is_memory_mapped(array):
+    """ whether the memory of array is a memory-mapped file """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+
+    return isinstance(array, mmap.mmap)
+
+
+def artifact_nbytes(obj, num_samples=100):
+    """ estimates the memory used by obj in bytes. Memory-mapped arrays are
+        not counted. The size of long lists is estimated from num_samples
+        items.
+    """
+    if isinstance(obj, np.ndarray) and _is_memory_mapped(obj):
+        return 0
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return obj.nbytes + artifact_nbytes(obj.ravel().tolist(), num_samples)
+        return obj.nbytes
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return int(np.sum(obj.memory_usage(deep=True)))
+    if sp.issparse(obj):
+        return sum(artifact_nbytes(getattr(obj, name)) for name in
+                   ['data', 'indices', 'indptr', 'row', 'col'] if hasattr(obj, name))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(artifact_nbytes(key) + artifact_nbytes(val)
+                                        for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        if len(obj) > num_samples:
+            sample = [obj[i] for i in np.linspace(0, len(obj) - 1, num_samples).astype(int)]
+            return sys.getsizeof(obj) + len(obj)*sum(artifact_nbytes(item)
+                                                     for item in sample)//num_samples
+        return sys.getsizeof(obj) + sum(artifact_nbytes(item) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return sys.getsizeof(obj) + artifact_nbytes(vars(obj))
+
+    return sys.getsizeof(obj)
+
+
+def file_digest(filename, digest_size=8, block_size=2**20):
+    """ returns the hexadecimal blake2b digest of the content of filename """
+    digest = hashlib.blake2b(digest_size=digest_size)
+    with open(filename, 'rb') as fopen:
+        for block in iter(lambda: fopen.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_pickle(filename):
+    with open(filename, 'rb') as fopen:
+        return pickle.load(fopen)
+
+
+def save_pickle(obj, filename):
+    with open(filename, 'wb') as fopen:
+        pickle.dump(obj, fopen)
+
+
+def _atomic_save_npy(array, filename):
+    """ writes array to filename in .npy format, through a temporary file 
+        such that arrays memory-mapped from the previous file stay valid 
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fopen:
+        np.save(fopen, np.asarray(array))
+    os.replace(tmp_filename, filename)
+
+
+def save_array(array, filename):
+    """ saves array as a raw .npy file (see `load_array`) """
+    _atomic_save_npy(array, filename)
+
+
+def load_array(filename, mmap_mode='r'):
+    """ returns the array of filename memory-mapped with mmap_mode """
+    return np.load(filename, mmap_mode=mmap_mode)
+
+
+def _sparse_array_filenames(filename):
+    base = os.path.splitext(filename)[0]
+    return {name: base + '_' + name + '.npy' for name in ['data', 'indices', 'indptr']}
+
+
+def save_sparse_array(X, filename):
+    """ saves the CSR matrix X as raw .npy files: data, indices and indptr
+        next to filename and the shape of X in filename, written last.
+    """
+    X = sp.csr_matrix(X)
+    for name, array_filename in _sparse_array_filenames(filename).items():
+        _atomic_save_npy(getattr(X, name), array_filename)
+
+    _atomic_save_npy(np.array(X.shape, dtype=np.int64), filename)
+
+
+def load_sparse_array(filename, mmap_mode='r'):
+    """ returns the CSR matrix saved with `save_sparse_array` with its
+        arrays memory-mapped with mmap_mode, such that loading takes constant
+        time and processes share the same pages
+    """
+    shape = tuple(np.load(filename).tolist())
+    arrays = {name: np.load(array_filename, mmap_mode=mmap_mode) for \
+              name, array_filename in _sparse_array_filenames(filename).items()}
+
+    # the arrays are set directly to keep them as np.memmap, that joblib 
+    # passes to its workers by reference
+    X = sp.csr_matrix(shape, dtype=arrays['data'].dtype)
+    X.data = arrays['data']
+    X.indices = arrays['indices']
+    X.indptr = arrays['indptr']
+
+    return X
+
+
+class ArtifactCache(object):
+    """ Cache of the objects loaded from or saved to files (see module docstring) """
+
+    def __init__(self, max_bytes=2*1024**3):
+
+        self.max_bytes = max_bytes
+
+        # absolute path -> (mtime, size, object, estimated memory)
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, filename):
+        return self.get(filename, count=False) is not None
+
+    @staticmethod
+    def _key(filename):
+        return os.path.abspath(filename)
+
+    @staticmethod
+    def _stamp(filename):
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def nbytes(self):
+        """ estimated memory of the cached objects """
+        return sum(entry[3] for entry in self._entries.values())
+
+    def get(self, filename, count=True):
+        """ returns the cached object of filename, None if it is not cached or
+            if the file changed
+        """
+        key = self._key(filename)
+        entry = self._entries.get(key)
+
+        if entry is not None and os.path.exists(filename) and \
+           entry[:2] == self._stamp(filename):
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[2]
+
+        if entry is not None:
+            del self._entries[key]
+        if count:
+            self.misses += 1
+
+        return None
+
+    def put(self, filename, obj):
+        """ caches obj as the content of filename (that must exist) """
+
+        key = self._key(filename)
+        self._entries.pop(key, None)
+
+        nbytes = artifact_nbytes(obj)
+        if nbytes > self.max_bytes:
+            return
+
+        self._entries[key] = self._stamp(filename) + (obj, nbytes)
+        self._evict()
+
+    def discard(self, filename):
+        """ removes the cached object of filename, if any """
+        self._entries.pop(self._key(filename), None)
+
+    def load(self, filename, loader):
+        """ returns the cached object of filename or loader(filename) """
+
+        obj = self.get(filename)
+        if obj is None:
+            obj = loader(filename)
+            self.put(filename, obj)
+        else:
+            print('using cached ' + filename)
+
+        return obj
+
+    def _evict(self):
+        total = self.nbytes()
+        while total > self.max_bytes and len(self._entries) > 0:
+            _, entry = self._entries.popitem(last=False)
+            total -= entry[3]
+
+    def clear(self):
+        self._entries.clear()
+
+
+# savers of the files that are memory-mapped when loaded, the saved arrays 
+# are not cached since the memory-mapped arrays use less memory
+memory_mapped_savers = (save_array, save_sparse_array)
+
+# cache shared by the stages of a session
+artifact_cache = ArtifactCache()
@@ -6,8 +6,24 @@
 # License: BSD 3 clause
 
 import time
+import pandas as pd
+
+from artifactCache import artifact_cache, memory_mapped_savers
 
 class baseModule():
+    """ Base class for modules.
+
+        Artifacts (graphs, dataframes, features, ...) are loaded and saved with
+        `load_artifact` and `save_artifact`, that keep them in an in-process
+        cache shared by all the modules, so that modules run one after the
+        other in the same session do not reload them from disk.
+
+        *Optional parameters that can be added to `job`:*
+
+        :use_artifact_cache: if False, artifacts are always loaded from disk.
+                             (Default is True).
+    """
+
     def __init__(self, job):
         self.job = job
 
@@ -16,3 +32,29 @@ class baseModule():
             
         print('*** took ' + "{:.4}".format(time.time()-t0) + 's')                
 
+    def load_artifact(self, filename, loader):
+        """ returns loader(filename), or the object already in the artifact
+            cache if filename did not change
+        """
+        if not self.job.get('use_artifact_cache', True):
+            return loader(filename)
+
+        return artifact_cache.load(filename, loader)
+
+    def save_artifact(self, obj, filename, saver):
+        """ saves obj to filename with saver(obj, filename) and adds it to the
+            artifact cache. Dataframes are cached as copies, so that changes 
+            to obj are not seen by the next stages, and arrays saved to be
+            memory-mapped (`artifactCache.memory_mapped_savers`) are not 
+            cached, the next `load_artifact` memory-maps them.
+        """
+        saver(obj, filename)
+
+        if not self.job.get('use_artifact_cache', True) or saver in memory_mapped_savers:
+            artifact_cache.discard(filename)
+            return
+        
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            obj = obj.copy()
+            
+        artifact_cache.put(filename, obj)
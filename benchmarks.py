@@ -0,0 +1,348 @@
+# Author: Alexandre Bovet <alexandre.bovet@gmail.com>
+# License: BSD 3 clause
+
+"""
+Benchmarks of the performance critical parts of the pipeline.
+
+Usage: python benchmarks.py [graph_file]
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+
+def benchmark_graph_io(graph_file, formats=('npz', 'gt', 'graphml'), num_repeat=3):
+    """ times the saving and loading of the hashtag graph in graph_file
+        for each of the formats.
+
+        Returns a dataframe with the best save and load times (in seconds)
+        and the file size (in MB) for each format.
+    """
+    from HTCoocNetwork import load_graph, save_graph, export_graphml
+
+    G = load_graph(graph_file)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for fmt in formats:
+            filename = os.path.join(tmp_dir, 'graph.' + fmt)
+
+            save_times = []
+            load_times = []
+            for _ in range(num_repeat):
+                t0 = time.time()
+                if fmt == 'graphml':
+                    export_graphml(G, filename)
+                else:
+                    save_graph(G, filename)
+                save_times.append(time.time() - t0)
+
+                t0 = time.time()
+                load_graph(filename)
+                load_times.append(time.time() - t0)
+
+            results.append({'format': fmt,
+                            'save_time': min(save_times),
+                            'load_time': min(load_times),
+                            'size_MB': os.path.getsize(filename)/1e6})
+
+    df = pd.DataFrame(results, columns=['format', 'save_time', 'load_time', 'size_MB'])
+
+    print('\nGraph with ' + str(G.num_vertices()) + ' nodes and ' +
+          str(G.num_edges()) + ' edges')
+    print(df.to_string(index=False))
+
+    return df
+
+
+def random_graph(num_vertices=10**6, num_edges=10**7, seed=0):
+    """ returns a random `HTCoocNetwork.HTGraph` with names, counts and 
+        significance properties """
+    from HTCoocNetwork import HTGraph
+    
+    rng = np.random.RandomState(seed)
+    
+    edges = rng.randint(0, num_vertices, size=(num_edges, 2))
+    edges.sort(axis=1)
+    
+    vp = {'names': np.array(['ht' + str(i) for i in range(num_vertices)]),
+          'counts': rng.zipf(1.5, size=num_vertices) % 10**6}
+    ep = {'weights': rng.randint(1, 100, size=num_edges),
+          's': rng.normal(0, 10, size=num_edges)}
+    
+    return HTGraph(edges, num_vertices, vp=vp, ep=ep, gp={'p0': 1e-6})
+    
+
+def benchmark_graph_filtering(G=None, s0=1.0, min_count=10, num_repeat=3):
+    """ times `significant_subgraph` (filtering of propagateLabels) on G 
+        (a random graph with 10M edges by default).
+        
+        Returns a dataframe with the best time of each step (in seconds).
+    """
+    from HTCoocNetwork import significant_subgraph
+    
+    if G is None:
+        G = random_graph()
+        
+    times = {'masks': [], 'subgraph': []}
+    for _ in range(num_repeat):
+        t0 = time.time()
+        vmask = G.vp.counts >= min_count
+        emask = G.ep.s >= s0
+        times['masks'].append(time.time() - t0)
+        
+        t0 = time.time()
+        G_filt = significant_subgraph(G, s0=s0, min_count=min_count)
+        times['subgraph'].append(time.time() - t0)
+        
+    df = pd.DataFrame([{'step': step, 'time': min(t)} for step, t in times.items()],
+                      columns=['step', 'time'])
+    
+    print('\nFiltering graph with ' + str(G.num_vertices()) + ' nodes and ' +
+          str(G.num_edges()) + ' edges (' + str(vmask.sum()) + ' nodes with enough counts, ' + 
+          str(emask.sum()) + ' significant edges) to ' + 
+          str(G_filt.num_vertices()) + ' nodes and ' + str(G_filt.num_edges()) + ' edges')
+    print(df.to_string(index=False))
+    
+    return df
+    
+
+def benchmark_bitmaps(num_tweets=10**8, set_sizes=(10**6, 10**7, 3*10**7), 
+                      num_repeat=3, seed=0):
+    """ times the operations of `TwBitmaps.Bitmap` on random sets of tweet 
+        rows of size set_sizes and compares them with the numpy set functions.
+        
+        Returns a dataframe with the best time of each operation (in seconds).
+    """
+    from TwBitmaps import Bitmap
+    
+    rng = np.random.RandomState(seed)
+    
+    rows = [np.unique(rng.randint(0, num_tweets, size)) for size in set_sizes]
+    bitmaps = [Bitmap.from_rows(r) for r in rows]
+    
+    operations = {'intersection': (lambda a, b: a & b, 
+                                   lambda a, b: np.intersect1d(a, b, assume_unique=True)),
+                  'union': (lambda a, b: a | b, np.union1d),
+                  'difference': (lambda a, b: a - b, 
+                                 lambda a, b: np.setdiff1d(a, b, assume_unique=True))}
+    
+    results = []
+    for i in range(len(set_sizes) - 1):
+        for name, (bitmap_op, numpy_op) in operations.items():
+            times = {'bitmap': [], 'numpy': []}
+            for _ in range(num_repeat):
+                t0 = time.time()
+                bitmap_op(bitmaps[i], bitmaps[-1])
+                times['bitmap'].append(time.time() - t0)
+                
+                t0 = time.time()
+                numpy_op(rows[i], rows[-1])
+                times['numpy'].append(time.time() - t0)
+                
+            results.append({'size': len(rows[i]), 'operation': name,
+                            'bitmap': min(times['bitmap']), 'numpy': min(times['numpy'])})
+            
+    df = pd.DataFrame(results, columns=['size', 'operation', 'bitmap', 'numpy'])
+    
+    print('\nset operations with a set of ' + str(len(rows[-1])) + ' rows out of ' + 
+          str(num_tweets) + ' tweets')
+    print(df.to_string(index=False))
+    
+    return df
+    
+    
+def random_tweets(num_tweets=100000, seed=0):
+    """ returns a list of random tweet-like texts with mentions, urls, 
+        hashtags, emoticons, html entities and lengthened words
+    """
+    rng = np.random.RandomState(seed)
+    
+    words = ['the', 'vote', 'great', 'AGAIN', 'election', 'tonight', 'debate', 
+             'sooooo', 'sad!!!!', '#Trump2016', '#ImWithHer', '@realDonaldTrump',
+             '@HillaryClinton', 'https://t.co/x8Gh2kLq', ':)', ':-D', '<3', 
+             '&amp;', 'RT', "can't", '...', '😀']
+    words += ['w' + str(i) for i in range(5000)]
+    
+    return [' '.join(rng.choice(words, size=rng.randint(5, 25))) for _ in range(num_tweets)]
+    
+    
+def benchmark_tokenizer(texts=None, ncpu=None):
+    """ reports the number of tweets tokenized per second by 
+        `CustomTweetTokenizer.tokenize` and `tokenize_batch` (with 1 and ncpu
+        processes), with the settings of `buildTrainingSet`. 
+        
+        Returns a dataframe with the tweets/s of each method.
+    """
+    from multiprocessing import cpu_count
+    from TwSentiment import CustomTweetTokenizer
+    
+    if texts is None:
+        texts = random_tweets()
+    if ncpu is None:
+        ncpu = max(cpu_count()-1, 1)
+        
+    tokenizer = CustomTweetTokenizer(preserve_case=False, reduce_len=True, 
+                                     strip_handles=False, normalize_usernames=False, 
+                                     normalize_urls=False, keep_allupper=False)
+    
+    methods = [('tokenize', lambda: [tokenizer.tokenize(t) for t in texts]),
+               ('tokenize_batch', lambda: tokenizer.tokenize_batch(texts))]
+    if ncpu > 1:
+        methods.append(('tokenize_batch ncpu=' + str(ncpu), 
+                        lambda: tokenizer.tokenize_batch(texts, ncpu=ncpu)))
+    
+    results = []
+    for name, method in methods:
+        t0 = time.time()
+        method()
+        results.append({'method': name, 'tweets/s': len(texts)/(time.time() - t0)})
+        
+    df = pd.DataFrame(results, columns=['method', 'tweets/s'])
+    
+    print('\ntokenizing ' + str(len(texts)) + ' tweets')
+    print(df.to_string(index=False))
+    
+    return df
+    
+    
+def p_val_reference_grid(N_values=(200, 2000, 20000), max_n2=400, num_r=7):
+    """ returns an array of (N, n1, n2, r) rows covering small and large
+        ratios of occurrences and co-occurrences below and above the mode.
+        n2 is limited to max_n2 since `p_val_np` is quadratic in n2.
+    """
+    grid = []
+    for N in N_values:
+        for n1_ratio in [0.01, 0.05, 0.3, 0.9]:
+            for n2_ratio in [0.2, 1.0]:
+                n1 = max(1, int(N*n1_ratio))
+                n2 = min(max(1, int(n1*n2_ratio)), max_n2)
+                for r in np.unique(np.linspace(1, n2, num_r).astype(int)):
+                    grid.append((N, n1, n2, r))
+
+    return np.array(grid, dtype=np.int64)
+
+
+def validate_p_val(grid=None):
+    """ compares `log_p_val` with `p_val_np` on a grid of (N, n1, n2, r).
+
+        Returns a dataframe with the grid, both values of log10(p) and
+        their absolute difference.
+    """
+    from HTCoocNetwork import p_val_np, log_p_val
+
+    if grid is None:
+        grid = p_val_reference_grid()
+
+    t0 = time.time()
+    log10_p_ref = np.array([np.log10(p_val_np(*[int(x) for x in row])) for row in grid],
+                           dtype=np.float64)
+    time_ref = time.time() - t0
+
+    t0 = time.time()
+    log10_p = log_p_val(grid[:,0], grid[:,1], grid[:,2], grid[:,3])/np.log(10)
+    time_vect = time.time() - t0
+
+    df = pd.DataFrame(grid, columns=['N', 'n1', 'n2', 'r'])
+    df['log10_p_ref'] = log10_p_ref
+    df['log10_p'] = log10_p
+    df['abs_error'] = np.abs(log10_p - log10_p_ref)
+
+    print('\np-values of ' + str(len(grid)) + ' edges')
+    print('p_val_np  : ' + '{:.4}'.format(time_ref) + 's')
+    print('log_p_val : ' + '{:.4}'.format(time_vect) + 's')
+    print('max absolute error on log10(p): ' + '{:.3}'.format(df.abs_error.max()))
+
+    return df
+
+
+def random_large_counts(N=10**7, num_edges=10000, max_z=20, seed=0):
+    """ returns an array of (N, n1, n2, r) rows with occurrences of up to N 
+        and co-occurrences up to max_z standard deviations above the mean.
+    """
+    rng = np.random.RandomState(seed)
+    
+    n1 = rng.randint(1000, N, num_edges)
+    n2 = np.maximum((n1*rng.rand(num_edges)).astype(np.int64), 1)
+    mean = n1*n2/N
+    std = np.sqrt(n2*(n1/N)*(1 - n1/N)*(N - n2)/(N - 1))
+    r = np.clip((mean + rng.rand(num_edges)*max_z*std).astype(np.int64), 0, n2)
+    
+    return np.column_stack((np.full(num_edges, N), n1, n2, r))
+    
+
+def benchmark_p_val_tiers(accuracy=1e-2, large_grid=None):
+    """ accuracy and speed of `log_p_val_tiered` compared to `p_val_np` on 
+        the reference grid (with the approximation tier used for all edges) 
+        and to `log_p_val` on edges with large counts (`random_large_counts`),
+        where `p_val_np` is too slow.
+        
+        Returns a dataframe with the time, the max absolute error on log10(p)
+        and the number of approximated edges for each method.
+    """
+    from HTCoocNetwork import p_val_np, log_p_val, log_p_val_tiered
+    
+    results = []
+    
+    grid = p_val_reference_grid()
+    
+    t0 = time.time()
+    log10_p_ref = np.array([np.log10(p_val_np(*[int(x) for x in row])) for row in grid],
+                           dtype=np.float64)
+    results.append({'edges': 'reference grid', 'method': 'p_val_np', 
+                    'time': time.time() - t0, 'max_error': 0.0, 'num_approximated': 0})
+    
+    t0 = time.time()
+    log_p, tiers = log_p_val_tiered(grid[:,0], grid[:,1], grid[:,2], grid[:,3], 
+                                    accuracy=accuracy, min_terms=0, return_tiers=True)
+    results.append({'edges': 'reference grid', 'method': 'tiered', 
+                    'time': time.time() - t0, 
+                    'max_error': np.abs(log_p/np.log(10) - log10_p_ref).max(), 
+                    'num_approximated': int((tiers == 1).sum())})
+    
+    if large_grid is None:
+        large_grid = random_large_counts()
+    N, n1, n2, r = large_grid.T
+    
+    t0 = time.time()
+    log_p_ref = log_p_val(N, n1, n2, r)
+    results.append({'edges': 'large counts', 'method': 'log_p_val', 
+                    'time': time.time() - t0, 'max_error': 0.0, 'num_approximated': 0})
+    
+    t0 = time.time()
+    log_p, tiers = log_p_val_tiered(N, n1, n2, r, accuracy=accuracy, return_tiers=True)
+    results.append({'edges': 'large counts', 'method': 'tiered', 
+                    'time': time.time() - t0, 
+                    'max_error': np.abs(log_p - log_p_ref).max()/np.log(10), 
+                    'num_approximated': int((tiers == 1).sum())})
+    
+    df = pd.DataFrame(results, columns=['edges', 'method', 'time', 'max_error', 
+                                        'num_approximated'])
+    
+    print('\ntiered p-values with accuracy ' + str(accuracy) + ' on log10(p)')
+    print('reference grid: ' + str(len(grid)) + ' edges, large counts: ' + 
+          str(len(large_grid)) + ' edges')
+    print(df.to_string(index=False))
+    
+    return df
+    
+
+if __name__ == '__main__':
+
+    validate_p_val()
+    
+    benchmark_p_val_tiers()
+    
+    benchmark_graph_filtering()
+    
+    benchmark_bitmaps()
+    
+    benchmark_tokenizer()
+
+    if len(sys.argv) > 1:
+        benchmark_graph_io(sys.argv[1])
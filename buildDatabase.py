@@ -8,6 +8,7 @@ from TwSqliteDB import updateSqliteTables, createIndexes
 import sqlite3
 
 
+from progressMonitor import ProgressMonitor
 from baseModule import baseModule
 
 class buildDatabse(baseModule):
@@ -20,6 +21,11 @@ class buildDatabse(baseModule):
         listed in `tweet_archive_dirs` and add them to the database 
         `sqlite_db_filename`. If the database already exists, it 
         will be updated with new tweets.
+        
+        *Optional parameters:*
+        
+        :metrics_file: file where a JSON summary of the ingestion rate is
+                       appended. Default is None.
     """
     
     def run(self):
@@ -41,6 +47,8 @@ class buildDatabse(baseModule):
         DROP_ALL_INDEXES = self.job.get('DROP_ALL_INDEXES', True)
         # create indexes after updating
         CREATE_INDEXES = self.job.get('CREATE_INDEXES', True)
+        # file with performance metrics
+        metrics_file = self.job.get('metrics_file', None)
         
         
         
@@ -121,8 +129,6 @@ class buildDatabse(baseModule):
                 
         # start building (updating database)        
         try:
-            t0 = time.time()
-
             with sqlite3.connect(sqlite_db_filename, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn:
             
                 
@@ -135,12 +141,10 @@ class buildDatabse(baseModule):
                 
                 c.fetchall()
                 
-                
+                monitor = ProgressMonitor('ingestion', total=len(files), unit='files',
+                                          cost_key_name='size_MB')
                 
                 for i, file in enumerate(files):
-                    print(str(i) + ' over ' + str(len(files)))
-                    
-                    t2 = time.time()
                     
                     updateSqliteTables(conn, file,
                                        filenames_dict=filenames_dict,
@@ -160,13 +164,11 @@ class buildDatabse(baseModule):
                                        update_tweet_to_query_table=True)
                     
                 
-                    print('Transaction time ' + "{:.6}".format(time.time()-t2) + 's')
-                    
-                    print('Total time ' + "{:.6}".format(time.time()-t0) + 's')
+                    conn.commit()
                     
-                    print('sqlite_file : ' + sqlite_db_filename)
+                    monitor.update(1, cost_keys=os.path.getsize(file)/1e6)
                 
-                    conn.commit()
+                monitor.close(metrics_file)
         
         except sqlite3.OperationalError as err:
             print(err)
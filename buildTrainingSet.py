@@ -2,21 +2,53 @@
 # License: BSD 3 clause
 
 
-from TwSentiment import CustomTweetTokenizer, bag_of_words_and_bigrams
-from sklearn.feature_extraction import DictVectorizer
-from sklearn.externals import joblib
+from TwSentiment import CustomTweetTokenizer, bag_of_words_and_bigrams, \
+                        hashed_bag_of_words_and_bigrams, extract_features, \
+                        features_from_matrix, text_hash
 
-import pickle
 import time
+from multiprocessing import cpu_count
 import numpy as np
 import sqlite3
 import random
+from itertools import chain
 import pandas as pd
-from TwSentiment import official_twitter_clients
+from TwSqliteDB import getHashtagLabelNames, iterTweetTexts
+from TwBitmaps import getTweetBitmaps, loadTweetBitmaps, saveTweetBitmaps, \
+                      tweetBitmapsFilename
+from functools import partial
 
 
 from baseModule import baseModule
+from artifactCache import save_pickle, save_array, save_sparse_array
 
+def reservoir_sample(iterable, k, rng=random):
+    """ returns a uniform random sample of k items of iterable (all of them 
+        if there are less than k) in one pass, keeping at most k items in 
+        memory (reservoir sampling), using the random generator rng 
+    """
+    reservoir = []
+    for i, item in enumerate(iterable):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = item
+                
+    return reservoir
+    
+def unique_texts(texts):
+    """ yields the texts that were not already yielded (compared by their
+        `text_hash`)
+    """
+    seen = set()
+    for text in texts:
+        h = text_hash(text)
+        if h not in seen:
+            seen.add(h)
+            yield text
+    
 class buildTrainingSet(baseModule):
     """ Create the tweet training set from the labeled hashtags.
     
@@ -29,18 +61,41 @@ class buildTrainingSet(baseModule):
         extract the features and labels of each tweets and saves them in 
         `features_pickle_file` and `labels_pickle_file`, respectively.
         Vectorized versions of the features and labels are saved to `features_vect_file` 
-        and `labels_vect_file` for the cross-validation. A mapper between label names
-        and label number is saved to `labels_mappers_file`.
+        and `labels_vect_file` for the cross-validation, as raw .npy files that are 
+        memory-mapped when loaded (the CSR arrays of the features are saved next to 
+        `features_vect_file` with the suffixes `_data.npy`, `_indices.npy` and 
+        `_indptr.npy`). A mapper between label names and label number is saved to 
+        `labels_mappers_file`.
         
         *Optional parameters:*
         
-        :column_name_ht_group: If the optional parameter `column_name_ht_group` 
-                               has been changed in `job` in the step before, 
-                               it will be used here to select the corresponding hashtag 
-                               lists.
+        :hashtag_labeling: If the optional parameter `hashtag_labeling` 
+                           (or its older alias `column_name_ht_group`) has been 
+                           changed in `job` in the step before, it will be used
+                           here to select the corresponding labeling of hashtags.
         :undersample_maj_class: whether to undersample the majority class in order
                                  to balance the training set. Default is True, if False, unbalanced training 
                                  set will be used and class weight will be adjusted accrodingly during training.
+                                 The texts are streamed from the database and 
+                                 only the sampled ones are kept in memory.
+        :random_seed: seed of the undersampling. Default is 19.
+        :dedup_training_texts: if True, identical texts are kept only once in
+                               each class of the training set. Default is False.
+        :ncpu: number of processes used to tokenize the tweets and extract 
+               their features (default is the number of cpus minus one).
+        :feature_hashing: if True, the tokens and bigrams are directly mapped 
+                          to `n_hashed_features` hashed columns (integer 
+                          feature ids from `hashed_bag_of_words_and_bigrams`, 
+                          without the dictionaries of features) and only the 
+                          vectorized features are saved (not `features_pickle_file`).
+                          `trainClassifier` must then be run with the same 
+                          option. Default is False.
+        :n_hashed_features: number of columns of the hashed features. Default
+                            is 2**20.
+        :tweet_bitmaps_file: where the bitmaps of the sets of tweets (camps,
+                             retweets, official clients, days) are saved, see
+                             `TwBitmaps`. Default is `sqlite_db_filename` with
+                             the suffix `_bitmaps.npz`.
          
         see http://scikit-learn.org/0.18/modules/generated/sklearn.linear_model.SGDClassifier.html
         
@@ -64,106 +119,107 @@ class buildTrainingSet(baseModule):
         #==============================================================================
         # OPTIONAL PARAMETERS
         #==============================================================================        
-        column_name = self.job.get('column_name_ht_group', 'ht_class')
+        labeling = self.job.get('hashtag_labeling', self.job.get('column_name_ht_group', 'ht_class'))
         
         # whether to undersample the majority class in order to balanced
         # the training set. Default is True, if False, unbalanced training
         # set will be used and class weight adjusted accrodingly during
         # training(http://scikit-learn.org/stable/modules/generated/sklearn.linear_model.SGDClassifier.html)
         undersample_maj_class = self.job.get('undersample_maj_class', True)
+        # seed of the undersampling
+        random_seed = self.job.get('random_seed', 19)
+        # keep only one copy of identical texts
+        dedup_training_texts = self.job.get('dedup_training_texts', False)
         
-        #find label names
-        with sqlite3.connect(sqlite_file, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn:
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT({col_name}) FROM hashtag_tweet_user".format(col_name=column_name))
-            label_names = [ln for (ln,) in c.fetchall() if ln is not None]
-
-        if len(label_names)>2:
-            raise Exception("Cannot manage more than 2 groups")
-        
-        
-        values_0 = sorted(label_names)
-        label_0 = values_0[0]
-        values_1 = sorted(label_names, reverse=True)
-        label_1 = values_1[0]
-        
-        # select tweets in one camp but not in the other camp and that
-        # are not retweets and that where sent from official twitter clients
-        source_contents = "','".join(official_twitter_clients)
-        
-        sql_query = """SELECT text FROM tweet WHERE tweet_id IN (SELECT * FROM (
-                                                                              SELECT tweet_id
-                                                                              FROM hashtag_tweet_user
-                                                                              WHERE {cname} == ?
-                                                                              )                                            
-                                                               EXCEPT
-                                                               SELECT * FROM (
-                                                                              SELECT tweet_id
-                                                                              FROM hashtag_tweet_user
-                                                                              WHERE {cname} == ?                                                       
-                                                                              UNION ALL
-                                                                              SELECT tweet_id
-                                                                              FROM tweet_to_retweeted_uid
-                                                                              )
-                                                               )
-                                               AND source_content_id IN (
-                                                                         SELECT id 
-                                                                         FROM source_content
-                                                                         WHERE source_content IN ('{sc_seq}')
-                                                                         )
-                                                               """.format(cname=column_name,
-                                                                          sc_seq=source_contents)
+        # number of processes for the feature extraction
+        ncpu = self.job.get('ncpu', cpu_count()-1)
         
+        # map features directly to hashed columns
+        feature_hashing = self.job.get('feature_hashing', False)
+        n_hashed_features = self.job.get('n_hashed_features', 2**20)
         
+        # where the bitmaps of the sets of tweets are saved
+        tweet_bitmaps_file = self.job.get('tweet_bitmaps_file', 
+                                          tweetBitmapsFilename(sqlite_file))
         
         with sqlite3.connect(sqlite_file,
                              detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn:
+            
+            #find label names
+            label_names = getHashtagLabelNames(conn, labeling)
+            
+            if len(label_names) == 0:
+                raise Exception("No labeled hashtags for the labeling '" + labeling + 
+                                "', run `updateHTGroups` first")
+            
+            if len(label_names)>2:
+                raise Exception("Cannot manage more than 2 groups")
+            
+            label_0 = label_names[0]
+            label_1 = label_names[-1]
+            
+            tb = getTweetBitmaps(conn, tweet_bitmaps_file, labeling,
+                                 load=partial(self.load_artifact, loader=loadTweetBitmaps),
+                                 save=partial(self.save_artifact, saver=saveTweetBitmaps))
+            
+            # select tweets in one camp but not in the other camp and that
+            # are not retweets and that where sent from official twitter clients
+            camp_0 = tb.camp(labeling, label_0)
+            camp_1 = tb.camp(labeling, label_1)
+            
+            sel_pro_1 = (camp_0 - camp_1 - tb['retweet']) & tb['official_client']
+            sel_pro_2 = (camp_1 - camp_0 - tb['retweet']) & tb['official_client']
+            
             c = conn.cursor()
             
-            # fist camp
-            c.execute(sql_query, values_0)
-                
-            # make sure there no Retweets
-            tweet_texts_pro_1 = [t for (t,) in c.fetchall() if t[:2] != 'RT']
-                                     
             #get hashtags
-            c.execute("SELECT DISTINCT hashtag FROM hashtag_tweet_user WHERE {cname} = ?".format(cname=column_name),
-                          [label_0])
+            c.execute("SELECT hashtag FROM hashtag_label WHERE labeling = ? AND label = ?",
+                          [labeling, label_0])
             
             htgs_pro_1 = [ht for (ht,) in c.fetchall()]
                
-            # second camp
-            
-            c.execute(sql_query, values_1)
-            
-            tweet_texts_pro_2 = [t for (t,) in c.fetchall() if t[:2] != 'RT']
-            
-            c.execute("SELECT DISTINCT hashtag FROM hashtag_tweet_user WHERE {cname} = ?".format(cname=column_name),
-                          [label_1])
+            c.execute("SELECT hashtag FROM hashtag_label WHERE labeling = ? AND label = ?",
+                          [labeling, label_1])
             
             htgs_pro_2 = [ht for (ht,) in c.fetchall()]
             
-     
-                          
-        
-        #%% balance set
-        print('Num tweets 1: ' + str(len(tweet_texts_pro_1)))
-        print('Num tweets 2: ' + str(len(tweet_texts_pro_2)))
-        
-        if undersample_maj_class:
-            print('Balancing sets by undersampling the majority class')                       
-            num_tweets = min( len(tweet_texts_pro_1), len(tweet_texts_pro_2))
-        
-        
-            # sub sample pro_trump
-            random.seed(19)
+            print('Num tweets 1: ' + str(len(sel_pro_1)))
+            print('Num tweets 2: ' + str(len(sel_pro_2)))
             
-            tweet_texts_pro_1_sample = random.sample(tweet_texts_pro_1, num_tweets)
-            tweet_texts_pro_2_sample = random.sample(tweet_texts_pro_2, num_tweets)
+            # stream the texts of each camp, making sure there no Retweets
+            tweet_texts_pro_1 = (t for t in iterTweetTexts(c, chain.from_iterable(
+                                 tb.iter_tweet_ids(sel_pro_1))) if t[:2] != 'RT')
+            tweet_texts_pro_2 = (t for t in iterTweetTexts(c, chain.from_iterable(
+                                 tb.iter_tweet_ids(sel_pro_2))) if t[:2] != 'RT')
             
-        else:
-            tweet_texts_pro_1_sample = tweet_texts_pro_1
-            tweet_texts_pro_2_sample = tweet_texts_pro_2
+            if dedup_training_texts:
+                tweet_texts_pro_1 = unique_texts(tweet_texts_pro_1)
+                tweet_texts_pro_2 = unique_texts(tweet_texts_pro_2)
+            
+            #%% balance set
+            if undersample_maj_class:
+                print('Balancing sets by undersampling the majority class')                       
+                num_tweets = min(len(sel_pro_1), len(sel_pro_2))
+                
+                # only num_tweets texts of each camp are kept in memory
+                rng = random.Random(random_seed)
+                
+                tweet_texts_pro_1_sample = reservoir_sample(tweet_texts_pro_1, num_tweets, rng)
+                tweet_texts_pro_2_sample = reservoir_sample(tweet_texts_pro_2, num_tweets, rng)
+                
+                # removed Retweets can make one of the samples smaller
+                num_tweets = min(len(tweet_texts_pro_1_sample), len(tweet_texts_pro_2_sample))
+                if len(tweet_texts_pro_1_sample) > num_tweets:
+                    tweet_texts_pro_1_sample = rng.sample(tweet_texts_pro_1_sample, num_tweets)
+                if len(tweet_texts_pro_2_sample) > num_tweets:
+                    tweet_texts_pro_2_sample = rng.sample(tweet_texts_pro_2_sample, num_tweets)
+                    
+            else:
+                tweet_texts_pro_1_sample = list(tweet_texts_pro_1)
+                tweet_texts_pro_2_sample = list(tweet_texts_pro_2)
+                
+        print('Num tweets in the training set: ' + str(len(tweet_texts_pro_1_sample)) + 
+              ', ' + str(len(tweet_texts_pro_2_sample)))
             
         feats_dict_list = [{'label': label_0, 'text': text} for text in tweet_texts_pro_1_sample]
         feats_dict_list.extend([{'label': label_1, 'text': text} for text in tweet_texts_pro_2_sample])
@@ -178,25 +234,6 @@ class buildTrainingSet(baseModule):
         all_hashtags.extend(htgs_pro_2)
         
         
-        def process_tweet(tweet_text, tokenizer=CustomTweetTokenizer(preserve_case=False,
-                                         reduce_len=True, 
-                                         strip_handles=False,
-                                         normalize_usernames=False, 
-                                         normalize_urls=False, 
-                                         keep_allupper=False),
-                            feature_extractor=bag_of_words_and_bigrams):
-            
-            tokens = tokenizer.tokenize(tweet_text)
-            tokens_to_keep = []
-            for token in tokens:
-                #remove hastags that are used for classifying
-                if token[0] == '#':
-                    if token[1:] in all_hashtags:
-                        continue
-                tokens_to_keep.append(token)
-            
-            return bag_of_words_and_bigrams(tokens_to_keep)
-        
         label_mapper = {label_0: 0, label_1: 1}
         label_inv_mapper = {0 : label_0 , 1 : label_1}
         
@@ -206,36 +243,55 @@ class buildTrainingSet(baseModule):
             return np.array([mapper[l] for l in labels])
             
         labels = df.label.tolist()
-        features = [process_tweet(t) for t in df.text.tolist()]
-                
-        with open(features_pickle_file, 'wb') as fopen:
-            pickle.dump(features, fopen)
         
-        with open(labels_pickle_file, 'wb') as fopen:
-            pickle.dump(labels, fopen)
+        print('\nExtracting features')
+        
+        t = time.time()
         
-        with open(labels_mappers_file, 'wb') as fopen:
-            pickle.dump({'label_mapper': label_mapper,
-                         'label_inv_mapper': label_inv_mapper}, fopen)            
+        tokenizer = CustomTweetTokenizer(preserve_case=False,
+                                         reduce_len=True, 
+                                         strip_handles=False,
+                                         normalize_usernames=False, 
+                                         normalize_urls=False, 
+                                         keep_allupper=False)
+        
+        if feature_hashing:
+            # integer feature ids
+            feature_extractor = partial(hashed_bag_of_words_and_bigrams,
+                                        n_features=n_hashed_features)
+        else:
+            feature_extractor = bag_of_words_and_bigrams
             
-        y = label_transformer(labels)
+        # remove hastags that are used for classifying
+        X, feature_names = extract_features(df.text.tolist(), tokenizer=tokenizer,
+                                            feature_extractor=feature_extractor,
+                                            excluded_hashtags=all_hashtags, 
+                                            ncpu=ncpu, dtype=np.int8,
+                                            n_features=n_hashed_features if \
+                                                       feature_hashing else None)
         
-        print('\nVectorizing features')
+        self.print_elapsed_time(t)
         
-        t = time.time()
+        if not feature_hashing:
+            features = features_from_matrix(X, feature_names)
+                
+            self.save_artifact(features, features_pickle_file, save_pickle)
         
-        vect = DictVectorizer(dtype=np.int8, sparse=True, sort=False)
-        X = vect.fit_transform(features)
+        self.save_artifact(labels, labels_pickle_file, save_pickle)
         
-        self.print_elapsed_time(t)
+        self.save_artifact({'label_mapper': label_mapper,
+                            'label_inv_mapper': label_inv_mapper}, 
+                           labels_mappers_file, save_pickle)
+            
+        y = label_transformer(labels)
         
         print('Num samples x Num features')
         print(X.shape)
         
 
-        # memmaping of the features
-        joblib.dump(X, features_vect_file)
-        joblib.dump(y, labels_vect_file)
+        # raw arrays of the features and labels, memory-mapped when loaded
+        self.save_artifact(X, features_vect_file, save_sparse_array)
+        self.save_artifact(y, labels_vect_file, save_array)
 
         
      
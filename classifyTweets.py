@@ -14,7 +14,12 @@ from datetime import datetime
 import time
 import numpy as np
 
+from progressMonitor import ProgressMonitor
 from baseModule import baseModule
+from artifactCache import file_digest
+from TwSentiment import text_hash, bag_of_words_and_bigrams
+from TwSqliteDB import createTextProbaCacheTable, getCachedTextProba, \
+                       setCachedTextProba
 
 class classifyTweets(baseModule):
     """ Classify each tweets and updates the SQLite database with the results.
@@ -30,6 +35,24 @@ class classifyTweets(baseModule):
         :propa_table_name_suffix: add a suffix to the created table names in order to
                                   compare different classifiers.
                                   Default is '' (empty string).
+        :metrics_file: file where a JSON summary of the classification rate is
+                       appended. Default is None.
+        :dedup_texts: if True, identical texts (e.g. retweets and copy-pasted
+                      tweets) are tokenized and classified only once per batch
+                      and their probability is copied to all their tweets. 
+                      Default is True.
+        :text_proba_cache: if True (and `dedup_texts` is True), the probabilities 
+                           of the texts are also stored in the table 
+                           `text_proba_cache` of the database, keyed by the 
+                           hash of the text and of the classifier file, and 
+                           reused across batches and runs. The table is 
+                           never pruned: when a classifier is retired, its
+                           rows can be removed with 
+                           `TwSqliteDB.deleteCachedTextProba(cursor, 
+                           artifactCache.file_digest(classifier_filename))`
+                           and the whole table dropped with 
+                           `TwSqliteDB.deleteCachedTextProba(cursor)`.
+                           Default is False.
     """
     
     def run(self):
@@ -46,13 +69,21 @@ class classifyTweets(baseModule):
         propa_col_name = self.job.get('propa_col_name','p_1')
         # name suffix of the table with the classification probabilities
         propa_table_name_suffix = self.job.get('propa_table_name_suffix', '')
+        # file with performance metrics
+        metrics_file = self.job.get('metrics_file', None)
+        # classify each distinct text only once
+        dedup_texts = self.job.get('dedup_texts', True)
+        # persistent cache of the probabilities of the texts
+        text_proba_cache = self.job.get('text_proba_cache', False) and dedup_texts
 
         #load classifier
         print('loading ' + classifier_filename )
-        cls = joblib.load(classifier_filename)
+        cls = self.load_artifact(classifier_filename, joblib.load)
         
         classifier = cls['sklearn_pipeline']
         label_inv_mapper = cls['label_inv_mapper']
+        # classifiers trained on hashed features give their feature extractor
+        feature_extractor = cls.get('feature_extractor', bag_of_words_and_bigrams)
         
         # number of tweets to classify per batch
         select_limit = 10000
@@ -61,7 +92,16 @@ class classifyTweets(baseModule):
         # connection timout for sqlite
         conn_timeout = 60
         
-        TweetClass = TweetClassifier(classifier=classifier, label_inv_mapper=label_inv_mapper)
+        TweetClass = TweetClassifier(classifier=classifier, feature_extractor=feature_extractor,
+                                     label_inv_mapper=label_inv_mapper)
+        
+        if text_proba_cache:
+            # identifies the classifier in the cache
+            classifier_id = file_digest(classifier_filename)
+            print('caching text probabilities of classifier ' + classifier_id)
+            with sqlite3.connect(sqlite_file, timeout=conn_timeout) as conn:
+                createTextProbaCacheTable(conn.cursor())
+                conn.commit()
         
         # first classify retweets, then tweets
         for CLASS_RETWEETS in [True, False]:
@@ -120,31 +160,56 @@ class classifyTweets(baseModule):
             
             t0 = time.time()
             
+            monitor = ProgressMonitor('classification of ' + table_select, 
+                                      total=num_row - offset_start, unit='tweets')
+            
             # start classifying using bunch of `select_limit`
             for i, offset in enumerate(range(offset_start, num_row, select_limit)):
-                print(str(i) + ' over ' + str((num_row - offset_start)/select_limit))
-                print('** row : ' + str(offset) + ' to ' + str(offset+select_limit-1))
-                print('\ntotal time : ' + str(time.time() - t0))
-                print('getting tweets from {tbs}'.format(tbs=table_select))
                 with sqlite3.connect(sqlite_file, timeout=conn_timeout,
                                      detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn:
                     c = conn.cursor()
                     c.execute('PRAGMA synchronous = NORMAL')
                     c.execute(sql_select, (select_limit, offset))
                     df = pd.DataFrame(data=c.fetchall(), columns=['tweet_id', 'user_id', 'text'])
+                    
+                    if dedup_texts:
+                        texts = df.text.tolist()
+                        hashes, first_index, inverse = np.unique([text_hash(text) for text in texts],
+                                                                 return_index=True,
+                                                                 return_inverse=True)
+                        # probabilities of the distinct texts
+                        distinct_probs = np.full(hashes.size, np.nan)
+                        if text_proba_cache:
+                            cached = getCachedTextProba(c, classifier_id, hashes)
+                            if len(cached) > 0:
+                                distinct_probs = np.array([cached.get(h, np.nan) for h in hashes.tolist()])
+                        
+                        to_classify = np.isnan(distinct_probs)
 
                 
                 conn.close()
                 
-                #compute classification probability
-                predict_proba = TweetClass.classify_text(df.text.tolist(), return_pred_labels=False)
+                if dedup_texts:
+                    if to_classify.any():
+                        #compute classification probability of the new distinct texts
+                        predict_proba = TweetClass.classify_text([texts[j] for j in first_index[to_classify]],
+                                                                 return_pred_labels=False)
+                        distinct_probs[to_classify] = predict_proba[:,1]
+                    
+                    #prob pro 1
+                    probs = distinct_probs[inverse].tolist()
+                    
+                    monitor.count('distinct_texts', hashes.size)
+                    monitor.count('classified_texts', to_classify.sum())
+                else:
+                    #compute classification probability
+                    predict_proba = TweetClass.classify_text(df.text.tolist(), return_pred_labels=False)
                 
-                #prob pro 1
-                probs = predict_proba[:,1].tolist()
+                    #prob pro 1
+                    probs = predict_proba[:,1].tolist()
                 
                 values = [(int(tid), int(uid), float(p)) for tid, uid, p in zip(df.tweet_id.tolist(), df.user_id.tolist(), probs)]
                 
-                print('updating {tbn}'.format(tbn=table_insert))
                 with sqlite3.connect(sqlite_file,
                                      timeout=conn_timeout,
                                      detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn_cp:
@@ -155,9 +220,20 @@ class classifyTweets(baseModule):
                     # insert values
                     c_cp.executemany(sql_insert, values)
                     
+                    if text_proba_cache and to_classify.any():
+                        setCachedTextProba(c_cp, classifier_id, hashes[to_classify],
+                                           distinct_probs[to_classify])
+                    
                     conn_cp.commit()
+                    
+                monitor.update(len(values))
                 
-            
+            if dedup_texts and monitor.done > 0:
+                print('distinct texts: {:.2%}, classified texts: {:.2%} of the {n} tweets'.format(
+                      monitor.counters['distinct_texts']/monitor.done,
+                      monitor.counters['classified_texts']/monitor.done, n=monitor.done))
+                
+            monitor.close(metrics_file)
             print('finished')
             self.print_elapsed_time(t0)
 
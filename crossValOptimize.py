@@ -5,7 +5,8 @@
 from sklearn.linear_model import SGDClassifier
 from sklearn.model_selection import KFold, GridSearchCV
 from sklearn.pipeline import Pipeline
-from sklearn.externals import joblib
+from sklearn.metrics import get_scorer
+from sklearn.externals.joblib import Parallel, delayed
 
 import time
 import numpy as np
@@ -13,6 +14,33 @@ import ujson as json
 from multiprocessing import cpu_count
 
 from baseModule import baseModule
+from artifactCache import load_array, load_sparse_array
+
+def regularization_path_scores(X, y, train, test, alphas, scoring, 
+                               path_n_iter, **classifier_params):
+    """ fits a SGDClassifier on the samples train of X for each value of 
+        alphas (in decreasing order), starting from the coefficients of the 
+        previous alpha (warm start), and returns the scores on the samples test.
+        
+        The first alpha is fitted with the n_iter of classifier_params and the 
+        following ones with path_n_iter iterations.
+    """
+    X_train, y_train = X[train], y[train]
+    X_test, y_test = X[test], y[test]
+    
+    scorer = get_scorer(scoring)
+    classifier = SGDClassifier(warm_start=True, **classifier_params)
+    
+    scores = []
+    for i, alpha in enumerate(alphas):
+        if i == 1:
+            classifier.set_params(n_iter=path_n_iter)
+        classifier.set_params(alpha=alpha)
+        classifier.fit(X_train, y_train)
+        
+        scores.append(scorer(classifier, X_test, y_test))
+        
+    return scores
 
 class crossValOptimize(baseModule):
     """ Cross-validation of the classifier.
@@ -45,6 +73,17 @@ class crossValOptimize(baseModule):
                                  regularization strength (`alpha`) between 1e-1 and 1e-7 
                                  with 20 logarithmically spaced steps.
         :verbose: verbosity level of the calssifier (default is 1).
+        :regularization_path: if True, instead of fitting the classifier 
+                              from scratch for each value of `alpha` (the only 
+                              parameter in `grid_search_parameters`), each fold 
+                              is fitted once along the decreasing values of 
+                              `alpha`, starting from the coefficients of the 
+                              previous value (warm start). The folds are fitted 
+                              in parallel on the memory-mapped features. 
+                              Default is False.
+        :path_n_iter: number of iterations for each value of `alpha` after the 
+                      first one with `regularization_path`. Default is 
+                      `n_iter/5` (at least 1).
 
         See the sklearn Stochastic Gradient Descent user guide 
         (http://scikit-learn.org/0.18/modules/sgd.html#sgd) for recommended settings,
@@ -64,9 +103,9 @@ class crossValOptimize(baseModule):
         best_params_file = self.job['best_params_file']
         
         # loading the memmaped  features
-        X = joblib.load(features_vect_file)
+        X = self.load_artifact(features_vect_file, load_sparse_array)
     
-        y = joblib.load(labels_vect_file)
+        y = self.load_artifact(labels_vect_file, load_array)
         
         #==============================================================================
         # OPTIONAL PARAMETERS
@@ -95,6 +134,10 @@ class crossValOptimize(baseModule):
         
         verbose = self.job.get('CV_verbose', 1)
         
+        # warm-started regularization path instead of the grid search
+        regularization_path = self.job.get('regularization_path', False)
+        path_n_iter = self.job.get('path_n_iter', max(1, n_iter//5))
+        
         # wether to undersample the majority class or to adjust class_weights        
         undersample_maj_class = self.job.get('undersample_maj_class', True)
         
@@ -120,24 +163,33 @@ class crossValOptimize(baseModule):
     
         kfold = KFold(n_splits=n_splits, shuffle=True, random_state=34)
         
-        #
-        # Auto Grid Search
-        #
-        self.grid_search = GridSearchCV(estimator=pipeline, param_grid=grid_search_parameters, cv=kfold,
-                                   scoring=scoring, verbose=0 , n_jobs=ncpu)
-        
-        print("\nPerforming grid search...")
-        print("pipeline:", [name for name, _ in pipeline.steps])
-        print("parameters:")
-        print(grid_search_parameters)
-        t0 = time.time()
-        self.grid_search.fit(X, y)
+        if regularization_path:
+            best_score, best_parameters_np = self.regularization_path_search(X, y, 
+                                kfold, grid_search_parameters, scoring, ncpu, 
+                                path_n_iter, verbose=verbose, loss=loss, 
+                                n_iter=n_iter, penalty=penalty, 
+                                class_weight=class_weight)
+        else:
+            #
+            # Auto Grid Search
+            #
+            self.grid_search = GridSearchCV(estimator=pipeline, param_grid=grid_search_parameters, cv=kfold,
+                                       scoring=scoring, verbose=0 , n_jobs=ncpu)
+            
+            print("\nPerforming grid search...")
+            print("pipeline:", [name for name, _ in pipeline.steps])
+            print("parameters:")
+            print(grid_search_parameters)
+            t0 = time.time()
+            self.grid_search.fit(X, y)
+            
+            self.print_elapsed_time(t0)
         
-        self.print_elapsed_time(t0)
-    
-        print("\nBest score: %0.3f" % self.grid_search.best_score_)
+            best_score = self.grid_search.best_score_
+            best_parameters_np = self.grid_search.best_estimator_.get_params()
+            
+        print("\nBest score: %0.3f" % best_score)
         print("Best parameters set:")
-        best_parameters_np = self.grid_search.best_estimator_.get_params()
         
         # prepare dictionary with best parameters default values
         self.best_parameters = {'classifier__loss': loss, 'classifier__penalty': penalty,
@@ -157,6 +209,50 @@ class crossValOptimize(baseModule):
         # save best params to JSON file
         with open(best_params_file, 'w') as fopen:
             json.dump(self.best_parameters, fopen)
+            
+    def regularization_path_search(self, X, y, kfold, grid_search_parameters, 
+                                   scoring, ncpu, path_n_iter, **classifier_params):
+        """ cross-validation of the values of alpha in grid_search_parameters 
+            along warm-started regularization paths (see 
+            `regularization_path_scores`), with one job per fold.
+            
+            Returns the best mean score and a dictionary with the best alpha, 
+            as the grid search. The mean scores are kept in `self.path_scores`.
+        """
+        if set(grid_search_parameters.keys()) != {'classifier__alpha'}:
+            raise Exception("`regularization_path` can only optimize `classifier__alpha`")
+            
+        alphas = np.asarray(grid_search_parameters['classifier__alpha'], dtype=float)
+        # from the strongest to the weakest regularization
+        path_order = np.argsort(-alphas, kind='mergesort')
+        
+        folds = list(kfold.split(X, y))
+        
+        print("\nPerforming regularization path search...")
+        print("parameters:")
+        print(grid_search_parameters)
+        t0 = time.time()
+        
+        # X is memory-mapped and shared with the jobs
+        fold_scores = Parallel(n_jobs=ncpu)(delayed(regularization_path_scores)(X, y, 
+                                            train, test, alphas[path_order], scoring, 
+                                            path_n_iter, **classifier_params) \
+                                            for train, test in folds)
+        
+        self.print_elapsed_time(t0)
+        
+        # mean over folds weighted by the number of test samples (as GridSearchCV)
+        scores = np.empty((len(folds), alphas.size))
+        scores[:, path_order] = np.array(fold_scores)
+        mean_scores = np.average(scores, axis=0, 
+                                 weights=[test.size for _, test in folds])
+        
+        self.path_scores = dict(zip(alphas.tolist(), mean_scores.tolist()))
+        
+        # first best value in the order of grid_search_parameters
+        best = np.argmax(mean_scores)
+        
+        return mean_scores[best], {'classifier__alpha': alphas[best]}
 
 
         
@@ -35,7 +35,7 @@ tweet_archive_dirs = ['etrade']
 sqlite_file = os.path.join(project_dir, 'test.sqlite')
 
 # hashtag co-occurrence graph that will be created
-graph_file = os.path.join(project_dir, 'graph_file.graphml')
+graph_file = os.path.join(project_dir, 'graph_file.npz')
 
 # pickle files where the training set features will be saved
 features_pickle_file = os.path.join(project_dir, 'features.pickle')
@@ -72,6 +72,10 @@ df_num_tweets_filename = os.path.join(project_dir, 'df_num_tweets.pickle')
 # DataFrame with the number of users in each camp per day
 df_num_users_filename = os.path.join(project_dir, 'df_num_users.pickle')
 
+# JSON lines file where the long loops (ingestion, significance, classification)
+# write a summary of their throughput
+metrics_file = os.path.join(project_dir, 'metrics.jsonl')
+
 
 job = {'tweet_archive_dirs': tweet_archive_dirs,
        'sqlite_db_filename' : sqlite_file,
@@ -86,9 +90,15 @@ job = {'tweet_archive_dirs': tweet_archive_dirs,
        'df_proba_filename':df_proba_filename,
        'df_num_tweets_filename': df_num_tweets_filename,
        'df_num_users_filename': df_num_users_filename,
-       'best_params_file' : best_params_file
+       'best_params_file' : best_params_file,
+       'metrics_file' : metrics_file
        }
 
+# The stages run in the same session share an in-process cache of the 
+# artifacts they load and save (graph, propagation results, features, 
+# classifier, ...) that are reloaded only if their file changed. Add 
+# 'use_artifact_cache' : False to job to always load them from disk.
+
 raise Exception
 
 #%% build database
@@ -100,7 +110,9 @@ buildDatabse(job).run()
 #%% make HT network
 # Reads all the co-occurences from the SQLite database and builds the network 
 # of where nodes are hashtags and edges are co-occurrences. 
-# The graph is a graph-tool object and is saved in graphml format to graph_file.
+# The graph is a `HTCoocNetwork.HTGraph` object and is saved in binary format to graph_file
+# (`.npz` numpy archive or `.gt` graph-tool format, depending on the extension).
+# graph-tool is only required for the `.gt` format and for GraphML exports.
 # Nodes of the graph have two properties: `counts` is the number of single 
 # occurrences of the hashtag and `name` is the name of the hashtag.
 # Edges have a property `weights` equal to the number of co-occurrences they represent.
@@ -127,10 +139,25 @@ makeHTNetwork(job).run()
 # The computation is done using `p0=1e-6` and `p0` is saved as a graph property.
 # Different values of `p0` can be tested latter.
 # The resulting graph is saved to `graph_file`.
+# Each p-value is computed once per unique triple of counts and saved in a
+# table alongside the graph to be reused by later runs.
 #
 # *Optional parameters that can be added to `job`:*
-# - `ncpu` : number of processors to be used. (Default is the number of cores 
-# on your machine minus 1).
+# - `p_val_method` : 'log' to compute the p-values of all edges at once in log
+# space, 'tiered' to approximate the p-values of edges with large counts when 
+# the error on the significance is smaller than `p_val_accuracy` (Default is 
+# 0.01), or 'exact' to use the exact summation for each edge. (Default is 'log').
+# - `ncpu` : number of processors to be used. Edges are split into chunks of 
+# similar computational cost. (Default is the number of cores on your machine
+# minus 1).
+# - `incremental_significance` : if True, only the edges whose counts changed 
+# since the last run are recomputed, the others are rescaled to the new number 
+# of tweets when the error bound on their significance is smaller than 
+# `max_rescale_error` (Default is 0.01). (Default is False).
+# - `pval_table_file` : file where the p-values are saved to be reused by later
+# runs. (Default is `graph_file` with the suffix `_pval_table.npz`).
+# - `graphml_file` : if given, the graph is also exported in GraphML format to
+# this file, e.g. for visualization. (Default is None).
 #
 # [1] Martinez-Romo, J. et al. Disentangling categorical relationships through 
 # a graph of co-occurrences. Phys. Rev. E 84, 1–8 (2011).
@@ -175,6 +202,20 @@ job['htgs_lists'] = job['initial_htgs_lists']
 #           (Default = 0.001).
 #        - `p0` : significance threshold. to keep only edges with p_val <= p0. 
 #           (Default = 1e-5).
+#        - `max_rounds` : if given, the loop is done automatically: the camps
+#           are replaced by the hashtags satisfying the rule of step 2 until 
+#           they do not change or after `max_rounds` rounds. The resulting lists
+#           are in `propagateLabels(job).htgs_lists` and the hashtags added or
+#           dropped at each round are saved in `propag_rounds_filename`. The 
+#           number of hashtags added per round and camp can be limited with 
+#           `max_new_per_round` and `min_new_count`, and the size of the camps 
+#           with `num_top_htgs` (as in step 2). With `reevaluate_labels=False`,
+#           hashtags are only added. (Default is None).
+#        - `sweep_p0_values`, `sweep_count_ratio_values` : lists of values of 
+#           `p0` and `count_ratio`. If given, the propagation is computed in one
+#           pass for all the pairs of values and saved in `propag_sweep_filename`
+#           with a row per pair of values and hashtag. The column `camp` gives 
+#           the camp selected by the rule of step 2. (Default is None).
 #
 # 2. Visualisation of the results using `selectHashtags`, and updating the 
 #    `htgs_lists` list. This will print a list of hashtags, $i$, for each camp 
@@ -212,13 +253,25 @@ job['htgs_lists'] = [['mortgage', 'rates', 'loan', 'loans', 'lenders', 'amortiza
 # loop end               
 #******************
 
+# alternatively, the loop can be done automatically with `max_rounds`:
+# job['max_rounds'] = 10
+# propag = propagateLabels(job)
+# propag.run()
+# job['htgs_lists'] = propag.htgs_lists
+
 #%% update HT group in database
 # `updateHTGroups` takes the lists of hashtags `htgs_lists` and mark then in 
-# the database `sqlite_db_filename`.
+# the database `sqlite_db_filename`, in the table `hashtag_label`.
 #
 # *Optional parameters that can be added to `job`:*
-# - `column_name_ht_group` : name of the column added to the database (Default 
-#   is `'ht_class'`). Different names can be used to test different `htgs_list`.
+# - `hashtag_labeling` : name of the labeling (Default is `'ht_class'`). 
+#   Different names can be used to test different `htgs_list`. The old key 
+#   `column_name_ht_group` is still accepted. Databases labeled with columns of
+#   `hashtag_tweet_user` (older versions) are migrated to `hashtag_label` when 
+#   the labeling is first read.
+# The camp of each tweet is also materialized in the table `tweet_camp`, used
+# to compute the bitmaps of the camps (see `TwBitmaps`). It is rebuilt when the 
+# labeling changes.
 
        
 updateHTGroups(job).run()
@@ -229,16 +282,30 @@ updateHTGroups(job).run()
 # extract the features and labels of each tweets and saves them in 
 # `features_pickle_file` and `labels_pickle_file`, respectively.
 # Vectorized versions of the features and labels are saved to `features_vect_file` 
-# and `labels_vect_file` for the cross-validation. A mapper between label names
-# and label number is saved to `labels_mappers_file`.
+# and `labels_vect_file` for the cross-validation, as raw .npy files that are 
+# memory-mapped when loaded (the CSR arrays of the features are saved next to 
+# `features_vect_file` with the suffixes `_data.npy`, `_indices.npy` and 
+# `_indptr.npy`). A mapper between label names and label number is saved to 
+# `labels_mappers_file`.
 #
 # *Optional parameters:*
-# - If the optional parameter `column_name_ht_group` has been changed in `job` 
+# - If the optional parameter `hashtag_labeling` has been changed in `job` 
 #   in the step before, it will be used here to select the corresponding hashtag 
 #   lists.
 # - `undersample_maj_class` : whether to undersample the majority class in order
 #   to balance the training set. Default is True, if False, unbalanced training 
 #   set will be used and class weight will be adjusted accrodingly during training.
+#   Texts are streamed from the database and only the sampled ones are kept in 
+#   memory. `random_seed` (Default is 19) makes the sampling reproducible.
+# - `ncpu` : number of processes used to tokenize the tweets and extract their 
+#   features. Default is the number of cpus minus one.
+# - `feature_hashing` : if True, tokens and bigrams are directly mapped to 
+#   `n_hashed_features` (Default 2**20) hashed columns (integer feature ids 
+#   instead of dictionaries of features) and the features are only 
+#   saved in vectorized form. Must also be set for `trainClassifier`. 
+#   Default is False.
+# - `dedup_training_texts` : if True, identical texts are kept only once in each
+#   class of the training set. Default is False.
 # (see http://scikit-learn.org/0.18/modules/generated/sklearn.linear_model.SGDClassifier.html) 
 
 buildTrainingSet(job).run()
@@ -268,6 +335,13 @@ buildTrainingSet(job).run()
 #   regularization strength (`alpha`) between 1e-1 and 1e-7 with 20 
 #   logarithmically spaced steps.
 # - `verbose` : verbosity level of the calssifier (default is 1).
+# - `regularization_path` : if True, each fold is fitted once along the 
+#   decreasing values of `alpha`, starting from the coefficients of the previous 
+#   value (warm start), instead of from scratch for each value. The folds run in 
+#   parallel on the memory-mapped features. Only `classifier__alpha` can be in 
+#   `grid_search_parameters`. Default is False.
+# - `path_n_iter` : number of iterations for each value of `alpha` after the 
+#   first one with `regularization_path`. Default is `n_iter/5`.
 
 # See the sklearn Stochastic Gradient Descent user guide 
 # (http://scikit-learn.org/0.18/modules/sgd.html#sgd) for recommended settings,
@@ -286,6 +360,11 @@ crossValOptimize(job).run()
 # Uses features and labels from `features_pickle_file` and `labels_pickle_file`
 # to train the classifier using the parameters from `best_params_file`.
 # The trained classifier is then saved to `classifier_filename`.
+#
+# *Optional parameters:*
+# - `feature_hashing` : if True, trains directly on the hashed features of 
+#   `features_vect_file` (see `buildTrainingSet`). The integer feature extractor
+#   is saved with the classifier and used by `classifyTweets`. Default is False.
 
 trainClassifier(job).run()
 
@@ -297,6 +376,15 @@ trainClassifier(job).run()
 # *Optional parameters:*
 # - `propa_table_name_suffix` : add a suffix to the two table names in order to
 # compare different classifiers. Default is '' (empty string).
+# - `dedup_texts` : identical texts are classified only once per batch. 
+#   Default is True.
+# - `text_proba_cache` : the probabilities of the texts are stored in the table 
+#   `text_proba_cache` for each classifier file and reused in later batches and 
+#   runs. The table is never pruned, the rows of a retired classifier can be 
+#   deleted with `TwSqliteDB.deleteCachedTextProba(cursor, classifier_id)`, 
+#   where `classifier_id` is `artifactCache.file_digest(classifier_filename)` 
+#   (printed when caching), and the whole table dropped with 
+#   `TwSqliteDB.deleteCachedTextProba(cursor)`. Default is False.
 
 classifyTweets(job).run()
 
@@ -316,8 +404,12 @@ classifyTweets(job).run()
 #   clients (`True`) or all tweets (`False`). Default is `True`.
 # - `propa_table_name_suffix` can be changed to use the classification of 
 #   different classifiers if it was used with `classifyTweets`.
-# - `column_name_ht_group` is also used if it was changed to create a different 
+# - `hashtag_labeling` is also used if it was changed to create a different 
 #   training set.
+# - `tweet_bitmaps_file` : where the bitmaps of the sets of tweets (camps, 
+#   retweets, official clients, days) are saved. They are computed once and 
+#   also used by `buildTrainingSet` and `analyzeProbaDF`. Default is 
+#   `sqlite_db_filename` with the suffix `_bitmaps.npz`.
 
        
 makeProbaDF(job).run()
@@ -338,6 +430,10 @@ makeProbaDF(job).run()
 #   p < 1-threshold are classified in camp1. Default is 0.5.
 # - `r_threshold` : threshold for the ratio of classified tweets needed to 
 #   classify a user. Default is 0.5.
+# - `use_tweet_bitmaps` : if True (and `resampling_frequency` is `'D'`), the 
+#   number of tweets per day is computed from the bitmaps of the days of the 
+#   database `sqlite_db_filename`, tweets not in the database are then not 
+#   counted and duplicated tweets are counted once. Default is False.
 
        
 analyzeProbaDF(job).run()
@@ -2,13 +2,13 @@
 # License: BSD 3 clause
 
 import time
-import graph_tool.all as gt
 import sqlite3
 import numpy as np
 import pandas as pd
 from itertools import combinations
 from collections import Counter
 
+from HTCoocNetwork import HTGraph, save_graph
 from baseModule import baseModule
 
 class makeHTNetwork(baseModule):
@@ -19,7 +19,8 @@ class makeHTNetwork(baseModule):
     
         Reads all the co-occurences from the SQLite database and builds the network 
         of where nodes are hashtags and edges are co-occurrences. 
-        The graph is a graph-tool object and is saved in graphml format to graph_file.
+        The graph is a `HTCoocNetwork.HTGraph` object and is saved in binary format to graph_file
+        (`.npz` numpy archive or `.gt` graph-tool format, depending on the extension).
         Nodes of the graph have two properties: `counts` is the number of single 
         occurrences of the hashtag and `name` is the name of the hashtag.
         Edges have a property `weights` equal to the number of co-occurrences they represent.
@@ -102,27 +103,15 @@ class makeHTNetwork(baseModule):
         
         print('creating graph')
         t0 = time.time()
-        self.G = gt.Graph(directed=False)
+        self.G = HTGraph.from_edge_list(edges_list_weigths[:,:2],
+                                        weights=edges_list_weigths[:,2].astype(np.int64))
         
-        e_weights = self.G.new_edge_property('int') 
+        ht_names = self.G.vp.names
         
-        self.G.vp['names'] = self.G.add_edge_list(edges_list_weigths, hashed=True, 
-                                            string_vals=True, eprops=e_weights)
-        
-        e_weights.a = edges_list_weigths[:,2]
-        
-        self.G.ep['weights'] = e_weights
-        
-        ht_names = self.G.vp.names.get_2d_array([0])
-        
-        self.G.graph_properties['Ntweets'] = self.G.new_graph_property('int')
-        self.G.graph_properties['Ntweets'] = df.tweet_id.unique().size
-        self.G.graph_properties['start_date'] = self.G.new_graph_property('object')
-        self.G.graph_properties['start_date'] = start_date
-        self.G.graph_properties['stop_date'] = self.G.new_graph_property('object')
-        self.G.graph_properties['stop_date'] = stop_date
-        self.G.graph_properties['weight_threshold'] = self.G.new_graph_property('int')
-        self.G.graph_properties['weight_threshold'] = weight_threshold
+        self.G.gp['Ntweets'] = int(df.tweet_id.unique().size)
+        self.G.gp['start_date'] = start_date
+        self.G.gp['stop_date'] = stop_date
+        self.G.gp['weight_threshold'] = weight_threshold
         
         self.print_elapsed_time(t0)
         
@@ -142,15 +131,13 @@ class makeHTNetwork(baseModule):
         
         
         #add counts to Graph vertex
-        v_counts = self.G.new_vertex_property('int', val=0)
         ht_counts_names = np.array(df_ht_counts.hashtag.tolist())
         sorter = np.argsort(ht_counts_names)
-        v_counts.a = df_ht_counts.iloc[sorter[np.searchsorted(ht_counts_names, 
-                                             ht_names, sorter=sorter)].flatten()]['count']
-        self.G.vp['counts'] = v_counts
+        self.G.vp['counts'] = df_ht_counts.iloc[sorter[np.searchsorted(ht_counts_names, 
+                                             ht_names, sorter=sorter)].flatten()]['count'].values.astype(np.int64)
         
         # save graph file
-        self.G.save(graph_file, fmt='graphml')
+        self.save_artifact(self.G, graph_file, save_graph)
         
         print('\nNumber of nodes: ' + str(self.G.num_vertices()))
         print('Number of edges: ' + str(self.G.num_edges()))
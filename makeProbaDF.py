@@ -5,6 +5,10 @@ import sqlite3
 import pandas as pd
 import time
 from TwSentiment import official_twitter_clients
+from TwSqliteDB import getHashtagLabelNames
+from TwBitmaps import getTweetBitmaps, loadTweetBitmaps, saveTweetBitmaps, \
+                      tweetBitmapsFilename
+from functools import partial
 
 from baseModule import baseModule
 
@@ -33,8 +37,13 @@ class makeProbaDF(baseModule):
         :propa_table_name_suffix: can be changed to use the classification of 
                                    different classifiers if it was used with 
                                    `classifyTweets`.
-        :column_name_ht_group: is also used if it was changed to create a different 
-                                training set.
+        :hashtag_labeling: name of the labeling of hashtags, is also used if it 
+                           was changed to create a different training set 
+                           (`column_name_ht_group` is an alias kept for older 
+                           jobs).
+        :tweet_bitmaps_file: where the bitmaps of the sets of tweets are saved 
+                             (see `TwBitmaps`). Default is `sqlite_db_filename` 
+                             with the suffix `_bitmaps.npz`.
     """
     
     def run(self):
@@ -52,9 +61,12 @@ class makeProbaDF(baseModule):
         USE_OFFICIAL_CLIENTS = self.job.get('use_official_clients',True)
         
         propa_col_name = self.job.get('propa_col_name','p_1')
-        ht_group_col_name = self.job.get('column_name_ht_group', 'ht_class')
+        labeling = self.job.get('hashtag_labeling', self.job.get('column_name_ht_group', 'ht_class'))
         # name suffix of the table with the classification probabilities
         propa_table_name_suffix = self.job.get('propa_table_name_suffix', '')
+        # where the bitmaps of the sets of tweets are saved
+        tweet_bitmaps_file = self.job.get('tweet_bitmaps_file', 
+                                          tweetBitmapsFilename(sqlite_file))
         
         ######
         # define sql queries
@@ -100,20 +112,6 @@ class makeProbaDF(baseModule):
                                                                                cptb=class_proba_table_name,
                                                                                pcolname=propa_col_name)
         
-        
-        # select tweets with labeled hashtags
-        sql_query_hashtag = """SELECT * FROM (
-                                      SELECT tweet_id
-                                      FROM hashtag_tweet_user
-                                      WHERE {cname} == ?
-                                      )                                            
-                               EXCEPT
-                               SELECT * FROM (
-                                      SELECT tweet_id
-                                      FROM hashtag_tweet_user
-                                      WHERE {cname} == ?
-                                      )
-                                      """.format(cname=ht_group_col_name)
                        
         #################
         # querying sqlite
@@ -124,12 +122,18 @@ class makeProbaDF(baseModule):
         with sqlite3.connect(sqlite_file, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES) as conn:
             
             # find labels name
-            c = conn.cursor()
-            c.execute("SELECT DISTINCT({col_name}) FROM hashtag_tweet_user".format(col_name=ht_group_col_name))
-            label_names = [ln for (ln,) in c.fetchall() if ln is not None]
+            label_names = getHashtagLabelNames(conn, labeling)
+            if len(label_names) == 0:
+                raise Exception("No labeled hashtags for the labeling '" + labeling + 
+                                "', run `updateHTGroups` first")
             if len(label_names)>2:
                 raise Exception("Cannot manage more than 2 groups")                           
                     
+            # bitmaps of the tweets with labeled hashtags
+            tb = getTweetBitmaps(conn, tweet_bitmaps_file, labeling,
+                                 load=partial(self.load_artifact, loader=loadTweetBitmaps),
+                                 save=partial(self.save_artifact, saver=saveTweetBitmaps))
+            
             print('creating df proba')
             df_proba = pd.read_sql(sql_query, conn, params=params)    
                 
@@ -141,13 +145,11 @@ class makeProbaDF(baseModule):
             df_proba_rt = pd.read_sql(sql_query_retweets, conn)
             self.print_elapsed_time(t0)
             
-            print('creating df_proba_ht_pro_0')
-            df_proba_ht_pro_0 = pd.read_sql(sql_query_hashtag, conn, params=sorted(label_names))
-            self.print_elapsed_time(t0)
-            
-            print('creating df_proba_ht_pro_1')
-            df_proba_ht_pro_1 = pd.read_sql(sql_query_hashtag, conn, params=sorted(label_names, reverse=True))
-            self.print_elapsed_time(t0)
+            # tweets in one camp but not in the other camp
+            camp_0 = tb.camp(labeling, label_names[0])
+            camp_1 = tb.camp(labeling, label_names[-1])
+            ht_pro_0 = camp_0 - camp_1
+            ht_pro_1 = camp_1 - camp_0
         
                                                       
 
@@ -177,12 +179,13 @@ class makeProbaDF(baseModule):
                          
         #%% correct probabilites for hashtags
         
-        self.df_proba_all.loc[self.df_proba_all.tweet_id.isin(df_proba_ht_pro_1.tweet_id), propa_col_name] = 1.0
-        self.df_proba_all.loc[self.df_proba_all.tweet_id.isin(df_proba_ht_pro_0.tweet_id), propa_col_name] = 0.0
+        rows = tb.rows_of(self.df_proba_all.tweet_id.values)
+        self.df_proba_all.loc[ht_pro_1.contains(rows), propa_col_name] = 1.0
+        self.df_proba_all.loc[ht_pro_0.contains(rows), propa_col_name] = 0.0
 
         #save                             
         print('saving corrected dataframe')
-        self.df_proba_all.to_pickle(df_proba_filename)
+        self.save_artifact(self.df_proba_all, df_proba_filename, pd.to_pickle)
         print('done')
         self.print_elapsed_time(t0)
                          
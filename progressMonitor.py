@@ -0,0 +1,154 @@
+# Author: Alexandre Bovet <alexandre.bovet@gmail.com>
+# License: BSD 3 clause
+
+"""
+Progress reports and throughput metrics for long loops.
+
+    monitor = ProgressMonitor('significance', total=num_edges, unit='edges')
+    for chunk in chunks:
+        ...
+        monitor.update(len(chunk), cost_keys=n2[chunk])
+    monitor.close(metrics_file)
+
+Progress lines (done, rate, ETA) are printed at most every `min_interval`
+seconds. Optional cost keys (e.g. the number of occurrences n2 of the
+hashtags of an edge) are binned by powers of 2 to report how the time is
+distributed. `close` prints a summary and appends it as a JSON line to
+the metrics file. Other quantities (e.g. the number of distinct items) can
+be accumulated with `count` and are added to the summary.
+"""
+
+import time
+import json
+import numpy as np
+
+
+class ProgressMonitor(object):
+    """ Rate-limited progress and throughput metrics of a loop (see module docstring) """
+
+    def __init__(self, name, total=None, unit='items', min_interval=5.0,
+                 cost_key_name='cost'):
+
+        self.name = name
+        self.total = None if total is None else int(total)
+        self.unit = unit
+        self.min_interval = min_interval
+        self.cost_key_name = cost_key_name
+
+        self.done = 0
+        self.t0 = time.time()
+        self._last_update = self.t0
+        self._last_report = self.t0
+
+        # number of items and time spent per cost bin
+        self._bin_counts = dict()
+        self._bin_times = dict()
+
+        # other counters added to the summary
+        self.counters = dict()
+
+    def elapsed(self):
+        return time.time() - self.t0
+
+    def rate(self):
+        elapsed = self.elapsed()
+        if elapsed == 0:
+            return 0.0
+        return self.done/elapsed
+
+    def eta(self):
+        """ estimated remaining time in seconds (None if total is unknown) """
+        rate = self.rate()
+        if self.total is None or rate == 0:
+            return None
+        return max(self.total - self.done, 0)/rate
+
+    def update(self, n=1, cost_keys=None, elapsed=None):
+        """ records that n more items were processed.
+
+            cost_keys is a scalar or an array with the cost key of each item.
+            The time spent since the last update (or elapsed if given) is
+            attributed to the cost bins of the items.
+        """
+        now = time.time()
+        if elapsed is None:
+            elapsed = now - self._last_update
+        self._last_update = now
+
+        self.done += int(n)
+
+        if cost_keys is not None:
+            cost_keys = np.atleast_1d(cost_keys)
+            bins = np.floor(np.log2(np.maximum(cost_keys, 1))).astype(np.int64)
+            bin_values, bin_counts = np.unique(bins, return_counts=True)
+            for b, c in zip(bin_values.tolist(), bin_counts.tolist()):
+                self._bin_counts[b] = self._bin_counts.get(b, 0) + c
+                self._bin_times[b] = self._bin_times.get(b, 0.0) + elapsed*c/cost_keys.size
+
+        if now - self._last_report >= self.min_interval:
+            self._last_report = now
+            self.report()
+
+    def count(self, counter_name, n=1):
+        """ adds n to the counter counter_name """
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + int(n)
+
+    def report(self):
+
+        line = self.name + ': ' + str(self.done)
+        if self.total is not None:
+            line += ' over ' + str(self.total) + ' ' + self.unit + \
+                    ' ({:.1%})'.format(self.done/max(self.total, 1))
+        else:
+            line += ' ' + self.unit
+        line += ' | {:.4g} '.format(self.rate()) + self.unit + '/s'
+
+        eta = self.eta()
+        if eta is not None:
+            line += ' | ETA {:.0f}s'.format(eta)
+
+        print(line)
+
+    def cost_distribution(self):
+        """ returns a list of dictionaries with the number of items and the
+            time spent for each cost bin [2**b, 2**(b+1))
+        """
+        return [{self.cost_key_name + '_min': 2**b,
+                 self.cost_key_name + '_max': 2**(b+1),
+                 'count': self._bin_counts[b],
+                 'time': self._bin_times[b]} for b in sorted(self._bin_counts.keys())]
+
+    def summary(self):
+        return {'name': self.name,
+                'unit': self.unit,
+                'total': self.total,
+                'done': self.done,
+                'elapsed': self.elapsed(),
+                'rate': self.rate(),
+                'start_time': self.t0,
+                'cost_distribution': self.cost_distribution(),
+                'counters': dict(self.counters)}
+
+    def close(self, metrics_file=None):
+        """ prints the summary and appends it to metrics_file as a JSON line """
+
+        summary = self.summary()
+
+        print(self.name + ': ' + str(self.done) + ' ' + self.unit + ' in ' +
+              '{:.4}'.format(summary['elapsed']) + 's ({:.4g} '.format(summary['rate']) +
+              self.unit + '/s)')
+
+        for cost_bin in summary['cost_distribution']:
+            print('    ' + self.cost_key_name + ' in [' + str(cost_bin[self.cost_key_name + '_min']) +
+                  ', ' + str(cost_bin[self.cost_key_name + '_max']) + '): ' +
+                  str(cost_bin['count']) + ' ' + self.unit + ', ' +
+                  '{:.4}'.format(cost_bin['time']) + 's')
+
+        for counter_name, value in sorted(summary['counters'].items()):
+            print('    ' + counter_name + ': ' + str(value))
+
+        if metrics_file is not None:
+            with open(metrics_file, 'a') as fopen:
+                fopen.write(json.dumps(summary) + '\n')
+
+        return summary
@@ -1,9 +1,12 @@
 # Author: Alexandre Bovet <alexandre.bovet@gmail.com>
 # License: BSD 3 clause
 
-import graph_tool.all as gt
+import os
 import numpy as np
-from HTCoocNetwork import propagates_labels, find_vertices_from_hashtags
+import pandas as pd
+from HTCoocNetwork import propagates_labels, find_vertices_from_hashtags, load_graph, \
+                          propagates_labels_iteratively, significant_subgraph, \
+                          propagation_sweep
 
 from baseModule import baseModule
 
@@ -27,6 +30,36 @@ class propagateLabels(baseModule):
                       (Default = 0.001).
         :p0: significance threshold. to keep only edges with p_val <= p0. 
              (Default = 1e-5).
+        :max_rounds: if given, the propagation is iterated automatically: at 
+                     each round, the camps are replaced by the hashtags 
+                     satisfying the selection rule of `selectHashtags`, as in
+                     the manual loop, until the camps do not change or after 
+                     `max_rounds` rounds. The final lists of hashtags are in 
+                     `self.htgs_lists` and the results have the additional 
+                     columns `label_final` and `round`. (Default is None, a 
+                     single propagation).
+        :reevaluate_labels: if False, hashtags are only added to the camps and 
+                            never dropped during the iterations. (Default is True).
+        :num_top_htgs: maximum number of hashtags (with the largest counts) kept
+                       in each camp during the iterations, as in 
+                       `selectHashtags`. (Default is None).
+        :max_new_per_round: maximum number of hashtags (with the largest counts)
+                            added to each camp per round. (Default is None).
+        :min_new_count: minimum number of occurrences of the hashtags added at 
+                        each round. (Default is 0).
+        :propag_rounds_filename: filename of the pandas DataFrame with the 
+                                 hashtags added at each round. (Default is 
+                                 `propag_results_filename` with the suffix 
+                                 `_rounds`).
+        :sweep_p0_values, sweep_count_ratio_values: if both are given, the 
+                     propagation is computed in one pass for the grid of p0 and
+                     count_ratio values and the results are saved in a pandas
+                     DataFrame with a row per grid point and hashtag having 
+                     labeled neighbors (see `HTCoocNetwork.propagation_sweep`).
+                     (Default is None).
+        :propag_sweep_filename: filename of the results of the sweep. (Default 
+                                is `propag_results_filename` with the suffix 
+                                `_sweep`).
     """    
     
     def run(self):
@@ -50,49 +83,77 @@ class propagateLabels(baseModule):
         
         # significance threshold (keep only edges with p_val <= p0)
         p0 = self.job.get('p0', 1e-5)
-
         
-        G = gt.load_graph(graph_file)
-        # array with hashtags names
-        ht_names = G.vp.names.get_2d_array([0])
+        # automatic iterations of the propagation
+        max_rounds = self.job.get('max_rounds', None)
+        max_new_per_round = self.job.get('max_new_per_round', None)
+        min_new_count = self.job.get('min_new_count', 0)
+        reevaluate_labels = self.job.get('reevaluate_labels', True)
+        num_top_htgs = self.job.get('num_top_htgs', None)
+        propag_rounds_filename = self.job.get('propag_rounds_filename',
+                        os.path.splitext(propag_results_filename)[0] + '_rounds' + \
+                        os.path.splitext(propag_results_filename)[1])
 
+        # sweep over p0 and count_ratio values
+        sweep_p0_values = self.job.get('sweep_p0_values', None)
+        sweep_count_ratio_values = self.job.get('sweep_count_ratio_values', None)
+        propag_sweep_filename = self.job.get('propag_sweep_filename',
+                        os.path.splitext(propag_results_filename)[0] + '_sweep' + \
+                        os.path.splitext(propag_results_filename)[1])
+        
+        G = self.load_artifact(graph_file, load_graph)
         
         # list of max counts for each camp
         initial_max_counts = []
         for htgs_list in initial_htgs_lists:
             #find the maximum number of occurence for each camp
-            initial_max_counts.append(np.max(G.vp.counts.a[np.in1d(ht_names, htgs_list)]).tolist())
+            initial_max_counts.append(np.max(G.vp.counts[find_vertices_from_hashtags(G, htgs_list)]).tolist())
                 
+        if sweep_p0_values is not None and sweep_count_ratio_values is not None:
+            # the loaded graph is shared with the artifact cache
+            G = G.shallow_copy()
+            G.vp['label_init'] = np.full(G.num_vertices(), -1, dtype=np.int64)
+            for label, htgs in enumerate(initial_htgs_lists):
+                G.vp['label_init'][find_vertices_from_hashtags(G, htgs)] = label+1
+                
+            print('Propagating labels for ' + str(len(sweep_p0_values)*len(sweep_count_ratio_values)) +
+                  ' pairs of p0 and count_ratio values')
+            self.df_sweep = propagation_sweep(G, sweep_p0_values, sweep_count_ratio_values,
+                                              init_label_vp='label_init')
+            
+            print('saving results')
+            self.save_artifact(self.df_sweep, propag_sweep_filename, pd.to_pickle)
+            return
+        
+        if max_rounds is not None:
+            self.run_iterations(G, initial_htgs_lists, count_ratio, p0, max_rounds,
+                                max_new_per_round, min_new_count, 
+                                propag_results_filename, propag_rounds_filename,
+                                reevaluate_labels=reevaluate_labels,
+                                max_per_label=num_top_htgs)
+            return
+        
         ################
         # filter network
         ################
         
-        #remove nodes with not enough counts (occurence)
-        Gfilt = gt.GraphView(G, 
-                    vfilt=lambda v: G.vp.counts[v] >= count_ratio*min(initial_max_counts),
-                    )
-        
-        
-        #filter significance        
-        s0 = np.log10(Gfilt.gp.p0/p0)
-        #shift significance accordind to new p0 value
-        Gfilt.ep.s.a  = Gfilt.ep.s.a - s0
-        
-        Gfilt = gt.GraphView(Gfilt, efilt=lambda e: Gfilt.ep.s[e] >= 0)
-
+        # significance threshold for the new p0 value
+        s0 = np.log10(G.gp.p0/p0)
         
-        G_final = gt.Graph(Gfilt, prune=True)
+        # remove nodes with not enough counts (occurence) and non-significant
+        # edges, the significance is shifted according to the new p0 value
+        G_final = significant_subgraph(G, s0=s0, 
+                                       min_count=count_ratio*min(initial_max_counts))
         
         #######################
         # propagate labels
         #######################
         
         # add initial labels tp Graph
-        G_final.vp['label_init'] = G_final.new_vertex_property('int', val = -1)
+        G_final.vp['label_init'] = np.full(G_final.num_vertices(), -1, dtype=np.int64)
         
         for label, htgs in enumerate(initial_htgs_lists):
-            for v in find_vertices_from_hashtags(G_final, htgs):
-                G_final.vp['label_init'][v] = label+1
+            G_final.vp['label_init'][find_vertices_from_hashtags(G_final, htgs)] = label+1
         
         # propagate
         print('Propagating labels')
@@ -100,7 +161,40 @@ class propagateLabels(baseModule):
         
         #save results
         print('saving results')
-        self.df_prop.to_pickle(propag_results_filename)
+        self.save_artifact(self.df_prop, propag_results_filename, pd.to_pickle)
+        
+    def run_iterations(self, G, initial_htgs_lists, count_ratio, p0, max_rounds,
+                       max_new_per_round, min_new_count, propag_results_filename, 
+                       propag_rounds_filename, reevaluate_labels=True, max_per_label=None):
+        """ iterates the propagation until the camps do not change (see `max_rounds`) """
         
+        # filter significance, the count threshold is updated at each round
+        s0 = np.log10(G.gp.p0/p0)
+        G_final = significant_subgraph(G, s0=s0)
         
+        G_final.vp['label_init'] = np.full(G_final.num_vertices(), -1, dtype=np.int64)
+        
+        for label, htgs in enumerate(initial_htgs_lists):
+            G_final.vp['label_init'][find_vertices_from_hashtags(G_final, htgs)] = label+1
+            
+        print('Propagating labels')
+        self.df_prop, self.df_rounds = propagates_labels_iteratively(G_final, 
+                                                init_label_vp='label_init',
+                                                count_ratio=count_ratio,
+                                                max_rounds=max_rounds,
+                                                max_new_per_round=max_new_per_round,
+                                                min_new_count=min_new_count,
+                                                reevaluate_labels=reevaluate_labels,
+                                                max_per_label=max_per_label)
+        
+        # final lists of hashtags for each camp
+        self.htgs_lists = [self.df_prop.name[self.df_prop.label_final == label+1].tolist()
+                           for label in range(len(initial_htgs_lists))]
+        
+        for label, htgs in enumerate(self.htgs_lists):
+            print('camp ' + str(label+1) + ': ' + str(len(htgs)) + ' hashtags')
         
+        #save results
+        print('saving results')
+        self.save_artifact(self.df_prop, propag_results_filename, pd.to_pickle)
+        self.save_artifact(self.df_rounds, propag_rounds_filename, pd.to_pickle)
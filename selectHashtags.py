@@ -43,7 +43,7 @@ class selectHashtags(baseModule):
         # filename of the graph for propagating
         propag_results_filename = self.job['propag_results_filename']
         
-        df_prop = pd.read_pickle(propag_results_filename)
+        df_prop = self.load_artifact(propag_results_filename, pd.read_pickle)
         
         #==============================================================================
         # OPTIONAL PARAMETERS
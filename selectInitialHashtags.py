@@ -1,7 +1,7 @@
 # Author: Alexandre Bovet <alexandre.bovet@gmail.com>
 # License: BSD 3 clause
 
-import graph_tool.all as gt
+from HTCoocNetwork import load_graph
 
 from baseModule import baseModule
 
@@ -34,10 +34,10 @@ class selectInitialHashtags(baseModule):
         ##########################
 
 
-        G = gt.load_graph(graph_file)
+        G = self.load_artifact(graph_file, load_graph)
         # array with hashtags names
-        ht_names = G.vp.names.get_2d_array([0])[0]
-        counts = G.vp.counts.a
+        ht_names = G.vp.names
+        counts = G.vp.counts
         
         self.ht_names_counts = sorted([(str(htn), int(htc)) for htn, htc in zip(ht_names, counts)],
                                   key=lambda x:x[1], reverse=True)
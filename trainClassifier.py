@@ -5,13 +5,15 @@ from sklearn.linear_model import SGDClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.externals import joblib
 from sklearn.feature_extraction import DictVectorizer
-import pickle
 
 import time
 import numpy as np
 import ujson as json
 
 from baseModule import baseModule
+from artifactCache import load_pickle, load_array, load_sparse_array
+from TwSentiment import HashedFeatureVectorizer, hashed_bag_of_words_and_bigrams
+from functools import partial
 
 class trainClassifier(baseModule):
     """ Train a classifier on the training set using the best parameters.
@@ -23,6 +25,17 @@ class trainClassifier(baseModule):
         Uses features and labels from `features_pickle_file` and `labels_pickle_file`
         to train the classifier using the parameters from `best_params_file`.
         The trained classifier is then saved to `classifier_filename`.
+        
+        *Optional parameters:*
+        
+        :feature_hashing: if True, the classifier is trained directly on the 
+                          hashed features of `features_vect_file` and 
+                          `labels_vect_file` (written by `buildTrainingSet` 
+                          with the same option) and the pipeline uses a 
+                          `HashedFeatureVectorizer`. The feature extractor 
+                          giving directly the hashed columns of a text 
+                          (`hashed_bag_of_words_and_bigrams`) is saved with the 
+                          classifier and used by `classifyTweets`. Default is False.
     """
     
     def run(self):
@@ -35,6 +48,11 @@ class trainClassifier(baseModule):
         labels_mappers_file = self.job['labels_mappers_file']
         classifier_filename = self.job['classifier_filename']
         
+        #==============================================================================
+        # OPTIONAL PARAMETERS
+        #==============================================================================
+        feature_hashing = self.job.get('feature_hashing', False)
+        
         
         # load best parameters from crossval
         with open(best_params_file, 'r') as fopen:
@@ -76,31 +94,45 @@ class trainClassifier(baseModule):
                   
         pipeline = Pipeline(pipeline_list)
 
-        with open(labels_mappers_file, 'rb') as fopen:
-            labels_mappers = pickle.load(fopen)
+        labels_mappers = self.load_artifact(labels_mappers_file, load_pickle)
             
         label_mapper = labels_mappers['label_mapper']            
         label_inv_mapper = labels_mappers['label_inv_mapper']
         
         
-        with open(features_file, 'rb') as fopen:
-            features = pickle.load(fopen)
-        
-        with open(labels_file, 'rb') as fopen:
-            labels = pickle.load(fopen)
-        
-        def label_transformer(labels, mapper=label_mapper):
-            """ maps label names to label values """
-            return np.array([mapper[l] for l in labels])    
+        if feature_hashing:
+            # train on the hashed features without the dictionaries of features
+            X = self.load_artifact(self.job['features_vect_file'], load_sparse_array)
+            y = self.load_artifact(self.job['labels_vect_file'], load_array)
             
-        y = label_transformer(labels)
-
-        pipeline = Pipeline(pipeline_list)
-        
-        print('fitting classifier')
-        t0 = time.time()
-        
-        pipeline.fit(features, y)
+            pipeline = Pipeline([('feat_vectorizer', HashedFeatureVectorizer(n_features=X.shape[1],
+                                                                              dtype=np.int8)),
+                                 pipeline_list[-1]])
+            
+            print('fitting classifier')
+            t0 = time.time()
+            
+            # stores the version of the feature hashing
+            pipeline.named_steps['feat_vectorizer'].fit(X, y)
+            pipeline.named_steps['classifier'].fit(X, y)
+            
+        else:
+            features = self.load_artifact(features_file, load_pickle)
+            
+            labels = self.load_artifact(labels_file, load_pickle)
+            
+            def label_transformer(labels, mapper=label_mapper):
+                """ maps label names to label values """
+                return np.array([mapper[l] for l in labels])    
+                
+            y = label_transformer(labels)
+    
+            pipeline = Pipeline(pipeline_list)
+            
+            print('fitting classifier')
+            t0 = time.time()
+            
+            pipeline.fit(features, y)
         
         self.print_elapsed_time(t0) 
                                                      
@@ -108,7 +140,11 @@ class trainClassifier(baseModule):
                    'label_mapper' : label_mapper,
                    'label_inv_mapper' : label_inv_mapper}
         
-        joblib.dump(self.to_dump, classifier_filename)
+        if feature_hashing:
+            self.to_dump['feature_extractor'] = partial(hashed_bag_of_words_and_bigrams,
+                                                        n_features=X.shape[1])
+        
+        self.save_artifact(self.to_dump, classifier_filename, joblib.dump)
         
 
         